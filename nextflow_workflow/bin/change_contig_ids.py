@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import argparse
+import fasta_io
+import gzip
+import perf_timer
 import sys
 import re
 from typing import TextIO
@@ -7,39 +10,76 @@ from typing import *
 from os import path
 from pathlib import Path
 import json
+import os
 
 
 DEFAULT_PREFIX = "contig_id"
 INDENT_VAL = 4
 
 
-def to_file(output_path: str, text: str, verbose: bool) -> None:
-    if verbose:
-        print(f"Writing reverted text to {output_path}...")
+def build_id_regex(id_mapping_dict: Dict[str, str]) -> Pattern:
+    # replacement IDs are all {prefix}_{index}, so rather than searching for every ID separately we match any whole
+    # token made of a known prefix and an index, then look it up in the mapping dict. The lookarounds stop contig_id_1
+    # from matching inside contig_id_10 or my_contig_id_1
+    prefixes = set()
+    for key in id_mapping_dict.keys():
+        prefix_match = re.fullmatch(r"(.+)_\d+", key)
+        if not prefix_match:
+            # not a replacement ID from rename mode, so fall back to matching each ID literally (longest first)
+            keys = sorted(id_mapping_dict.keys(), key=len, reverse=True)
+            return re.compile(rf"(?<!\w)(?:{'|'.join(re.escape(key) for key in keys)})(?!\w)")
 
-    with open(output_path, "w") as output_file:
-        # get rid of escape character \ that changes original sequence name to something different
-        text_no_escape = text.encode("utf-8").decode('unicode-escape')
-        output_file.write(text_no_escape)
+        prefixes.add(prefix_match.group(1))
 
+    prefix_pattern = "|".join(re.escape(prefix) for prefix in sorted(prefixes, key=len, reverse=True))
 
-def revert_contig_ids(input_file: TextIO, id_mapping_dict: Dict[str, str], verbose: bool) -> str:
-    file_content = input_file.read() # read entire input file in one go (so we have to use re.sub() less)
+    return re.compile(rf"(?<!\w)(?:{prefix_pattern})_\d+(?!\w)")
 
-    for key in id_mapping_dict.keys(): # key here will be the replacement ID
-        if verbose:
-            print(f"Reverting {key} to {id_mapping_dict[key]}...")
 
-        file_content = re.sub(key, id_mapping_dict[key], file_content)
+def revert_contig_ids(input_file: TextIO, output_file: TextIO, id_mapping_dict: Dict[str, str], verbose: bool) -> int:
+    # nothing to revert, and an empty pattern would match everywhere
+    if not id_mapping_dict:
+        output_file.writelines(input_file)
+        return 0
+
+    id_regex = build_id_regex(id_mapping_dict)
+    replacement_count = 0
+    in_fasta_section = False
+
+    def lookup_original_id(id_match: Match) -> str:
+        return id_mapping_dict.get(id_match.group(0), id_match.group(0))
+
+    # stream the file once, line by line. Prokka .gff files end with the whole genome after a ##FASTA line- after that
+    # point only header lines can hold contig IDs, so sequence lines are copied without being searched
+    for line in input_file:
+        if in_fasta_section and line[0] != ">":
+            output_file.write(line)
+            continue
+
+        if line.startswith("##FASTA"):
+            in_fasta_section = True
+
+        reverted_line, line_count = id_regex.subn(lookup_original_id, line)
+        replacement_count += line_count
+        output_file.write(reverted_line)
 
-    return file_content
+    return replacement_count
 
 
-def revert_contig_ids_from_path(input_path: str, id_mapping_dict: Dict[str, str], verbose: bool) -> str:
+def revert_contig_ids_from_path(input_path: str, output_path: str, id_mapping_dict: Dict[str, str],
+                                verbose: bool) -> None:
     if verbose:
         print(f"Opening {input_path}...")
-    with open(input_path, "r") as input_file:
-        return revert_contig_ids(input_file, id_mapping_dict, verbose)
+
+    # output_path is usually the same as input_path, so write to a temporary file and move it into place once done
+    temp_path = f"{output_path}.tmp"
+    with open(input_path, "r") as input_file, open(temp_path, "w") as output_file:
+        replacement_count = revert_contig_ids(input_file, output_file, id_mapping_dict, verbose)
+
+    os.replace(temp_path, output_path)
+
+    if verbose:
+        print(f"Reverted {replacement_count} contig IDs, writing reverted text to {output_path}...")
 
 
 def load_map_dict_from_json(json_path: str, verbose: bool) -> Dict[str, str]:
@@ -59,70 +99,75 @@ def dict_to_json(json_path: str, map_dict: Dict[str, str]) -> None:
         json_file.write(json.dumps(map_dict, indent=INDENT_VAL))
 
 
-def tuple_list_to_fasta(fasta_path: str, tuple_list: List[Tuple[str,str,str]]) -> None:
-    with open(fasta_path, "w") as output_fasta:
-        for entry in tuple_list:
-            header = entry[1]
-            sequence = entry[2]
-            fasta_entry = f">{header}\n{sequence}\n"
+def rename_contig_ids(fasta_file: TextIO, output_fasta: TextIO, prefix: str,
+                      lengths_file: Optional[TextIO], verbose: bool) -> Dict[str, str]:
+    id_map_dict = {}
+    index = 0
+    original_id = None
+    replacement_id = None
+    seq_length = 0
 
-            output_fasta.write(fasta_entry)
+    def write_length() -> None:
+        if lengths_file is not None and original_id is not None:
+            lengths_file.write(f"{original_id}\t{seq_length}\t{replacement_id}\n")
 
+    if lengths_file is not None:
+        lengths_file.write("# Original ID\tLength\tReplacement ID\n")
 
-def change_contig_ids(fasta_tuple_list: List[Tuple[str,str,str]], prefix: str, verbose: bool) -> Tuple[List[Tuple[str,str,str]], Dict[str,str]]:
-    replaced_tuple_list = []
-    id_map_dict = {}
-    index = 1
+    # stream the .fasta one record at a time, so memory use doesn't depend on assembly size. Only header lines change-
+    # sequence lines are written back out untouched, and only counted if we're recording contig lengths
+    for header_line, seq_lines in fasta_io.read_fasta_records(fasta_file):
+        write_length()
 
-    for entry in fasta_tuple_list:
-        original_id = entry[0]
-        original_header = entry[1]
-        sequence = entry[2]
+        index += 1
+        # grab the 'name,' or fasta header line up to the first whitespace character, and keep everything after it
+        header = header_line[1:].rstrip("\n")
+        original_id = fasta_io.get_seq_id(header_line)
+        description = header[header.index(original_id) + len(original_id):] if original_id else header
 
         # generate replacement values. Sequence shouldn't be affected by this
         replacement_id = f"{prefix}_{index}"
-        replacement_header = re.sub(original_id, replacement_id, original_header)
-
-        index += 1
-
-        replaced_tuple_list.append((replacement_id, replacement_header, sequence))
+        seq_length = sum(len(line.strip()) for line in seq_lines) if lengths_file is not None else 0
         id_map_dict[replacement_id] = original_id
 
-        if verbose:
-            print(f"Replacing {original_id} with {replacement_id}...")
-
-    # the values in the dict have added backslashes to escape any weird characters- we need to get rid of them so they
-    # match the original contig ID exactly
-    for key in id_map_dict.keys():
-        id_map_dict[key] = re.sub("\\\\", "", id_map_dict[key])
-        
-    return replaced_tuple_list, id_map_dict
+        output_fasta.write(f">{replacement_id}{description}\n")
+        output_fasta.writelines(seq_lines)
 
+        if verbose:
+            print(f"Replacing {original_id} with {replacement_id}...", file=sys.stderr)
 
-def parse_fasta(fasta_file: TextIO) -> List[Tuple[str, str, str]]:
-    parsed_tuple_list = []
+    write_length()
 
-    fasta_list = re.split('\n>', fasta_file.read())
+    return id_map_dict
 
-    for entry in fasta_list:
-        # remove leading and trailing > character, if present
-        entry = entry.strip(">")
-        header, sequence = entry.split("\n", 1)
-        # grab the 'name,' or fasta header line up to the first whitespace character
-        seq_id = re.escape(header.split()[0])
 
-        entry_tuple = (seq_id, header, sequence)
-        parsed_tuple_list.append(entry_tuple)
+def rename_contig_ids_from_path(fasta_path: str, output_fasta_path: str, output_json: str, prefix: str,
+                                lengths_path: str, verbose: bool) -> None:
+    if verbose:
+        print(f"Opening {fasta_path}...", file=sys.stderr)
 
-    return parsed_tuple_list
+    lengths_file = open(lengths_path, "w") if lengths_path else None
 
+    try:
+        with fasta_io.open_fasta(fasta_path) as fasta_file:
+            # - writes the renamed .fasta to stdout, so it can be piped straight into the next tool
+            if output_fasta_path == "-":
+                id_map_dict = rename_contig_ids(fasta_file, sys.stdout, prefix, lengths_file, verbose)
+            else:
+                # a gzipped input overwritten in place stays gzipped, as does any output named .gz
+                compress = output_fasta_path.endswith(".gz") or \
+                    (output_fasta_path == fasta_path and fasta_io.is_gzipped(fasta_path))
 
-def parse_fasta_from_path(fasta_path: str, verbose: bool) -> List[Tuple[str, str, str]]:
-    with open(fasta_path, "r") as fasta_file:
-        if verbose:
-            print(f"Opening {fasta_path}...")
+                # output .fasta is the input .fasta by default, so write to a temporary file and move it into place
+                temp_path = f"{output_fasta_path}.tmp"
+                with (gzip.open(temp_path, "wt") if compress else open(temp_path, "w")) as output_fasta:
+                    id_map_dict = rename_contig_ids(fasta_file, output_fasta, prefix, lengths_file, verbose)
+                os.replace(temp_path, output_fasta_path)
+    finally:
+        if lengths_file is not None:
+            lengths_file.close()
 
-        return parse_fasta(fasta_file)
+    dict_to_json(output_json, id_map_dict)
 
 
 def parse_args(sys_args: list) -> argparse.Namespace:
@@ -141,14 +186,20 @@ def parse_args(sys_args: list) -> argparse.Namespace:
     change_parser.add_argument("input_fasta", type=str, help="Input .fasta format file with contigs to be renamed. By "
                                                              "default, this file will be overwritten to replace the "
                                                              "contig IDs (set --output_fasta to set a different output "
-                                                             "file instead")
+                                                             "file instead). A gzipped file stays gzipped")
     change_parser.add_argument("output_map_json", type=str, help="Output .json file containing a converted Python "
                                                              "dictionary that maps new IDs to original IDs")
     change_parser.add_argument("--prefix", type=str, help=f"Sets prefix for replacement IDs (default {default_prefix})",
                                default=default_prefix)
     change_parser.add_argument("--output_fasta", type=str, help="Optional output .fasta file. Will be a copy of the "
-                                                                "original input file with different contig IDs",
+                                                                "original input file with different contig IDs. Set "
+                                                                "to - to write to stdout. Gzipped if the path ends in "
+                                                                ".gz",
                                default="")
+    change_parser.add_argument("--output_lengths", type=str, default="",
+                               help="Optional output .tsv file listing each contig's original ID, length and "
+                                    "replacement ID, collected while renaming so the genome doesn't have to be read "
+                                    "again")
     # add parser for revert mode, which will scan through input file line by line, reverting contig ID to original
     # we also add arguments unique to the revert parser
     revert_parser = subparsers.add_parser('revert', help="Reverts any instance of a replacement contig ID with the "
@@ -170,6 +221,7 @@ def parse_args(sys_args: list) -> argparse.Namespace:
 def _main():
     # TODO: Explanations
     args = parse_args(sys.argv[1:]) # get command line args. Right now we can only grab arguments both have in common
+    perf_timer.start(__file__, args.change_mode)
     change_mode = args.change_mode # sets whether we rename contig IDs or revert to original names
     verbose = args.verbose # reports when we change something in either mode
 
@@ -189,16 +241,9 @@ def _main():
         if not output_fasta:
             output_fasta = fasta_file
 
-        # break fasta file into tuples containing (ID, header, sequence) where ID is anything between > and the first
-        # whitespace character and header is the full line after >
-        entry_tuple_list = parse_fasta_from_path(fasta_file, verbose)
-
-        # change IDs and get dictionary mapping replacement IDs (key) to original ID (value)
-        modified_entry_tuple_list, id_map_dict = change_contig_ids(entry_tuple_list, prefix, verbose)
-
-        # write modified .fasta entries, ID mapping structure to files
-        tuple_list_to_fasta(output_fasta, modified_entry_tuple_list)
-        dict_to_json(output_json, id_map_dict)
+        # rewrite headers with replacement IDs while streaming the .fasta to its output, writing the dictionary mapping
+        # replacement IDs (key) to original IDs (value) and optionally each contig's length as we go
+        rename_contig_ids_from_path(fasta_file, output_fasta, output_json, prefix, args.output_lengths, verbose)
 
     elif change_mode == 'revert':
         input_path = args.input_file # input file with replaced contig IDs, to be reverted to original IDs
@@ -211,9 +256,8 @@ def _main():
 
         id_mapping_dict = load_map_dict_from_json(input_json_path, verbose) # load input JSON to get ID mapping dict
 
-        file_text = revert_contig_ids_from_path(input_path, id_mapping_dict, verbose) # load input file to replace IDs
-
-        to_file(output_path, file_text, verbose) # write modified file text to output file (default: input file)
+        # replace IDs in input file, writing to output file (default: input file)
+        revert_contig_ids_from_path(input_path, output_path, id_mapping_dict, verbose)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+import argparse
+import gzip
+import mmap
+import os
+import re
+import sys
+from os import path
+from typing import TextIO
+from typing import *
+
+# Shared .fasta reading, writing and indexing for VIBES scripts, so every script follows the same parsing rules and
+# never holds a whole file in memory:
+#   - records are read lazily, one at a time, as (header line, sequence lines)
+#   - anything before the first '>' line and whitespace-only lines are ignored
+#   - a record's ID is its header up to the first whitespace character, and may be empty
+#   - records with no sequence are still yielded, so each script decides what to do with them
+#   - gzip and bgzip compressed files are detected from their first bytes and decompressed while reading
+# Uncompressed files can also be indexed with samtools-style .fai files, which hold each sequence's name, length, byte
+# offset of its first residue, residues per line and bytes per line. Regions are then read straight from a memory map
+# of the file, without reading anything before them.
+
+FASTA_LINE_WIDTH = 60
+GZIP_MAGIC = b"\x1f\x8b"
+WRITE_BUFFER_SIZE = 1024 * 1024
+# header of the manifest split_phage_database.py writes, listing each sequence's ID, length and the file it went to
+MANIFEST_HEADER = "# Sequence ID\tLength\tFile\n"
+
+# sequence length, byte offset of first residue, residues per line, bytes per line
+IndexEntry = Tuple[int, int, int, int]
+
+
+def overwrite_check(file_path: str, force: bool) -> None:
+    if path.isfile(file_path) and not force:
+        raise FileExistsError(
+            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+
+
+def is_gzipped(fasta_path: str) -> bool:
+    with open(fasta_path, "rb") as fasta_file:
+        return fasta_file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def open_fasta(fasta_path: str) -> TextIO:
+    # - reads from stdin. bgzip output is a series of gzip members, which gzip reads as one stream
+    if fasta_path == "-":
+        return sys.stdin
+
+    if is_gzipped(fasta_path):
+        return gzip.open(fasta_path, "rt")
+
+    return open(fasta_path, "r")
+
+
+def read_fasta_records(fasta_file: TextIO) -> Iterator[Tuple[str, List[str]]]:
+    # yields (header line, sequence lines) one record at a time, so only one record is ever held in memory. Lines keep
+    # their line endings, so records can be written back out unchanged
+    header = None
+    seq_lines = []
+
+    for line in fasta_file:
+        if line[0] == ">":
+            if header is not None:
+                yield header, seq_lines
+            header = line if line.endswith("\n") else line + "\n"
+            seq_lines = []
+        elif header is not None and not line.isspace():
+            seq_lines.append(line if line.endswith("\n") else line + "\n")
+
+    if header is not None:
+        yield header, seq_lines
+
+
+def read_fasta_records_from_path(fasta_path: str) -> Iterator[Tuple[str, List[str]]]:
+    fasta_file = open_fasta(fasta_path)
+
+    try:
+        yield from read_fasta_records(fasta_file)
+    finally:
+        if fasta_file is not sys.stdin:
+            fasta_file.close()
+
+
+def get_seq_id(header: str) -> str:
+    # grab the 'name,' or fasta header line up to the first whitespace character
+    split_header = header[1:].split(maxsplit=1)
+    return split_header[0] if split_header else ""
+
+
+def get_sequence(seq_lines: List[str]) -> str:
+    return "".join(line.strip() for line in seq_lines)
+
+
+def get_file_stem(seq_id: str, used_stems: Set[str], simple_name: bool = False) -> str:
+    # sequence IDs can hold characters that don't belong in file names, such as '/' or '|'
+    file_stem = re.sub(r"[^\w.-]", "_", seq_id)
+
+    # simple_name cuts the stem at its first '.', as Nextflow's simpleName does to the name of a file named after the ID
+    if simple_name:
+        file_stem = file_stem.split(".")[0]
+
+    file_stem = file_stem or "sequence"
+
+    # replacing characters can make two IDs map to the same name, so number any repeats
+    unique_stem = file_stem
+    repeat = 1
+    while unique_stem in used_stems:
+        repeat += 1
+        unique_stem = f"{file_stem}_{repeat}"
+
+    used_stems.add(unique_stem)
+
+    return unique_stem
+
+
+def format_fasta_entry(header: str, sequence: str, line_width: int = FASTA_LINE_WIDTH) -> str:
+    lines = [sequence[i:i + line_width] for i in range(0, len(sequence), line_width)]
+    return f">{header}\n" + "".join(f"{line}\n" for line in lines)
+
+
+class FastaWriter:
+    """Buffers .fasta output so many small records are written to disk in
+    a few large writes. Either wraps an open file or opens output_path,
+    where - writes to stdout"""
+
+    def __init__(self, output: Union[str, TextIO], line_width: int = FASTA_LINE_WIDTH,
+                 buffer_size: int = WRITE_BUFFER_SIZE):
+        self.owns_file = isinstance(output, str)
+        if not self.owns_file:
+            self.output_file = output
+        elif output == "-":
+            self.owns_file = False
+            self.output_file = sys.stdout
+        else:
+            self.output_file = open(output, "w")
+
+        self.line_width = line_width
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.record_count = 0
+
+    def write(self, text: str) -> None:
+        self.buffer.append(text)
+        self.buffered += len(text)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_record(self, header: str, sequence: str) -> None:
+        # header doesn't include the '>' character. Sequence is wrapped to line_width residues per line
+        self.write(format_fasta_entry(header, sequence, self.line_width))
+        self.record_count += 1
+
+    def write_lines(self, header_line: str, seq_lines: List[str]) -> None:
+        # write a record as it was read by read_fasta_records(), keeping its original line wrapping
+        self.write(header_line)
+        for line in seq_lines:
+            self.write(line)
+        self.record_count += 1
+
+    def flush(self) -> None:
+        self.output_file.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self) -> None:
+        self.flush()
+        if self.owns_file:
+            self.output_file.close()
+        else:
+            self.output_file.flush()
+
+    def __enter__(self) -> "FastaWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def build_fasta_index(fasta_path: str, verbose: bool) -> Dict[str, IndexEntry]:
+    # builds a samtools-style .fai index: for each sequence, its length, the byte offset of its first residue, the
+    # number of residues per line and the number of bytes per line (including the newline)
+    if is_gzipped(fasta_path):
+        # random access into bgzip files needs a separate .gzi block index, which isn't supported
+        raise ValueError(f"{fasta_path} is compressed, so it can't be indexed. Decompress it first")
+
+    if verbose:
+        print(f"Indexing {fasta_path}...", file=sys.stderr)
+
+    index_dict = {}
+    seq_name = None
+    seq_len = offset = line_bases = line_width = 0
+    last_line_short = False
+    byte_pos = 0
+
+    with open(fasta_path, "rb") as fasta_file:
+        for line in fasta_file:
+            line_start = byte_pos
+            byte_pos += len(line)
+
+            if line.startswith(b">"):
+                if seq_name is not None:
+                    index_dict[seq_name] = (seq_len, offset, line_bases, line_width)
+
+                seq_name = get_seq_id(line.decode())
+                if seq_name in index_dict:
+                    raise ValueError(f"{fasta_path} contains sequence {seq_name} more than once, so it can't be "
+                                     f"indexed")
+
+                seq_len = line_bases = line_width = 0
+                offset = byte_pos
+                last_line_short = False
+                continue
+
+            bases = len(line.rstrip(b"\r\n"))
+            if bases == 0:
+                # a blank line before a sequence's first residue just moves its offset. After that, it ends the
+                # sequence's line layout like a short line, so any sequence line after it can't be indexed
+                if line_bases == 0:
+                    offset = byte_pos
+                else:
+                    last_line_short = True
+                continue
+
+            # every line but the last in a sequence must be the same length, or offsets can't be computed
+            if line_bases == 0:
+                line_bases = bases
+                line_width = len(line)
+            elif last_line_short or bases > line_bases:
+                raise ValueError(f"{fasta_path} has sequence lines of different lengths in {seq_name} (byte "
+                                 f"{line_start}), so it can't be indexed")
+
+            last_line_short = bases < line_bases
+            seq_len += bases
+
+    if seq_name is not None:
+        index_dict[seq_name] = (seq_len, offset, line_bases, line_width)
+
+    return index_dict
+
+
+def read_fasta_index(index_path: str) -> Dict[str, IndexEntry]:
+    index_dict = {}
+
+    with open(index_path, "r") as index_file:
+        for line in index_file:
+            name, seq_len, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+            index_dict[name] = (int(seq_len), int(offset), int(line_bases), int(line_width))
+
+    return index_dict
+
+
+def write_fasta_index(index_path: str, index_dict: Dict[str, IndexEntry]) -> None:
+    # write to a temporary file and move it into place, so a concurrent run never reads a partial index
+    temp_path = f"{index_path}.tmp.{os.getpid()}"
+    with open(temp_path, "w") as index_file:
+        for name, (seq_len, offset, line_bases, line_width) in index_dict.items():
+            index_file.write(f"{name}\t{seq_len}\t{offset}\t{line_bases}\t{line_width}\n")
+    os.replace(temp_path, index_path)
+
+
+def load_fasta_index(fasta_path: str, verbose: bool) -> Dict[str, IndexEntry]:
+    index_path = fasta_path + ".fai"
+
+    # the index is kept next to the .fasta, and only rebuilt if it's missing or older than the .fasta
+    if path.isfile(index_path) and path.getmtime(index_path) >= path.getmtime(fasta_path):
+        return read_fasta_index(index_path)
+
+    index_dict = build_fasta_index(fasta_path, verbose)
+
+    try:
+        write_fasta_index(index_path, index_dict)
+    except OSError:
+        # the .fasta's directory may be read only- the index then just isn't kept for later runs
+        if verbose:
+            print(f"Couldn't write index {index_path}, continuing without saving it", file=sys.stderr)
+
+    return index_dict
+
+
+class FastaIndex:
+    """Random access to sequences in an uncompressed .fasta file through
+    its .fai index and a memory map of the file, so reading a region
+    costs the same no matter where in the file it is"""
+
+    def __init__(self, fasta_path: str, verbose: bool = False):
+        self.fasta_path = fasta_path
+        self.index_dict = load_fasta_index(fasta_path, verbose)
+        self.fasta_file = open(fasta_path, "rb")
+        self.fasta_map = mmap.mmap(self.fasta_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, seq_name: str) -> bool:
+        return seq_name in self.index_dict
+
+    def get_length(self, seq_name: str) -> int:
+        return self.get_entry(seq_name)[0]
+
+    def get_entry(self, seq_name: str) -> IndexEntry:
+        if seq_name not in self.index_dict:
+            raise KeyError(f"Sequence {seq_name} not found in {self.fasta_path}")
+
+        return self.index_dict[seq_name]
+
+    def fetch(self, seq_name: str, start: int = 1, end: Optional[int] = None) -> str:
+        # start and end are 1-indexed and inclusive, and end defaults to the end of the sequence. Convert each to the
+        # byte offset of that residue in the file, then slice the memory-mapped file and drop line breaks
+        seq_len, offset, line_bases, line_width = self.get_entry(seq_name)
+        end = seq_len if end is None else min(end, seq_len)
+
+        if seq_len == 0 or end < start:
+            return ""
+
+        start_index = max(start, 1) - 1
+        end_index = end - 1
+
+        start_byte = offset + (start_index // line_bases) * line_width + start_index % line_bases
+        end_byte = offset + (end_index // line_bases) * line_width + end_index % line_bases
+
+        return self.fasta_map[start_byte:end_byte + 1].replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def close(self) -> None:
+        self.fasta_map.close()
+        self.fasta_file.close()
+
+    def __enter__(self) -> "FastaIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Shared .fasta reader, writer and indexer used by VIBES "
+                                                           "scripts. Run directly to index or fetch from a .fasta file")
+    subparsers = parser.add_subparsers(dest="fasta_mode",
+                                       help="index writes a samtools-style .fai index next to a .fasta file, fetch "
+                                            "prints a region of one sequence using that index")
+
+    index_parser = subparsers.add_parser("index", help="Write a .fai index for an uncompressed .fasta file")
+    index_parser.add_argument("input_fasta", type=str, help="Path to uncompressed .fasta file")
+    index_parser.add_argument("--force", action="store_true", help="If the index already exists, overwrite it")
+
+    fetch_parser = subparsers.add_parser("fetch", help="Print a region of one sequence in .fasta format, building the "
+                                                       "index first if needed")
+    fetch_parser.add_argument("input_fasta", type=str, help="Path to uncompressed .fasta file")
+    fetch_parser.add_argument("seq_name", type=str, help="ID of sequence to fetch from")
+    fetch_parser.add_argument("--start", type=int, default=1, help="1-indexed start of region (default 1)")
+    fetch_parser.add_argument("--end", type=int, default=None,
+                              help="1-indexed, inclusive end of region (default: end of sequence)")
+
+    # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers
+    for name, subp in subparsers.choices.items():
+        subp.add_argument("--verbose", action="store_true",
+                          help="Print additional information useful for debugging to stderr")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    fasta_mode = args.fasta_mode
+    verbose = args.verbose
+
+    if fasta_mode == "index":
+        index_path = args.input_fasta + ".fai"
+        overwrite_check(index_path, args.force)
+        write_fasta_index(index_path, build_fasta_index(args.input_fasta, verbose))
+
+    elif fasta_mode == "fetch":
+        with FastaIndex(args.input_fasta, verbose) as fasta_index:
+            end = args.end if args.end is not None else fasta_index.get_length(args.seq_name)
+            region = fasta_index.fetch(args.seq_name, args.start, end)
+
+        with FastaWriter("-") as writer:
+            writer.write_record(f"{args.seq_name}_{args.start}-{end}", region)
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,7 +1,20 @@
 #!/usr/bin/env python3
 import re
 import argparse
+import fasta_io
+import os
 import sys
+from multiprocessing import Pool
+
+# Default size of each byte range of the input handed to a worker process, in MB
+DEFAULT_CHUNK_SIZE = 64
+
+# Looks for 'virus', 'viral', or 'phage' anywhere in a header line, ignoring case. Compiled once at import so each worker
+# process has its own copy
+headerRegex = re.compile(rb'(virus|viral|phage)', re.IGNORECASE)
+
+# Matches runs of blank or whitespace-only lines, which the shared .fasta reader drops
+blankLineRegex = re.compile(rb'\n\s*\n')
 
 
 # containing argparse in a function can make testing functions easier
@@ -12,42 +25,112 @@ def parseArgs(sysArgs):
     parser.add_argument("output", help="Path to output filtered .fasta file containing viral protein sequence")
     parser.add_argument("-f", "--force", help="If output files already exist, overwrite them", action="store_true")
     parser.add_argument("-v", "--verbose", help="Print number of matching entries found", action="store_true")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes filtering the input in parallel (default: number of CPUs). Compressed "
+                             "input is always filtered by one process")
+    parser.add_argument("-c", "--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Size in MB of the pieces the input is split into for parallel filtering (default %d)"
+                             % DEFAULT_CHUNK_SIZE)
 
     return parser.parse_args()
 
 
+# Split inputFasta into byte ranges of roughly chunkSize bytes. Each range is extended to end just before the next header
+# line, so every range holds only whole entries and ranges can be filtered independently
+def findChunkBoundaries(inputFasta, chunkSize):
+    fileSize = os.path.getsize(inputFasta)
+    boundaries = [0]
+
+    with open(inputFasta, "rb") as inputFileHandle:
+        while boundaries[-1] + chunkSize < fileSize:
+            # skip to the start of the line after the target offset, then on to the next header line
+            inputFileHandle.seek(boundaries[-1] + chunkSize)
+            inputFileHandle.readline()
+            boundary = inputFileHandle.tell()
+
+            line = inputFileHandle.readline()
+            while line and not line.startswith(b">"):
+                boundary = inputFileHandle.tell()
+                line = inputFileHandle.readline()
+
+            if not line:
+                break
+
+            boundaries.append(boundary)
+
+    boundaries.append(fileSize)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# Filter the entries in one byte range of inputFasta, returning the kept entries (in their original order) and how many
+# there were. Only each entry's header line is searched, never its sequence
+def filterChunk(chunkTask):
+    inputFasta, chunkStart, chunkEnd = chunkTask
+
+    with open(inputFasta, "rb") as inputFileHandle:
+        inputFileHandle.seek(chunkStart)
+        chunkData = inputFileHandle.read(chunkEnd - chunkStart)
+
+    # anything before the first header line in the file isn't part of an entry
+    if not chunkData.startswith(b">"):
+        firstHeader = chunkData.find(b"\n>")
+        if firstHeader == -1:
+            return b"", 0
+        chunkData = chunkData[firstHeader + 1:]
+
+    keptEntries = []
+
+    # each range starts with a header line, so splitting on newlines followed by '>' gives one piece per entry, with the
+    # leading '>' and trailing newline removed
+    for entry in chunkData[1:].split(b"\n>"):
+        headerEnd = entry.find(b"\n")
+        header = entry if headerEnd == -1 else entry[:headerEnd]
+
+        if headerRegex.search(header):
+            entry = blankLineRegex.sub(b"\n", b">" + entry.rstrip(b"\n") + b"\n")
+            keptEntries.append(entry)
+
+    return b"".join(keptEntries), len(keptEntries)
+
+
 # Grab all entries from input .fasta that have 'virus' or 'phage' in their headers and save them in output .fasta file. Discard any that don't.
-# Print how many matches were found
-def filterEntries(inputFasta, outputFasta, force, verbose):
+# Print how many matches were found. Uncompressed input is split into byte ranges that are filtered by a pool of worker
+# processes, and the kept entries are written in the same order as the input
+def filterEntries(inputFasta, outputFasta, force, verbose, workers=1, chunkSize=DEFAULT_CHUNK_SIZE):
     # Counter to keep track of, and ultimate report the number of, matching entries found
     savedEntries = 0
 
-    # Since this regex statement will be used many times, we compile it ahead of time to save a little time. This regex statement
-    # looks for a '>' at the start of a line, followed by at least 0 non-newline characters, followed by either 'virus', 'viral', or 'phage'.
-    # This is to ensure that matches are in header lines, rather than sequence data, since the statement ignores case
-    virusRegex = re.compile(r'>[^\n\r]*(virus|viral|phage)', re.IGNORECASE)
-
     # This variable stores either 'w' or 'x'. 'w' tells it to overwrite the output if it already exists (--force set),
     # 'x' instructs open() to only open the output file if it doesn't already exist (--force not set),
     # credit for conditional assignment syntax to https://stackoverflow.com/questions/394809/does-python-have-a-ternary-conditional-operator
     openPermission = 'w' if force else 'x'
 
+    # compressed input can't be split into byte ranges, so it's streamed through one process
+    parallel = workers > 1 and not fasta_io.is_gzipped(inputFasta)
+
     try:
-        with open(outputFasta, openPermission) as outputFileHandle:
-            with open(inputFasta, "r") as inputFileHandle:
-                inputData = inputFileHandle.read()
-                # use regex to split all entries in the file along the > character, which denotes the beginning of a .fasta entry
-                entriesList = re.split(r'>', inputData)
-
-                for entry in entriesList:
-                    # re-attach '>' to front of entry's header line
-                    entry = ">%s" % entry
-
-                    # if the header line contains virus or phage (regardless of upper or lower case), we want to save it to output.
-                    # Ignore matches in any line after the header
-                    if re.search(virusRegex, entry):
-                        outputFileHandle.write(entry)
-                        savedEntries += 1
+        if parallel:
+            chunkTasks = [(inputFasta, chunkStart, chunkEnd)
+                          for chunkStart, chunkEnd in findChunkBoundaries(inputFasta, chunkSize * 1024 * 1024)]
+
+            with open(outputFasta, openPermission + "b") as outputFileHandle, Pool(processes=workers) as pool:
+                # imap hands back results in the order the ranges were submitted, so output order matches input order
+                for keptData, keptCount in pool.imap(filterChunk, chunkTasks):
+                    outputFileHandle.write(keptData)
+                    savedEntries += keptCount
+
+        else:
+            with open(outputFasta, openPermission) as outputFileHandle:
+                # read one entry at a time rather than the whole file, so memory use doesn't depend on the size of the
+                # input
+                with fasta_io.FastaWriter(outputFileHandle) as outputWriter:
+                    for header, seqLines in fasta_io.read_fasta_records_from_path(inputFasta):
+                        # if the header line contains virus or phage (regardless of upper or lower case), we want to
+                        # save it to output. Ignore matches in any line after the header
+                        if headerRegex.search(header.encode()):
+                            outputWriter.write_lines(header, seqLines)
+                            savedEntries += 1
 
         if verbose:
             print("%d entries contained virus, viral, or phage in their headers" % savedEntries)
@@ -61,4 +144,4 @@ def filterEntries(inputFasta, outputFasta, force, verbose):
 if __name__ == "__main__":
     args = parseArgs(sys.argv[1:])
 
-    filterEntries(args.input, args.output, args.force, args.verbose)
+    filterEntries(args.input, args.output, args.force, args.verbose, max(1, args.workers), max(1, args.chunk_size))
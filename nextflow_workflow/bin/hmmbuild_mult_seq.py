@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import argparse
+import fasta_io
+import perf_timer
 import re
 import sys
 import subprocess
@@ -56,32 +58,33 @@ def generate_hmm(temp_fasta_dict: Dict[str, str], seq_type: Optional[str], cpu_c
     return temp_hmm_list
 
 
-def generate_temp_fastas(fasta_file: TextIO, temp_folder: str) -> Dict[str, str]:
+def generate_temp_fastas(fasta_file: TextIO, temp_folder: str, verbose: bool) -> Dict[str, str]:
     temp_fasta_dict = {}
-    fasta_list = re.split('\n>', fasta_file.read())
     index = 1
 
-    for entry in fasta_list:
-        # remove leading and trailing > character, if present
-        entry = entry.strip(">")
-        header, sequence = entry.split("\n", 1)
+    for header, seq_lines in fasta_io.read_fasta_records(fasta_file):
+        # hmmbuild fails on a record with no sequence, so leave it out rather than stopping the whole build
+        if not seq_lines:
+            if verbose:
+                print(f"Skipping {header.strip()}, which has no sequence")
+            continue
+
         # grab the 'name,' or fasta header line up to the first whitespace character
-        seq_name = re.escape(header.split()[0])
+        seq_name = re.escape(fasta_io.get_seq_id(header))
 
         temp_file_path = f"{temp_folder}temp{index}.fasta"
         temp_fasta_dict[temp_file_path] = seq_name
-        with open(temp_file_path, "w") as temp_file:
-            temp_file.write(f">{header.strip()}\n{sequence.strip()}")
-            temp_file.close()
+        with fasta_io.FastaWriter(temp_file_path) as temp_writer:
+            temp_writer.write_lines(header, seq_lines)
 
         index += 1
 
     return temp_fasta_dict
 
 
-def generate_temp_fastas_from_path(fasta_path: str, temp_folder: str) -> Dict[str, str]:
-    with open(fasta_path) as fasta_file:
-        temp_fasta_dict = generate_temp_fastas(fasta_file, temp_folder)
+def generate_temp_fastas_from_path(fasta_path: str, temp_folder: str, verbose: bool) -> Dict[str, str]:
+    with fasta_io.open_fasta(fasta_path) as fasta_file:
+        temp_fasta_dict = generate_temp_fastas(fasta_file, temp_folder, verbose)
 
     return temp_fasta_dict
 
@@ -99,7 +102,7 @@ def do_cmd(cmd: List[str], verbose: bool):
 
 def parse_args(sys_args: list) -> argparse.Namespace:
     parser = argparse.ArgumentParser(sys_args, description="Accepts input .fasta file and generates HMM for each entry. Automatically runs hmmpress on output .hmm file")
-    parser.add_argument("input_fasta", type=str, help="Input .fasta format file containing dna/rna/amino acid sequences")
+    parser.add_argument("input_fasta", type=str, help="Input .fasta format file containing dna/rna/amino acid sequences. May be gzip compressed")
     parser.add_argument("output_hmm", type=str, help="Path to output .hmm file. Output.hmm will be accompanied by auxiliary 'pressed' files")
     parser.add_argument("--temp_folder", type=str, default=None, help="Path to folder where temporary .fasta files will be created. These are automatically deleted before the program ends."
                                                                       "If no folder is specified, temporary files are stored in the directory that the output file will live in")
@@ -113,6 +116,7 @@ def parse_args(sys_args: list) -> argparse.Namespace:
 
 def _main():
     args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__)
     fasta_path = args.input_fasta
     hmm_path = args.output_hmm
     seq_type = args.seq_type
@@ -130,7 +134,7 @@ def _main():
         # the user
         temp_folder = path.dirname(fasta_path)
 
-    temp_fasta_dict = generate_temp_fastas_from_path(fasta_path, temp_folder)
+    temp_fasta_dict = generate_temp_fastas_from_path(fasta_path, temp_folder, verbose)
     temp_hmm_list = generate_hmm(temp_fasta_dict, seq_type, cpu_count, verbose)
 
     combine_hmms(temp_hmm_list, hmm_path, force)
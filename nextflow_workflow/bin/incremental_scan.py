@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import argparse
+import fasta_io
+import perf_timer
+import hashlib
+import re
+import sys
+from os import path
+from typing import TextIO
+from typing import *
+
+# Supports scanning genomes against only the phages added to a database since the last run. A manifest of phage names
+# and sequence hashes records what every stored per-genome table was scanned against. diff mode compares the current
+# phage database to that manifest, and merge mode folds a scan against only the new phages into a genome's stored,
+# unfiltered nhmmscan table.
+#
+# nhmmscan computes each hit's E-value from the model and the length of the scanned sequence, not from how many models
+# are in the database, so hits from a partial scan carry the same E-values a full rescan would give them. The merged
+# table is unfiltered, so redundant hits are resolved by running dfamscan.pl over it just like after a full scan.
+
+
+def overwrite_check(file_path: str, force: bool) -> None:
+    if path.isfile(file_path) and not force:
+        raise FileExistsError(
+            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+
+
+def hash_sequence(seq_lines: List[str]) -> str:
+    seq_hash = hashlib.sha256()
+    for line in seq_lines:
+        seq_hash.update(line.strip().upper().encode("ascii"))
+
+    return seq_hash.hexdigest()
+
+
+def read_manifest(manifest_path: str, verbose: bool) -> Dict[str, str]:
+    manifest_dict = {}
+
+    # on the first incremental run there is no manifest yet, so every phage is new
+    if not manifest_path or not path.isfile(manifest_path):
+        if verbose:
+            print(f"No phage manifest found at {manifest_path}, treating all phages as new", file=sys.stderr)
+        return manifest_dict
+
+    with open(manifest_path, "r") as manifest_file:
+        for line in manifest_file:
+            if line[0] == "#":
+                continue
+
+            phage_name, seq_hash = line.rstrip("\n").split("\t")
+            manifest_dict[phage_name] = seq_hash
+
+    return manifest_dict
+
+
+def diff_phage_database(phage_file: TextIO, manifest_dict: Dict[str, str], new_fasta: TextIO, manifest: TextIO,
+                        verbose: bool) -> Tuple[int, Set[str]]:
+    new_count = 0
+    seen_names = set()
+    changed_names = set()
+
+    manifest.write("# Phage name\tSequence SHA-256\n")
+
+    for header, seq_lines in fasta_io.read_fasta_records(phage_file):
+        # grab the 'name,' or fasta header line up to the first whitespace character
+        phage_name = fasta_io.get_seq_id(header)
+        seq_hash = hash_sequence(seq_lines)
+        seen_names.add(phage_name)
+
+        manifest.write(f"{phage_name}\t{seq_hash}\n")
+
+        if manifest_dict.get(phage_name) != seq_hash:
+            new_fasta.write(header)
+            new_fasta.writelines(seq_lines)
+            new_count += 1
+
+            # a phage whose sequence changed is rescanned like a new one, but its old hits must also be dropped
+            if phage_name in manifest_dict:
+                changed_names.add(phage_name)
+
+            if verbose:
+                print(f"{phage_name} is new or changed since the last run", file=sys.stderr)
+
+    removed_names = (set(manifest_dict.keys()) - seen_names) | changed_names
+
+    return new_count, removed_names
+
+
+def diff_phage_database_from_path(phage_path: str, manifest_path: str, new_fasta_path: str,
+                                  output_manifest_path: str, removed_path: str, force: bool, verbose: bool) -> None:
+    for output_path in (new_fasta_path, output_manifest_path, removed_path):
+        overwrite_check(output_path, force)
+
+    manifest_dict = read_manifest(manifest_path, verbose)
+
+    with fasta_io.open_fasta(phage_path) as phage_file, open(new_fasta_path, "w") as new_fasta, \
+            open(output_manifest_path, "w") as manifest:
+        new_count, removed_names = diff_phage_database(phage_file, manifest_dict, new_fasta, manifest, verbose)
+
+    with open(removed_path, "w") as removed_file:
+        for phage_name in sorted(removed_names):
+            removed_file.write(f"{phage_name}\n")
+
+    print(f"{new_count} new or changed phages, {len(removed_names)} removed or changed phages", file=sys.stderr)
+
+
+def read_removed_models(removed_path: str) -> Set[str]:
+    removed_models = set()
+
+    if not removed_path:
+        return removed_models
+
+    with open(removed_path, "r") as removed_file:
+        for line in removed_file:
+            if line.strip():
+                # hmmbuild_mult_seq.py names each model with the regex-escaped phage name, so that's what appears in
+                # the model column of nhmmscan tables
+                removed_models.add(re.escape(line.strip()))
+
+    return removed_models
+
+
+def split_table(table_path: str) -> Tuple[str, List[str]]:
+    header = ""
+    rows = []
+    header_done = False
+
+    with open(table_path, "r") as table_file:
+        for line in table_file:
+            if line[0] == "#":
+                # like dfamscan.pl, keep only the first block of comment lines as the header
+                if not header_done:
+                    header += line
+                continue
+
+            header_done = True
+            rows.append(line)
+
+    return header, rows
+
+
+def merge_tables(stored_path: str, new_path: str, removed_models: Set[str], output_path: str, force: bool,
+                 verbose: bool) -> bool:
+    overwrite_check(output_path, force)
+
+    new_header, new_rows = split_table(new_path)
+    stored_header = ""
+    stored_rows = []
+    has_stored_table = bool(stored_path) and path.isfile(stored_path)
+
+    if has_stored_table:
+        stored_header, stored_rows = split_table(stored_path)
+
+    kept_rows = [row for row in stored_rows if row.split(maxsplit=1)[0] not in removed_models]
+    dropped_count = len(stored_rows) - len(kept_rows)
+
+    with open(output_path, "w") as output_table:
+        output_table.write(stored_header or new_header)
+        output_table.writelines(kept_rows)
+        output_table.writelines(new_rows)
+
+    if verbose:
+        print(f"{len(new_rows)} new hits added, {dropped_count} hits to removed phages dropped", file=sys.stderr)
+
+    # a genome's integration output only needs regenerating if its table differs from the stored one
+    return not has_stored_table or len(new_rows) > 0 or dropped_count > 0
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Supports incremental scans, where genomes that have already "
+                                                           "been scanned are only scanned against phages added to the "
+                                                           "database since the last run")
+    subparsers = parser.add_subparsers(dest="incremental_mode",
+                                       help="diff finds phages that are new since the stored manifest was written, "
+                                            "merge adds hits against new phages to a genome's stored, unfiltered "
+                                            "table")
+
+    diff_parser = subparsers.add_parser("diff", help="Compare a phage database against the stored manifest")
+    diff_parser.add_argument("phage_fasta", type=str, help="Path to .fasta file containing all phage genomes")
+    diff_parser.add_argument("stored_manifest", type=str,
+                             help="Path to manifest written by the previous run. If it doesn't exist, every phage is "
+                                  "treated as new")
+    diff_parser.add_argument("output_new_fasta", type=str,
+                             help="Path to output .fasta containing only new or changed phages")
+    diff_parser.add_argument("output_manifest", type=str,
+                             help="Path to output manifest describing the full current phage database")
+    diff_parser.add_argument("output_removed", type=str,
+                             help="Path to output text file listing phages whose stored hits must be dropped, because "
+                                  "they were removed from the database or their sequence changed")
+
+    merge_parser = subparsers.add_parser("merge", help="Merge a table of hits against new phages into a genome's "
+                                                       "stored table. Prints true if the merged table differs from "
+                                                       "the stored one, false otherwise")
+    merge_parser.add_argument("new_table", type=str,
+                              help="Path to unfiltered nhmmscan --dfamtblout table from scanning against new phages")
+    merge_parser.add_argument("output_table", type=str, help="Path to output merged, unfiltered table")
+    merge_parser.add_argument("--stored_table", type=str, default="",
+                              help="Path to genome's stored, unfiltered table from previous runs. If missing, the "
+                                   "genome is treated as never scanned")
+    merge_parser.add_argument("--removed", type=str, default="",
+                              help="Path to list of removed phages written by diff mode")
+
+    # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers
+    for name, subp in subparsers.choices.items():
+        subp.add_argument("--verbose", action="store_true",
+                          help="Print additional information useful for debugging to stderr")
+        subp.add_argument("--force", action="store_true", help="If output files already exist, overwrite them")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__, args.incremental_mode)
+    incremental_mode = args.incremental_mode
+    verbose = args.verbose
+    force = args.force
+
+    if incremental_mode == "diff":
+        diff_phage_database_from_path(args.phage_fasta, args.stored_manifest, args.output_new_fasta,
+                                      args.output_manifest, args.output_removed, force, verbose)
+
+    elif incremental_mode == "merge":
+        removed_models = read_removed_models(args.removed)
+        changed = merge_tables(args.stored_table, args.new_table, removed_models, args.output_table, force, verbose)
+        # printed in lowercase so it can be compared directly in workflow.nf
+        print(str(changed).lower())
+
+
+if __name__ == "__main__":
+    _main()
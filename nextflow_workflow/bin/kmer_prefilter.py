@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+import argparse
+import fasta_io
+import perf_timer
+import sys
+import zlib
+from array import array
+from os import path
+from typing import TextIO
+from typing import *
+
+DEFAULT_KMER_SIZE = 21
+DEFAULT_SKETCH_SCALE = 10
+DEFAULT_MIN_SHARED_KMERS = 3
+DEFAULT_EVAL = 1e-5
+# crc32 hashes fall in [0, 2^32). A sketch with scale s keeps only k-mers hashing below 2^32 / s, so roughly 1 in s
+# k-mers is stored or compared, and the same k-mers are sampled from both the phage database and the genomes
+HASH_SPACE = 2 ** 32
+COMPLEMENT_TABLE = str.maketrans("ACGTUNacgtun", "TGCAANtgcaan")
+TABLE_MODE = Literal["dfam", "tbl"]
+
+
+def overwrite_check(file_path: str, force: bool) -> None:
+    if path.isfile(file_path) and not force:
+        raise FileExistsError(
+            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+
+
+def get_max_hash(sketch_scale: int) -> int:
+    return HASH_SPACE // sketch_scale
+
+
+def reverse_complement(sequence: str) -> str:
+    return sequence.translate(COMPLEMENT_TABLE)[::-1]
+
+
+def sketch_sequence(sequence: str, kmer_size: int, max_hash: int) -> Iterator[int]:
+    # RNA phages are sketched as DNA, so they share k-mers with the DNA genomes they're compared to
+    seq_bytes = sequence.upper().replace("U", "T").encode("ascii")
+    # slicing a memoryview avoids copying every k-mer before it is hashed
+    seq_view = memoryview(seq_bytes)
+
+    for index in range(len(seq_bytes) - kmer_size + 1):
+        kmer_hash = zlib.crc32(seq_view[index:index + kmer_size])
+        if kmer_hash < max_hash:
+            yield kmer_hash
+
+
+def build_phage_index(phage_file: TextIO, kmer_size: int, max_hash: int, verbose: bool) -> Set[int]:
+    kmer_index = set()
+
+    for header, seq_lines in fasta_io.read_fasta_records(phage_file):
+        sequence = fasta_io.get_sequence(seq_lines)
+        # phages may integrate in either orientation. Indexing both strands here means genomes only need to be
+        # sketched on their forward strand
+        kmer_index.update(sketch_sequence(sequence, kmer_size, max_hash))
+        kmer_index.update(sketch_sequence(reverse_complement(sequence), kmer_size, max_hash))
+
+        if verbose:
+            print(f"Indexed {fasta_io.get_seq_id(header)}: {len(kmer_index)} sampled k-mers in index")
+
+    return kmer_index
+
+
+def write_index(index_path: str, kmer_index: Set[int], kmer_size: int, sketch_scale: int, force: bool) -> None:
+    overwrite_check(index_path, force)
+
+    # the index is stored as a small header (k-mer size, sketch scale) followed by sorted unsigned 32-bit hashes
+    hash_array = array("I", [kmer_size, sketch_scale])
+    hash_array.extend(sorted(kmer_index))
+
+    with open(index_path, "wb") as index_file:
+        hash_array.tofile(index_file)
+
+
+def read_index(index_path: str, verbose: bool) -> Tuple[Set[int], int, int]:
+    if verbose:
+        print(f"Opening {index_path}...")
+
+    hash_array = array("I")
+    with open(index_path, "rb") as index_file:
+        hash_array.frombytes(index_file.read())
+
+    kmer_size = hash_array[0]
+    sketch_scale = hash_array[1]
+
+    return set(hash_array[2:]), kmer_size, sketch_scale
+
+
+def count_shared_kmers(sequence: str, kmer_index: Set[int], kmer_size: int, max_hash: int) -> Tuple[int, int]:
+    sampled = 0
+    shared = 0
+
+    for kmer_hash in sketch_sequence(sequence, kmer_size, max_hash):
+        sampled += 1
+        if kmer_hash in kmer_index:
+            shared += 1
+
+    return sampled, shared
+
+
+def prefilter_genome(genome_file: TextIO, output_fasta: TextIO, report: TextIO, kmer_index: Set[int], kmer_size: int,
+                     max_hash: int, min_shared_kmers: int, verbose: bool) -> Tuple[int, int]:
+    total_seqs = 0
+    removed_seqs = 0
+    report_lines = []
+
+    for header, seq_lines in fasta_io.read_fasta_records(genome_file):
+        seq_id = fasta_io.get_seq_id(header)
+        sequence = fasta_io.get_sequence(seq_lines)
+        sampled, shared = count_shared_kmers(sequence, kmer_index, kmer_size, max_hash)
+        passed = shared >= min_shared_kmers
+
+        total_seqs += 1
+        if passed:
+            output_fasta.write(header)
+            output_fasta.writelines(seq_lines)
+        else:
+            removed_seqs += 1
+
+        if verbose:
+            print(f"{seq_id}: {shared} of {sampled} sampled k-mers shared with phage index, passed: {passed}")
+
+        report_lines.append(f"{seq_id}\t{len(sequence)}\t{sampled}\t{shared}\t{passed}\n")
+
+    # summary lines go first so they're easy to find, followed by one line per sequence
+    report.write(f"# Sequences scanned: {total_seqs}\n")
+    report.write(f"# Sequences removed: {removed_seqs}\n")
+    report.write("# Sequence name\tLength\tSampled k-mers\tShared k-mers\tPassed\n")
+    report.writelines(report_lines)
+
+    return total_seqs, removed_seqs
+
+
+def prefilter_genome_from_path(genome_path: str, output_fasta_path: str, report_path: str, kmer_index: Set[int],
+                               kmer_size: int, max_hash: int, min_shared_kmers: int, force: bool,
+                               verbose: bool) -> Tuple[int, int]:
+    overwrite_check(output_fasta_path, force)
+    overwrite_check(report_path, force)
+
+    if verbose:
+        print(f"Opening {genome_path}...")
+
+    with fasta_io.open_fasta(genome_path) as genome_file, open(output_fasta_path, "w") as output_fasta, \
+            open(report_path, "w") as report:
+        return prefilter_genome(genome_file, output_fasta, report, kmer_index, kmer_size, max_hash, min_shared_kmers,
+                                verbose)
+
+
+def read_removed_seqs(report_path: str) -> Set[str]:
+    removed_seqs = set()
+
+    with open(report_path, "r") as report:
+        for line in report:
+            if line[0] == "#":
+                continue
+
+            split_line = line.rstrip("\n").split("\t")
+            if split_line[4] == "False":
+                removed_seqs.add(split_line[0])
+
+    return removed_seqs
+
+
+def count_lost_hits(table_file: TextIO, table_mode: TABLE_MODE, removed_seqs: Set[str],
+                    max_eval: float) -> Tuple[int, int, Set[str], Set[str]]:
+    total_hits = 0
+    lost_hits = 0
+    seqs_with_hits = set()
+    lost_seqs = set()
+
+    for line in table_file:
+        if line[0] == "#":
+            continue
+
+        line_list = line.split()
+        # sequence name and e-value live in different columns for nhmmscan's .dfam and FraHMMER's .tbl tables
+        if table_mode == "dfam":
+            seq_name = line_list[2]
+            evalue = float(line_list[4])
+        else:
+            seq_name = line_list[0]
+            evalue = float(line_list[12])
+
+        if evalue > max_eval:
+            continue
+
+        total_hits += 1
+        seqs_with_hits.add(seq_name)
+        if seq_name in removed_seqs:
+            lost_hits += 1
+            lost_seqs.add(seq_name)
+
+    return total_hits, lost_hits, seqs_with_hits, lost_seqs
+
+
+def validate_prefilter(report_path: str, table_path: str, table_mode: TABLE_MODE, output_path: str, max_eval: float,
+                       force: bool, verbose: bool) -> None:
+    overwrite_check(output_path, force)
+    removed_seqs = read_removed_seqs(report_path)
+
+    if verbose:
+        print(f"Opening {table_path}...")
+
+    with open(table_path, "r") as table_file:
+        total_hits, lost_hits, seqs_with_hits, lost_seqs = count_lost_hits(table_file, table_mode, removed_seqs,
+                                                                           max_eval)
+
+    # sensitivity is the fraction of hits from the full scan that would have survived the prefilter
+    sensitivity = 1.0
+    if total_hits > 0:
+        sensitivity = (total_hits - lost_hits) / total_hits
+
+    headers = ["Report", "Sequences removed", "Hits in full scan", "Hits lost", "Sequences with hits",
+               "Sequences with hits removed", "Sensitivity", "Lost sequences\n"]
+    with open(output_path, "w") as output_file:
+        output_file.write("# ")
+        output_file.write("\t".join(headers))
+        output_file.write(f"{path.basename(report_path)}\t{len(removed_seqs)}\t{total_hits}\t{lost_hits}\t"
+                          f"{len(seqs_with_hits)}\t{len(lost_seqs)}\t{sensitivity}\t"
+                          f"{','.join(sorted(lost_seqs)) or '-'}\n")
+
+    if verbose:
+        print(f"{lost_hits} of {total_hits} hits lost to prefilter (sensitivity {sensitivity})")
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Sketch-based k-mer prefilter that removes genome sequences "
+                                                           "sharing too few k-mers with a phage database before they "
+                                                           "are scanned with nhmmscan")
+    subparsers = parser.add_subparsers(dest="prefilter_mode",
+                                       help="build creates a k-mer sketch index from a phage .fasta, filter streams a "
+                                            "genome against that index, and validate measures how many hits from a "
+                                            "full scan the filter would have removed")
+
+    build_parser = subparsers.add_parser("build", help="Build a k-mer sketch index from a phage database .fasta")
+    build_parser.add_argument("phage_fasta", type=str, help="Path to .fasta file containing phage genomes")
+    build_parser.add_argument("output_index", type=str, help="Path to output k-mer sketch index")
+    build_parser.add_argument("--kmer_size", type=int, default=DEFAULT_KMER_SIZE,
+                              help=f"Length of k-mers to index (default {DEFAULT_KMER_SIZE})")
+    build_parser.add_argument("--sketch_scale", type=int, default=DEFAULT_SKETCH_SCALE,
+                              help=f"Keep roughly 1 in sketch_scale k-mers in the index. Larger values produce a "
+                                   f"smaller, faster index at some cost to sensitivity (default "
+                                   f"{DEFAULT_SKETCH_SCALE})")
+
+    filter_parser = subparsers.add_parser("filter", help="Write genome sequences that share enough k-mers with the "
+                                                         "phage index to a new .fasta, and report on every sequence")
+    filter_parser.add_argument("kmer_index", type=str, help="Path to k-mer sketch index produced by build mode")
+    filter_parser.add_argument("genome_fasta", type=str, help="Path to bacterial genome in .fasta format")
+    filter_parser.add_argument("output_fasta", type=str, help="Path to output .fasta containing sequences that passed "
+                                                              "the prefilter")
+    filter_parser.add_argument("output_report", type=str, help="Path to output .tsv reporting sampled and shared "
+                                                               "k-mer counts for every sequence")
+    filter_parser.add_argument("--min_shared_kmers", type=int, default=DEFAULT_MIN_SHARED_KMERS,
+                               help=f"Minimum number of sampled k-mers a sequence must share with the phage index to "
+                                    f"be passed on for scanning (default {DEFAULT_MIN_SHARED_KMERS})")
+
+    validate_parser = subparsers.add_parser("validate", help="Compare a prefilter report against the table from a full "
+                                                             "scan to measure sensitivity loss")
+    validate_parser.add_argument("report", type=str, help="Path to .tsv report produced by filter mode")
+    validate_parser.add_argument("table_path", type=str, help="Path to .dfam or .tbl table from an unfiltered scan of "
+                                                              "the same genome")
+    validate_parser.add_argument("table_type", type=str, choices=["dfam", "tbl"],
+                                 help="Which type of table is being supplied as input, which must be dfam or tbl.")
+    validate_parser.add_argument("output_tsv", type=str, help="Path to output validation summary .tsv")
+    validate_parser.add_argument("--max_evalue", type=float, default=DEFAULT_EVAL,
+                                 help=f"Hits with e-values above this are ignored, matching table_parser.py's default "
+                                      f"filtering (default {DEFAULT_EVAL})")
+
+    # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers
+    for name, subp in subparsers.choices.items():
+        subp.add_argument("--verbose", action="store_true", help="Print additional information useful for debugging")
+        subp.add_argument("--force", action="store_true", help="If output files already exist, overwrite them")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__, args.prefilter_mode)
+    prefilter_mode = args.prefilter_mode
+    verbose = args.verbose
+    force = args.force
+
+    if prefilter_mode == "build":
+        kmer_size = args.kmer_size
+        sketch_scale = args.sketch_scale
+
+        if kmer_size < 1 or sketch_scale < 1:
+            raise ValueError("--kmer_size and --sketch_scale must be used with arguments greater than 0")
+
+        with fasta_io.open_fasta(args.phage_fasta) as phage_file:
+            kmer_index = build_phage_index(phage_file, kmer_size, get_max_hash(sketch_scale), verbose)
+
+        write_index(args.output_index, kmer_index, kmer_size, sketch_scale, force)
+
+    elif prefilter_mode == "filter":
+        kmer_index, kmer_size, sketch_scale = read_index(args.kmer_index, verbose)
+        total_seqs, removed_seqs = prefilter_genome_from_path(args.genome_fasta, args.output_fasta,
+                                                              args.output_report, kmer_index, kmer_size,
+                                                              get_max_hash(sketch_scale), args.min_shared_kmers,
+                                                              force, verbose)
+
+        print(f"{removed_seqs} of {total_seqs} sequences in {args.genome_fasta} removed by k-mer prefilter")
+
+    elif prefilter_mode == "validate":
+        validate_prefilter(args.report, args.table_path, args.table_type, args.output_tsv, args.max_evalue, force,
+                           verbose)
+
+
+if __name__ == "__main__":
+    _main()
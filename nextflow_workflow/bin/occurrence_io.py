@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import sys
+from os import path
+from typing import TextIO
+from typing import *
+
+# Shared reader and writer for nucleotide occurrence counts, i.e. how many times each position of a reference virus
+# was detected in bacterial genomes. Counts are stored as runs of (start, end, count), where start and end are 0-based
+# and end is exclusive, and positions not covered by any run have a count of 0. Most of a virus is covered by a handful
+# of long runs, so this is far smaller than one integer per position.
+#
+# Compact .json files look like:
+#   {"format": "vibes_occurrence_runs", "version": 1,
+#    "viruses": {"virus_name": {"length": 40000, "runs": [[0, 1500, 2], [1500, 40000, 1]]}}}
+# .npz files hold the same runs as flat arrays (numpy is only imported when one is read or written). Dense .json files,
+# mapping each virus name to a list with one count per position, can still be read and written for compatibility.
+
+OCCURRENCE_FORMAT = "vibes_occurrence_runs"
+OCCURRENCE_VERSION = 1
+INDENT_VAL = 4
+
+Run = Tuple[int, int, int]
+# maps virus name to (virus length, runs)
+OccurrenceDict = Dict[str, Tuple[int, List[Run]]]
+
+
+def overwrite_check(file_path: str, force: bool) -> None:
+    if path.isfile(file_path) and not force:
+        raise FileExistsError(
+            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+
+
+def events_to_runs(events: Dict[int, int]) -> List[Run]:
+    # events maps a position to the change in count at that position. Walking the positions in order and keeping a
+    # running count gives a run between each pair of neighbouring positions
+    runs = []
+    count = 0
+    prev_position = None
+
+    for position in sorted(events.keys()):
+        if count and prev_position is not None and position > prev_position:
+            # merge with the previous run if they touch and have the same count
+            if runs and runs[-1][1] == prev_position and runs[-1][2] == count:
+                runs[-1] = (runs[-1][0], position, count)
+            else:
+                runs.append((prev_position, position, count))
+
+        count += events[position]
+        prev_position = position
+
+    return runs
+
+
+def intervals_to_runs(intervals: Iterable[Tuple[int, int]]) -> List[Run]:
+    # intervals are 0-based and end-exclusive. Coverage is built from the interval ends, so the work done depends on
+    # the number of intervals rather than on their length
+    events = {}
+
+    for start, end in intervals:
+        if end <= start:
+            continue
+
+        events[start] = events.get(start, 0) + 1
+        events[end] = events.get(end, 0) - 1
+
+    return events_to_runs(events)
+
+
+def runs_to_dense(runs: List[Run], length: int) -> List[int]:
+    counts = [0] * length
+
+    for start, end, count in runs:
+        counts[start:end] = [count] * (end - start)
+
+    return counts
+
+
+def dense_to_runs(counts: Sequence[int]) -> List[Run]:
+    runs = []
+    run_start = 0
+
+    for index in range(1, len(counts) + 1):
+        if index == len(counts) or counts[index] != counts[run_start]:
+            if counts[run_start]:
+                runs.append((run_start, index, int(counts[run_start])))
+            run_start = index
+
+    return runs
+
+
+def runs_to_array(runs: List[Run], length: int) -> "numpy.ndarray":
+    import numpy as np
+
+    # add each run's count at its start and subtract it at its end, then take the running sum
+    diff = np.zeros(length + 1, dtype=np.int64)
+    if runs:
+        run_array = np.array(runs, dtype=np.int64)
+        np.add.at(diff, run_array[:, 0], run_array[:, 2])
+        np.add.at(diff, run_array[:, 1], -run_array[:, 2])
+
+    return np.cumsum(diff[:-1])
+
+
+def array_to_runs(counts: "numpy.ndarray") -> List[Run]:
+    import numpy as np
+
+    if len(counts) == 0:
+        return []
+
+    # positions where the count changes start a new run
+    starts = np.concatenate(([0], np.flatnonzero(counts[1:] != counts[:-1]) + 1))
+    ends = np.append(starts[1:], len(counts))
+    run_counts = counts[starts]
+    nonzero = run_counts != 0
+
+    return list(zip(starts[nonzero].tolist(), ends[nonzero].tolist(), run_counts[nonzero].tolist()))
+
+
+def read_occurrence_json(json_file: TextIO) -> OccurrenceDict:
+    json_dict = json.load(json_file)
+
+    if json_dict.get("format") == OCCURRENCE_FORMAT:
+        return {vir_name: (virus["length"], [tuple(run) for run in virus["runs"]])
+                for vir_name, virus in json_dict["viruses"].items()}
+
+    # older dense files map each virus to a list with one count per position
+    return {vir_name: (len(counts), dense_to_runs(counts)) for vir_name, counts in json_dict.items()}
+
+
+def read_occurrence_npz(npz_path: str) -> OccurrenceDict:
+    import numpy as np
+
+    occurrence_dict = {}
+
+    with np.load(npz_path) as npz_file:
+        if "format" not in npz_file.files:
+            # dense arrays keyed on virus name
+            for vir_name in npz_file.files:
+                counts = npz_file[vir_name]
+                occurrence_dict[vir_name] = (len(counts), array_to_runs(counts))
+            return occurrence_dict
+
+        names = npz_file["names"].tolist()
+        lengths = npz_file["lengths"].tolist()
+        run_offsets = npz_file["run_offsets"].tolist()
+        starts = npz_file["starts"].tolist()
+        ends = npz_file["ends"].tolist()
+        counts = npz_file["counts"].tolist()
+
+    # runs for virus i are at run_offsets[i]:run_offsets[i + 1] in the flat arrays
+    for index, vir_name in enumerate(names):
+        run_slice = slice(run_offsets[index], run_offsets[index + 1])
+        occurrence_dict[vir_name] = (lengths[index], list(zip(starts[run_slice], ends[run_slice], counts[run_slice])))
+
+    return occurrence_dict
+
+
+def read_occurrences(input_path: str, verbose: bool) -> OccurrenceDict:
+    if verbose:
+        print(f"Reading occurrence counts from {input_path}...", file=sys.stderr)
+
+    if input_path.endswith(".npz"):
+        return read_occurrence_npz(input_path)
+
+    with open(input_path, "r") as json_file:
+        return read_occurrence_json(json_file)
+
+
+def write_occurrence_json(json_file: TextIO, occurrence_dict: OccurrenceDict, dense: bool = False) -> None:
+    if dense:
+        json_dict = {vir_name: runs_to_dense(runs, length) for vir_name, (length, runs) in occurrence_dict.items()}
+        json_file.write(json.dumps(json_dict, indent=INDENT_VAL))
+        return
+
+    json_dict = {"format": OCCURRENCE_FORMAT,
+                 "version": OCCURRENCE_VERSION,
+                 "viruses": {vir_name: {"length": length, "runs": [list(run) for run in runs]}
+                             for vir_name, (length, runs) in occurrence_dict.items()}}
+
+    # no indentation or spaces- these files are read by scripts, not people
+    json_file.write(json.dumps(json_dict, separators=(",", ":")))
+
+
+def write_occurrence_npz(npz_path: str, occurrence_dict: OccurrenceDict) -> None:
+    import numpy as np
+
+    names = list(occurrence_dict.keys())
+    run_offsets = [0]
+    starts = []
+    ends = []
+    counts = []
+
+    for vir_name in names:
+        for start, end, count in occurrence_dict[vir_name][1]:
+            starts.append(start)
+            ends.append(end)
+            counts.append(count)
+        run_offsets.append(len(starts))
+
+    # np.savez_compressed() would append .npz to a path that doesn't end with it, so write through a file object
+    with open(npz_path, "wb") as npz_file:
+        np.savez_compressed(npz_file,
+                            format=np.array(OCCURRENCE_FORMAT),
+                            names=np.array(names, dtype=str),
+                            lengths=np.array([occurrence_dict[vir_name][0] for vir_name in names], dtype=np.int64),
+                            run_offsets=np.array(run_offsets, dtype=np.int64),
+                            starts=np.array(starts, dtype=np.int64),
+                            ends=np.array(ends, dtype=np.int64),
+                            counts=np.array(counts, dtype=np.int64))
+
+
+def write_occurrences(output_path: str, occurrence_dict: OccurrenceDict, force: bool, dense: bool = False) -> None:
+    overwrite_check(output_path, force)
+
+    if output_path.endswith(".npz"):
+        write_occurrence_npz(output_path, occurrence_dict)
+        return
+
+    with open(output_path, "w") as json_file:
+        write_occurrence_json(json_file, occurrence_dict, dense)
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Converts VIBES occurrence count files between the compact "
+                                                           ".json, binary .npz and dense .json formats")
+    parser.add_argument("input_path", type=str, help="Path to input occurrence count file")
+    parser.add_argument("output_path", type=str, help="Path to output occurrence count file. Written as binary if the "
+                                                      "path ends in .npz, compact .json otherwise")
+    parser.add_argument("--dense", action="store_true",
+                        help="Write .json output with one count per position of each virus, as older versions of "
+                             "VIBES did")
+    parser.add_argument("--verbose", action="store_true", help="Print additional information useful for debugging")
+    parser.add_argument("--force", action="store_true", help="If output file already exists, overwrite it")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+
+    write_occurrences(args.output_path, read_occurrences(args.input_path, args.verbose), args.force, args.dense)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import sys
+from os import path
+from typing import *
+
+import numpy as np
+
+import occurrence_io
+import perf_timer
+
+# A persistent store of phage occurrence coverage and integration counts summed over a cohort of bacterial genomes,
+# built up across runs. Each phage's coverage is a memory-mapped .npy array with one count per position, and a small
+# index.json holds each phage's length, array file and integration totals. Each genome's contribution (its coverage
+# runs and integration counts per phage) is kept in its own file under genomes/, so adding a genome again replaces its
+# old contribution and removing a genome subtracts it, without rescanning any other genome's integration .tsv.
+#
+# Queries only read index.json and the memory-mapped arrays they need. Only one process should add to or remove from a
+# store at a time- a lock file makes concurrent writers wait their turn.
+#
+# Stored files are never changed in place. Each add or remove is one generation: it writes a new copy of each coverage
+# array it changes and a new contribution file for each genome it adds, named after the generation, and then saves
+# index.json to point at them. Saving the index commits the whole add or remove, so a writer killed partway through
+# leaves the store as it was. The files it had written aren't referenced by the index, and the next add or remove
+# deletes them.
+
+INDEX_FILE = "index.json"
+LOCK_FILE = "store.lock"
+COVERAGE_DIR = "coverage"
+GENOME_DIR = "genomes"
+STORE_VERSION = 2
+COVERAGE_DTYPE = np.int64
+DEFAULT_TOP_COUNT = 10
+
+# maps phage name to (phage length, coverage runs, integration count)
+Contribution = Dict[str, Tuple[int, List[occurrence_io.Run], int]]
+
+
+def load_index(store_dir: str) -> Dict[str, Any]:
+    index_path = path.join(store_dir, INDEX_FILE)
+
+    if not path.isfile(index_path):
+        return {"version": STORE_VERSION, "generation": 0, "genomes": {}, "viruses": {}}
+
+    with open(index_path, "r") as index_file:
+        index = json.load(index_file)
+
+    # version 1 stores listed genome names only, and named each genome's contribution file after the hash of its name
+    if index["version"] < 2:
+        index["genomes"] = {genome_name: get_genome_file(genome_name, 0) for genome_name in index["genomes"]}
+        index["generation"] = 0
+        index["version"] = STORE_VERSION
+
+    return index
+
+
+def save_index(store_dir: str, index: Dict[str, Any]) -> None:
+    # write to a temporary file and move it into place, so readers never see a partially written index
+    index_path = path.join(store_dir, INDEX_FILE)
+    temp_path = f"{index_path}.tmp"
+
+    with open(temp_path, "w") as index_file:
+        json.dump(index, index_file, separators=(",", ":"))
+
+    os.replace(temp_path, index_path)
+
+
+def get_genome_file(genome_name: str, generation: int) -> str:
+    # genome names can contain characters that don't belong in file names. Generation 0 is the name version 1 stores
+    # used
+    name_hash = hashlib.sha256(genome_name.encode("utf-8")).hexdigest()
+    file_name = f"{name_hash}.json" if generation == 0 else f"{name_hash}.{generation}.json"
+
+    return path.join(GENOME_DIR, file_name)
+
+
+def get_coverage_file(virus_number: int, generation: int) -> str:
+    return path.join(COVERAGE_DIR, f"{virus_number}.{generation}.npy")
+
+
+def read_contribution(store_dir: str, genome_file: str) -> Contribution:
+    with open(path.join(store_dir, genome_file), "r") as genome_json_file:
+        genome_json = json.load(genome_json_file)
+
+    return {vir_name: (virus["length"], [tuple(run) for run in virus["runs"]], virus["integrations"])
+            for vir_name, virus in genome_json["viruses"].items()}
+
+
+def write_contribution(store_dir: str, genome_file: str, genome_name: str, contribution: Contribution) -> None:
+    genome_json = {"genome": genome_name,
+                   "viruses": {vir_name: {"length": length, "runs": [list(run) for run in runs],
+                                          "integrations": integration_count}
+                               for vir_name, (length, runs, integration_count) in contribution.items()}}
+
+    with open(path.join(store_dir, genome_file), "w") as genome_json_file:
+        json.dump(genome_json, genome_json_file, separators=(",", ":"))
+
+
+def parse_integration_tsv(tsv_path: str) -> Contribution:
+    intervals_dict = {}
+    length_dict = {}
+    integration_dict = {}
+
+    with open(tsv_path, "r") as tsv:
+        for line in tsv:
+            if line[0] == "#":
+                continue
+
+            # columns are written by table_parser.py's write_integration_tsv()
+            line_list = line.rstrip("\n").split("\t")
+            vir_name = line_list[0]
+            query_st = int(line_list[5])
+            query_end = int(line_list[6])
+
+            # positions are 1-indexed and inclusive, runs are 0-indexed and exclude their end
+            intervals_dict.setdefault(vir_name, []).append((min(query_st, query_end) - 1, max(query_st, query_end)))
+            length_dict[vir_name] = int(line_list[7])
+
+            # hits from an integration broken up over multiple hits share an integration ID, so count IDs rather than
+            # hits. Hits without an ID are counted individually
+            integration_id = line_list[14] if len(line_list) > 14 and line_list[14] else line
+            integration_dict.setdefault(vir_name, set()).add(integration_id)
+
+    return {vir_name: (length_dict[vir_name], occurrence_io.intervals_to_runs(intervals),
+                       len(integration_dict[vir_name]))
+            for vir_name, intervals in intervals_dict.items()}
+
+
+def apply_changes(store_dir: str, index: Dict[str, Any], changes: List[Tuple[Contribution, int]],
+                  generation: int) -> List[str]:
+    # each change is a genome's contribution and a sign, 1 to add it or -1 to subtract it. Changes are summed per phage
+    # first, so each changed array is written once, to a new memory-mapped array that index is pointed at. The arrays
+    # the saved index refers to are left untouched. Returns the files the new arrays replace
+    viruses = index["viruses"]
+    virus_runs = {}
+
+    for contribution, sign in changes:
+        for vir_name, (length, runs, integration_count) in contribution.items():
+            if vir_name not in viruses:
+                viruses[vir_name] = {"file": "", "number": len(viruses), "length": length, "integrations": 0,
+                                     "genomes": 0}
+
+            virus = viruses[vir_name]
+            # a phage can be longer than when the store was created (e.g. its reference was updated), so grow its array
+            virus["length"] = max(virus["length"], length)
+            virus["integrations"] += sign * integration_count
+            virus["genomes"] += sign
+            virus_runs.setdefault(vir_name, []).extend((start, end, sign * count) for start, end, count in runs)
+
+    replaced_files = []
+
+    for vir_name, runs in virus_runs.items():
+        virus = viruses[vir_name]
+        old_file = virus["file"]
+
+        # version 1 stores named arrays by number only
+        if "number" not in virus:
+            virus["number"] = int(path.basename(old_file).split(".")[0])
+
+        virus["file"] = get_coverage_file(virus["number"], generation)
+        # a new array file starts out filled with zeros
+        coverage = np.lib.format.open_memmap(path.join(store_dir, virus["file"]), mode="w+", dtype=COVERAGE_DTYPE,
+                                             shape=(virus["length"],))
+
+        if old_file:
+            old_coverage = np.load(path.join(store_dir, old_file), mmap_mode="r")
+            coverage[:len(old_coverage)] = old_coverage
+            del old_coverage
+            replaced_files.append(old_file)
+
+        for start, end, count in runs:
+            coverage[start:end] += count
+
+        coverage.flush()
+        del coverage
+
+    return replaced_files
+
+
+def update_genomes(store_dir: str, index: Dict[str, Any], updates: List[Tuple[str, Optional[Contribution]]]) -> None:
+    # each update replaces a genome's stored contribution with a new one, or removes the genome if it's None. All of
+    # them are applied as one generation- nothing the saved index refers to is changed until the updated index is
+    # saved, which commits every update at once
+    if not updates:
+        return
+
+    new_index = copy.deepcopy(index)
+    generation = new_index["generation"] + 1
+    new_index["generation"] = generation
+    genomes = new_index["genomes"]
+
+    changes = []
+    replaced_files = []
+    # the latest contribution given for each genome, in case a genome is updated more than once
+    new_contributions = {}
+
+    for genome_name, contribution in updates:
+        if genome_name in new_contributions:
+            if new_contributions[genome_name] is not None:
+                changes.append((new_contributions[genome_name], -1))
+        elif genome_name in genomes:
+            changes.append((read_contribution(store_dir, genomes[genome_name]), -1))
+            replaced_files.append(genomes[genome_name])
+
+        if contribution is not None:
+            changes.append((contribution, 1))
+
+        new_contributions[genome_name] = contribution
+
+    for genome_name, contribution in new_contributions.items():
+        if contribution is None:
+            genomes.pop(genome_name, None)
+        else:
+            genomes[genome_name] = get_genome_file(genome_name, generation)
+            write_contribution(store_dir, genomes[genome_name], genome_name, contribution)
+
+    replaced_files.extend(apply_changes(store_dir, new_index, changes, generation))
+    save_index(store_dir, new_index)
+
+    # the updates are committed, so files only the old index referred to can go
+    for replaced_file in replaced_files:
+        os.remove(path.join(store_dir, replaced_file))
+
+
+def remove_unreferenced_files(store_dir: str, index: Dict[str, Any], verbose: bool) -> None:
+    # files written by an update that was killed before its index was saved
+    referenced_files = set(index["genomes"].values()) | {virus["file"] for virus in index["viruses"].values()}
+
+    for file_dir in [COVERAGE_DIR, GENOME_DIR]:
+        for file_name in os.listdir(path.join(store_dir, file_dir)):
+            store_file = path.join(file_dir, file_name)
+
+            if store_file not in referenced_files:
+                if verbose:
+                    print(f"Removing {store_file}, left by an unfinished update", file=sys.stderr)
+                os.remove(path.join(store_dir, store_file))
+
+
+def add_genomes(store_dir: str, tsv_paths: List[str], verbose: bool) -> None:
+    index = load_index(store_dir)
+    remove_unreferenced_files(store_dir, index, verbose)
+    updates = []
+
+    for tsv_path in tsv_paths:
+        # genomes are named after their integration .tsv, just like in the rest of the output
+        genome_name = path.basename(tsv_path).split(".")[0]
+        contribution = parse_integration_tsv(tsv_path)
+        updates.append((genome_name, contribution))
+
+        # adding a genome that's already in the store replaces its old contribution
+        if verbose:
+            action = "Replacing" if genome_name in index["genomes"] else "Adding"
+            print(f"{action} {genome_name}, with integrations of {len(contribution)} phages", file=sys.stderr)
+
+    update_genomes(store_dir, index, updates)
+
+
+def remove_genomes(store_dir: str, genome_names: List[str], verbose: bool) -> None:
+    index = load_index(store_dir)
+    remove_unreferenced_files(store_dir, index, verbose)
+    updates = []
+
+    for genome_name in genome_names:
+        if genome_name not in index["genomes"]:
+            print(f"{genome_name} is not in the store, skipping", file=sys.stderr)
+            continue
+
+        updates.append((genome_name, None))
+
+        if verbose:
+            print(f"Removing {genome_name}", file=sys.stderr)
+
+    update_genomes(store_dir, index, updates)
+
+
+def query_coverage(store_dir: str, vir_name: str, start: int, end: int, per_position: bool,
+                   output_file: TextIO) -> None:
+    index = load_index(store_dir)
+
+    if vir_name not in index["viruses"]:
+        raise KeyError(f"{vir_name} is not in the store")
+
+    virus = index["viruses"][vir_name]
+    coverage = np.load(path.join(store_dir, virus["file"]), mmap_mode="r")
+
+    # start and end are 1-indexed and inclusive, like positions in the rest of VIBES' output
+    end = virus["length"] if end <= 0 else min(end, virus["length"])
+    if start < 1 or start > end:
+        raise ValueError(f"Region {start}-{end} is not on {vir_name}, which is {virus['length']} positions long")
+
+    region = coverage[start - 1:end]
+
+    if per_position:
+        output_file.write("# Position\tOccurrences\n")
+        for position, count in enumerate(region.tolist(), start):
+            output_file.write(f"{position}\t{count}\n")
+        return
+
+    output_file.write("# Phage\tStart\tEnd\tMean occurrences\tMin occurrences\tMax occurrences\tPositions detected\n")
+    output_file.write(f"{vir_name}\t{start}\t{end}\t{region.mean():.4f}\t{region.min()}\t{region.max()}\t"
+                      f"{np.count_nonzero(region)}\n")
+
+
+def query_top(store_dir: str, top_count: int, output_file: TextIO) -> None:
+    index = load_index(store_dir)
+    viruses = sorted(index["viruses"].items(), key=lambda item: (-item[1]["integrations"], item[0]))
+
+    output_file.write("# Phage\tIntegrations\tGenomes with integrations\tLength\n")
+    for vir_name, virus in viruses[:top_count]:
+        if virus["integrations"] <= 0:
+            break
+        output_file.write(f"{vir_name}\t{virus['integrations']}\t{virus['genomes']}\t{virus['length']}\n")
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Persistent store of phage occurrence coverage and "
+                                                           "integration counts summed over a cohort of bacterial "
+                                                           "genomes, updated incrementally")
+    subparsers = parser.add_subparsers(dest="store_mode",
+                                       help="add folds genomes' integration .tsv files into the store, remove "
+                                            "subtracts genomes from it, coverage reports occurrences over a region "
+                                            "of a phage and top lists phages by integration count")
+
+    add_parser = subparsers.add_parser("add", help="Add genomes to the store. A genome already in the store has its "
+                                                   "old contribution replaced")
+    remove_parser = subparsers.add_parser("remove", help="Subtract genomes' contributions from the store")
+    coverage_parser = subparsers.add_parser("coverage", help="Report occurrences over a region of a phage")
+    top_parser = subparsers.add_parser("top", help="List phages with the most integrations")
+
+    # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers. The store
+    # directory is set here, before mode-specific arguments, so it's always the first positional argument
+    for name, subp in subparsers.choices.items():
+        subp.add_argument("store_dir", type=str, help="Path to store directory. Created by add mode if it doesn't "
+                                                      "exist")
+        subp.add_argument("--verbose", action="store_true",
+                          help="Print additional information useful for debugging to stderr")
+
+    add_parser.add_argument("tsv_paths", type=str, nargs="+",
+                            help="Paths to integration .tsv files written by table_parser.py. Each genome is named "
+                                 "after its .tsv file")
+
+    remove_parser.add_argument("genome_names", type=str, nargs="+", help="Names of genomes to remove")
+
+    coverage_parser.add_argument("virus_name", type=str, help="Name of phage to query")
+    coverage_parser.add_argument("--start", type=int, default=1, help="First position of region (default 1)")
+    coverage_parser.add_argument("--end", type=int, default=0,
+                                 help="Last position of region. Defaults to the end of the phage")
+    coverage_parser.add_argument("--per_position", action="store_true",
+                                 help="Print the occurrence count at each position instead of a summary")
+
+    top_parser.add_argument("--count", type=int, default=DEFAULT_TOP_COUNT,
+                            help=f"Number of phages to list (default {DEFAULT_TOP_COUNT})")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__, args.store_mode)
+    store_mode = args.store_mode
+    store_dir = args.store_dir
+    verbose = args.verbose
+
+    if store_mode in ("add", "remove"):
+        os.makedirs(path.join(store_dir, COVERAGE_DIR), exist_ok=True)
+        os.makedirs(path.join(store_dir, GENOME_DIR), exist_ok=True)
+
+        # hold the lock until the index is saved, so concurrent writers can't lose each other's updates
+        with open(path.join(store_dir, LOCK_FILE), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if store_mode == "add":
+                add_genomes(store_dir, args.tsv_paths, verbose)
+            else:
+                remove_genomes(store_dir, args.genome_names, verbose)
+
+    elif store_mode == "coverage":
+        query_coverage(store_dir, args.virus_name, args.start, args.end, args.per_position, sys.stdout)
+
+    elif store_mode == "top":
+        query_top(store_dir, args.count, sys.stdout)
+
+
+if __name__ == "__main__":
+    _main()
@@ -4,6 +4,8 @@ import glob
 import json
 import os
 
+import occurrence_io
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -44,6 +46,26 @@ def parse_args():
         default="./viz",
     )
 
+    parser.add_argument(
+        "-s",
+        type=str,
+        help="Optional summed occurrence counts (e.g. from sum_occurrences.py) to "
+        "plot instead of counting occurrences from the integration .tsv files",
+        metavar="<occurrences.json>",
+        dest="occurrence_input",
+        default="",
+    )
+
+    parser.add_argument(
+        "-c",
+        type=str,
+        help="Optional path to write the occurrence counts for every virus to, in "
+        "the compact occurrence format (binary if the path ends in .npz)",
+        metavar="<occurrences.json>",
+        dest="occurrence_output",
+        default="",
+    )
+
     args = parser.parse_args()
 
     return args
@@ -226,10 +248,12 @@ class Sequence:
 class Occurrence:
     def __init__(self, integrations: [Integration]):
         self.name = integrations[0].query_name
-        self.counts = [0 for _ in range(integrations[0].query_length)]
-        for integration in integrations:
-            for i in range(integration.query_start, integration.query_end):
-                self.counts[i] += 1
+        self.length = integrations[0].query_length
+        # counted as runs from the integration ends, rather than position by position
+        self.runs = occurrence_io.intervals_to_runs(
+            [(i.query_start, i.query_end) for i in integrations]
+        )
+        self.counts = occurrence_io.runs_to_dense(self.runs, self.length)
 
 
 def parse_integration_tsv(path: str) -> [Integration]:
@@ -349,6 +373,23 @@ def parse_records(args):
 
         all_occurrences.append(Occurrence(filtered))
 
+    # precomputed counts replace the ones counted from this run's integrations
+    if args.occurrence_input:
+        summed = occurrence_io.read_occurrences(args.occurrence_input, False)
+        for occurrence in all_occurrences:
+            if occurrence.name in summed:
+                (occurrence.length, occurrence.runs) = summed[occurrence.name]
+                occurrence.counts = occurrence_io.runs_to_dense(
+                    occurrence.runs, occurrence.length
+                )
+
+    if args.occurrence_output:
+        occurrence_io.write_occurrences(
+            args.occurrence_output,
+            {o.name: (o.length, o.runs) for o in all_occurrences},
+            True,
+        )
+
     data_list = []
 
     for bacteria_name in bacteria_names:
@@ -446,4 +487,5 @@ def main():
     write_data(args, data_list)
 
 
-main()
+if __name__ == "__main__":
+    main()
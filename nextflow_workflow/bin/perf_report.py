@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+from os import path
+from typing import TextIO
+from typing import *
+
+import perf_timer
+
+# Summarizes where the time and memory of a VIBES run went. Reads the Nextflow trace file written with performance_dir
+# set (or with -with-trace) and, optionally, the timing records bin/ scripts write through perf_timer.py. Writes per
+# process, per genome and per script summaries sorted by cost, plus a list of processes whose *_memory or *_time settings
+# in advanced_options.config are far above or below what their tasks used.
+
+# A task's cost is the core-hours it held: realtime multiplied by the number of CPUs requested, whether or not they
+# were used
+SUMMARY_COLUMNS = ["Tasks", "Failed", "Retried", "Wall hours", "CPU hours", "Core hours", "CPU efficiency",
+                   "Max peak RSS (GB)", "Queue wait hours", "Max queue wait (minutes)", "Read (GB)", "Written (GB)"]
+SCRIPT_COLUMNS = ["Process", "Script", "Label", "Runs", "Wall hours", "CPU hours", "Max peak RSS (GB)", "Read (GB)",
+                  "Written (GB)", "Share of task wall time"]
+PROVISIONING_COLUMNS = ["Process", "Setting", "Flag", "Tasks", "Requested", "Max used", "Max fraction used",
+                        "Suggested"]
+
+# maps each process to the prefix of its cpus, time and memory settings in advanced_options.config. Processes missing
+# from here have their resources set in workflow.nf
+RESOURCE_SETTINGS = {"hmm_build": "hmmbuild", "incremental_hmm_build": "hmmbuild", "nhmmscan": "nhmmscan",
+                     "incremental_nhmmscan": "nhmmscan", "nhmmscan_fused": "nhmmscan", "bathconvert": "bathconvert",
+                     "bathsearch": "bathsearch", "reformat_integrations": "ri", "reformat_proteins": "rp",
+                     "reformat_protein_batch": "rp", "download_bakta_db": "download_db", "bakta_annotation": "bakta",
+                     "prokka_annotation": "prokka", "prokka_annotation_zip_output": "prokka"}
+
+# exit statuses of tasks killed by the scheduler or container runtime, usually for running out of memory or time
+KILLED_EXIT_STATUSES = {"137", "140", "143"}
+
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+MEMORY_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4, "PB": 1024 ** 5}
+
+GB = 1024 ** 3
+HOUR = 3600
+
+# extra room left above the most any task used when suggesting a setting
+MEMORY_HEADROOM = 1.25
+TIME_HEADROOM = 1.5
+
+DEFAULT_LOW_USAGE = 0.25
+DEFAULT_HIGH_USAGE = 0.9
+DEFAULT_TOP = 10
+
+
+def overwrite_check(file_path: str, force: bool) -> None:
+    if path.isfile(file_path) and not force:
+        raise FileExistsError(
+            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+
+
+def is_missing(value: Optional[str]) -> bool:
+    return value is None or value.strip() in ("", "-")
+
+
+# Nextflow trace values are human readable by default ("1h 2m 3s", "1.2 GB", "95.3%"), or plain milliseconds and bytes
+# when trace.raw is enabled. Both are accepted
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    if is_missing(value):
+        return None
+
+    value = value.strip()
+
+    # raw durations are in milliseconds
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        return float(value) / 1000
+
+    parts = re.findall(r"([\d.]+)\s*(ms|s|m|h|d)", value)
+
+    if not parts:
+        raise ValueError(f"Unrecognized duration in trace file: {value}")
+
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_memory(value: Optional[str]) -> Optional[float]:
+    if is_missing(value):
+        return None
+
+    value = value.strip()
+
+    # raw memory and I/O values are in bytes
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        return float(value)
+
+    match = re.fullmatch(r"([\d.]+)\s*([KMGTP]?B)", value)
+
+    if not match:
+        raise ValueError(f"Unrecognized memory value in trace file: {value}")
+
+    return float(match.group(1)) * MEMORY_UNITS[match.group(2)]
+
+
+def parse_number(value: Optional[str]) -> Optional[float]:
+    if is_missing(value):
+        return None
+
+    return float(value.strip().rstrip("%"))
+
+
+class TraceTask:
+    def __init__(self, row: Dict[str, str]):
+        self.name = row.get("name", "")
+        self.status = row.get("status", "")
+        self.exit_status = row.get("exit", "").strip()
+        self.attempt = int(parse_number(row.get("attempt")) or 1)
+        self.work_dir = row.get("workdir", "").strip()
+
+        # names look like workflow:process (tag). Without a tag field, whatever is in parentheses is used, which is
+        # the task index for processes without a tag directive
+        name_match = re.fullmatch(r"(.*?)(?: \((.*)\))?", self.name)
+        self.process = row.get("process") or name_match.group(1)
+        self.process_name = self.process.split(":")[-1]
+
+        if "tag" in row:
+            self.tag = "" if is_missing(row["tag"]) else row["tag"]
+        else:
+            self.tag = name_match.group(2) or ""
+
+        # duration runs from submission to completion, realtime only covers the task's own execution, so the
+        # difference is time spent waiting in the executor's queue and staging files
+        self.duration = parse_duration(row.get("duration"))
+        self.realtime = parse_duration(row.get("realtime"))
+        self.cpu_percent = parse_number(row.get("%cpu"))
+        self.cpus = parse_number(row.get("cpus"))
+        self.peak_rss = parse_memory(row.get("peak_rss"))
+        self.memory = parse_memory(row.get("memory"))
+        self.time = parse_duration(row.get("time"))
+        self.rchar = parse_memory(row.get("rchar"))
+        self.wchar = parse_memory(row.get("wchar"))
+
+        self.queue_wait = None
+
+        if self.duration is not None and self.realtime is not None:
+            self.queue_wait = max(self.duration - self.realtime, 0)
+
+    def is_failed(self) -> bool:
+        return self.status in ("FAILED", "ABORTED")
+
+    def is_killed(self) -> bool:
+        return self.exit_status in KILLED_EXIT_STATUSES
+
+    def get_usage(self, resource_type: str) -> Optional[Tuple[float, float]]:
+        # the amount of memory or time used, and the amount requested
+        if resource_type == "memory":
+            used, requested = self.peak_rss, self.memory
+        else:
+            used, requested = self.realtime, self.time
+
+        if used is None or not requested:
+            return None
+
+        return used, requested
+
+    def get_limiting_resource(self) -> Optional[str]:
+        fractions = {resource_type: usage[0] / usage[1] for resource_type, usage
+                     in [("memory", self.get_usage("memory")), ("time", self.get_usage("time"))] if usage}
+
+        return max(fractions, key=fractions.get) if fractions else None
+
+    def get_cpu_seconds(self) -> float:
+        if self.realtime is None or self.cpu_percent is None:
+            return 0
+
+        return self.realtime * self.cpu_percent / 100
+
+    def get_core_seconds(self) -> float:
+        return (self.realtime or 0) * (self.cpus or 1)
+
+
+class UsageSummary:
+    def __init__(self):
+        self.tasks = 0
+        self.failed = 0
+        self.retried = 0
+        self.realtime = 0
+        self.cpu_seconds = 0
+        self.core_seconds = 0
+        self.peak_rss = 0
+        self.queue_wait = 0
+        self.max_queue_wait = 0
+        self.rchar = 0
+        self.wchar = 0
+
+    def add(self, task: TraceTask) -> None:
+        self.tasks += 1
+        self.failed += task.is_failed()
+        self.retried += task.attempt > 1
+        self.realtime += task.realtime or 0
+        self.cpu_seconds += task.get_cpu_seconds()
+        self.core_seconds += task.get_core_seconds()
+        self.peak_rss = max(self.peak_rss, task.peak_rss or 0)
+        self.queue_wait += task.queue_wait or 0
+        self.max_queue_wait = max(self.max_queue_wait, task.queue_wait or 0)
+        self.rchar += task.rchar or 0
+        self.wchar += task.wchar or 0
+
+    def get_row(self) -> List[str]:
+        efficiency = self.cpu_seconds / self.core_seconds if self.core_seconds else 0
+
+        return [str(self.tasks), str(self.failed), str(self.retried), f"{self.realtime / HOUR:.3f}",
+                f"{self.cpu_seconds / HOUR:.3f}", f"{self.core_seconds / HOUR:.3f}", f"{efficiency:.2f}",
+                f"{self.peak_rss / GB:.3f}", f"{self.queue_wait / HOUR:.3f}", f"{self.max_queue_wait / 60:.1f}",
+                f"{self.rchar / GB:.3f}", f"{self.wchar / GB:.3f}"]
+
+
+class ScriptSummary:
+    def __init__(self):
+        self.runs = 0
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+        self.peak_rss = 0
+        self.rchar = 0
+        self.wchar = 0
+        # realtime of the trace tasks the script ran in, each counted once, to measure what share of those tasks the
+        # script accounts for
+        self.task_realtimes = {}
+
+    def add(self, record: Dict[str, Any], task: Optional[TraceTask]) -> None:
+        self.runs += 1
+        self.wall_seconds += record.get("wall_seconds", 0)
+        self.cpu_seconds += sum(record.get(field, 0) for field in ["user_seconds", "system_seconds",
+                                                                   "child_user_seconds", "child_system_seconds"])
+        self.peak_rss = max(self.peak_rss, record.get("peak_rss_bytes", 0), record.get("child_peak_rss_bytes", 0))
+        self.rchar += record.get("rchar", 0)
+        self.wchar += record.get("wchar", 0)
+
+        if task is not None and task.realtime:
+            self.task_realtimes[task.work_dir] = task.realtime
+
+    def get_row(self) -> List[str]:
+        task_realtime = sum(self.task_realtimes.values())
+        share = f"{min(self.wall_seconds / task_realtime, 1):.2f}" if task_realtime else "-"
+
+        return [str(self.runs), f"{self.wall_seconds / HOUR:.3f}", f"{self.cpu_seconds / HOUR:.3f}",
+                f"{self.peak_rss / GB:.3f}", f"{self.rchar / GB:.3f}", f"{self.wchar / GB:.3f}", share]
+
+
+def read_trace(trace_file: TextIO, verbose: bool) -> List[TraceTask]:
+    tasks = []
+    skipped = 0
+
+    for row in csv.DictReader(trace_file, delimiter="\t"):
+        # cached tasks were run, and paid for, by an earlier run
+        if row.get("status") == "CACHED":
+            skipped += 1
+            continue
+
+        tasks.append(TraceTask(row))
+
+    if verbose:
+        print(f"Read {len(tasks)} tasks from trace file, skipped {skipped} cached tasks", file=sys.stderr)
+
+    return tasks
+
+
+def read_trace_from_path(trace_path: str, verbose: bool) -> List[TraceTask]:
+    with open(trace_path, newline="") as trace_file:
+        return read_trace(trace_file, verbose)
+
+
+def read_timing_records(timing_dir: str, verbose: bool) -> List[Dict[str, Any]]:
+    records = []
+
+    for record_name in sorted(os.listdir(timing_dir)):
+        if not record_name.endswith(perf_timer.TIMING_RECORD_SUFFIX):
+            continue
+
+        with open(path.join(timing_dir, record_name)) as record_file:
+            records.append(json.load(record_file))
+
+    if verbose:
+        print(f"Read {len(records)} timing records from {timing_dir}", file=sys.stderr)
+
+    return records
+
+
+def summarize_tasks(tasks: List[TraceTask], key: Callable[[TraceTask], str]) -> Dict[str, UsageSummary]:
+    summaries = {}
+
+    for task in tasks:
+        summaries.setdefault(key(task), UsageSummary()).add(task)
+
+    return summaries
+
+
+def summarize_scripts(records: List[Dict[str, Any]],
+                      tasks: List[TraceTask]) -> Dict[Tuple[str, str, str], ScriptSummary]:
+    # scripts record the directory they ran in, which is the task's work directory in the trace
+    tasks_by_work_dir = {task.work_dir: task for task in tasks if task.work_dir}
+    summaries = {}
+
+    for record in records:
+        task = tasks_by_work_dir.get(record.get("work_dir", ""))
+        process = task.process if task is not None else "-"
+        key = (process, record.get("script", "-"), record.get("label") or "-")
+        summaries.setdefault(key, ScriptSummary()).add(record, task)
+
+    return summaries
+
+
+def get_setting_name(process_name: str, resource_type: str) -> str:
+    setting_prefix = RESOURCE_SETTINGS.get(process_name)
+
+    if setting_prefix:
+        return f"{setting_prefix}_{resource_type}"
+
+    return f"{process_name} {resource_type} (set in workflow.nf)"
+
+
+def check_resource(process_name: str, tasks: List[TraceTask], resource_type: str, low_usage: float,
+                   high_usage: float) -> Optional[List[str]]:
+    usage = [task.get_usage(resource_type) for task in tasks if task.get_usage(resource_type)]
+
+    if not usage:
+        return None
+
+    max_fraction = max(used / requested for used, requested in usage)
+    max_used = max(used for used, _ in usage)
+    # settings are scaled up for retried tasks, so the smallest request is the setting itself
+    requested = min(requested for _, requested in usage)
+    # a killed task is blamed on whichever resource it had used the larger share of
+    killed = sum(task.is_killed() and task.get_limiting_resource() == resource_type for task in tasks)
+
+    if resource_type == "memory":
+        # advanced_options.config memory settings are in GB
+        suggested = max(math.ceil(max_used * MEMORY_HEADROOM / GB * 10) / 10, 0.1) * GB
+        values = [f"{requested / GB:.2f} GB", f"{max_used / GB:.2f} GB", f"{suggested / GB:.1f} GB"]
+    else:
+        # advanced_options.config time settings are in hours
+        suggested = max(math.ceil(max_used * TIME_HEADROOM / HOUR), 1) * HOUR
+        values = [f"{requested / HOUR:.2f} h", f"{max_used / HOUR:.2f} h", f"{suggested / HOUR:.0f} h"]
+
+    if max_fraction >= high_usage or killed:
+        flag = "under-provisioned"
+    # settings can't usefully go below the suggested minimum, so small requests aren't flagged
+    elif max_fraction <= low_usage and suggested < requested:
+        flag = "over-provisioned"
+    else:
+        return None
+
+    if killed:
+        flag += f" ({killed} tasks killed)"
+
+    return [tasks[0].process, get_setting_name(process_name, resource_type), flag, str(len(usage)), values[0],
+            values[1], f"{max_fraction:.2f}", values[2]]
+
+
+def check_provisioning(tasks: List[TraceTask], low_usage: float, high_usage: float) -> List[List[str]]:
+    tasks_by_process = {}
+
+    for task in tasks:
+        tasks_by_process.setdefault(task.process_name, []).append(task)
+
+    flags = []
+
+    for process_name, process_tasks in sorted(tasks_by_process.items()):
+        for resource_type in ["memory", "time"]:
+            flag = check_resource(process_name, process_tasks, resource_type, low_usage, high_usage)
+
+            if flag:
+                flags.append(flag)
+
+    return flags
+
+
+def write_tsv(output_path: str, columns: List[str], rows: List[List[str]], force: bool) -> None:
+    overwrite_check(output_path, force)
+
+    with open(output_path, "w") as output_file:
+        output_file.write("# " + "\t".join(columns) + "\n")
+
+        for row in rows:
+            output_file.write("\t".join(row) + "\n")
+
+
+def sort_by_cost(summaries: Dict[Any, Any], cost: Callable[[Any], float]) -> List[Tuple[Any, Any]]:
+    return sorted(summaries.items(), key=lambda item: cost(item[1]), reverse=True)
+
+
+def print_report(process_rows: List[List[str]], genome_rows: List[List[str]], script_rows: List[List[str]],
+                 flags: List[List[str]], top: int, output: TextIO) -> None:
+    output.write("Most costly processes (core hours, wall hours, CPU efficiency, max peak RSS in GB, queue wait "
+                 "hours):\n")
+    for row in process_rows[:top]:
+        output.write(f"    {row[0]}: {row[6]}, {row[4]}, {row[7]}, {row[8]}, {row[9]}\n")
+
+    if genome_rows:
+        output.write("Most costly genomes (core hours, wall hours, max peak RSS in GB):\n")
+        for row in genome_rows[:top]:
+            output.write(f"    {row[0]}: {row[6]}, {row[4]}, {row[8]}\n")
+
+    if script_rows:
+        output.write("Slowest scripts (wall hours, CPU hours, share of task wall time):\n")
+        for row in script_rows[:top]:
+            output.write(f"    {row[1]} {row[2]} in {row[0]}: {row[4]}, {row[5]}, {row[9]}\n")
+
+    for row in flags:
+        output.write(f"{row[1]} is {row[2]}: {row[5]} used at most, of {row[4]} requested. Suggested: {row[7]}\n")
+
+
+def write_performance_report(trace_path: str, timing_dir: str, output_dir: str, low_usage: float, high_usage: float,
+                             top: int, force: bool, verbose: bool) -> None:
+    tasks = read_trace_from_path(trace_path, verbose)
+    records = read_timing_records(timing_dir, verbose) if timing_dir else []
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    process_summaries = sort_by_cost(summarize_tasks(tasks, lambda task: task.process),
+                                     lambda summary: summary.core_seconds)
+    process_rows = [[process] + summary.get_row() for process, summary in process_summaries]
+    write_tsv(path.join(output_dir, "process_summary.tsv"), ["Process"] + SUMMARY_COLUMNS, process_rows, force)
+
+    # only tagged tasks belong to a genome
+    tagged_tasks = [task for task in tasks if task.tag]
+    genome_summaries = sort_by_cost(summarize_tasks(tagged_tasks, lambda task: task.tag),
+                                    lambda summary: summary.core_seconds)
+    genome_rows = [[tag] + summary.get_row() for tag, summary in genome_summaries]
+    write_tsv(path.join(output_dir, "genome_summary.tsv"), ["Genome"] + SUMMARY_COLUMNS, genome_rows, force)
+
+    script_rows = []
+
+    if timing_dir:
+        script_summaries = sort_by_cost(summarize_scripts(records, tasks), lambda summary: summary.wall_seconds)
+        script_rows = [list(key) + summary.get_row() for key, summary in script_summaries]
+        write_tsv(path.join(output_dir, "script_summary.tsv"), SCRIPT_COLUMNS, script_rows, force)
+
+    flags = check_provisioning(tasks, low_usage, high_usage)
+    write_tsv(path.join(output_dir, "provisioning.tsv"), PROVISIONING_COLUMNS, flags, force)
+
+    print_report(process_rows, genome_rows, script_rows, flags, top, sys.stdout)
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Summarizes wall time, CPU use, peak memory, queue wait and "
+                                                           "I/O of a VIBES run per process, per genome and per script, "
+                                                           "sorted by cost, and flags over- or under-provisioned "
+                                                           "resource settings")
+    parser.add_argument("trace_file", type=str,
+                        help="Path to Nextflow trace file, written to performance_dir/trace.tsv when performance_dir is "
+                             "set")
+    parser.add_argument("output_dir", type=str,
+                        help="Path to directory where process_summary.tsv, genome_summary.tsv, script_summary.tsv and "
+                             "provisioning.tsv will be written. Created if it doesn't exist")
+    parser.add_argument("--timing_dir", type=str, default="",
+                        help="Path to directory of timing records written by bin/ scripts (performance_dir/timing when "
+                             "performance_dir is set)")
+    parser.add_argument("--low_usage", type=float, default=DEFAULT_LOW_USAGE,
+                        help=f"Flag memory and time settings as over-provisioned if no task used more than this "
+                             f"fraction of what it requested (default {DEFAULT_LOW_USAGE})")
+    parser.add_argument("--high_usage", type=float, default=DEFAULT_HIGH_USAGE,
+                        help=f"Flag memory and time settings as under-provisioned if any task used at least this "
+                             f"fraction of what it requested, or any task was killed after using more of it than of "
+                             f"the other setting (default {DEFAULT_HIGH_USAGE})")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                        help=f"Number of processes, genomes and scripts listed in the summary printed to stdout "
+                             f"(default {DEFAULT_TOP})")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print additional information useful for debugging to stderr")
+    parser.add_argument("--force", action="store_true", help="If output files already exist, overwrite them")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+
+    if not 0 <= args.low_usage < args.high_usage:
+        raise ValueError("--low_usage must be at least 0 and less than --high_usage")
+
+    write_performance_report(args.trace_file, args.timing_dir, args.output_dir, args.low_usage, args.high_usage,
+                             args.top, args.force, args.verbose)
+
+
+if __name__ == "__main__":
+    _main()
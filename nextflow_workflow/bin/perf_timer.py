@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import atexit
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from os import path
+from typing import *
+
+# Records how long a bin/ script ran, how much CPU time and memory it and the processes it started used, and how much it
+# read and wrote. Each run writes one .json record to the directory named by the VIBES_TIMING_DIR environment variable,
+# which perf_report.py matches to Nextflow trace entries by task work directory. When VIBES_TIMING_DIR is unset or empty,
+# nothing is measured or written
+
+TIMING_DIR_VARIABLE = "VIBES_TIMING_DIR"
+TIMING_RECORD_SUFFIX = ".timing.json"
+
+# I/O counters read from /proc/self/io. rchar and wchar count every byte passed to read and write calls, including reads
+# served from the page cache, while read_bytes and write_bytes only count bytes that reached storage
+IO_FIELDS = ["rchar", "wchar", "read_bytes", "write_bytes"]
+
+
+def read_io_counters() -> Dict[str, int]:
+    counters = {}
+
+    # /proc/self/io only exists on Linux, so I/O volume isn't recorded elsewhere
+    try:
+        with open("/proc/self/io") as io_file:
+            for line in io_file:
+                name, value = line.split(":")
+                if name in IO_FIELDS:
+                    counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return counters
+
+
+def peak_rss_bytes(usage: resource.struct_rusage) -> int:
+    # ru_maxrss is reported in bytes on macOS and in kilobytes everywhere else
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+class ScriptTimer:
+    def __init__(self, script: str, label: str, timing_dir: str):
+        self.script = script
+        self.label = label
+        self.timing_dir = timing_dir
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_io = read_io_counters()
+        self.stopped = False
+
+    def get_record(self) -> Dict[str, Any]:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # only covers child processes that have been waited on, such as finished subprocess.run() calls and the workers
+        # of a closed multiprocessing Pool
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_counters = read_io_counters()
+
+        record = {"script": self.script,
+                  "label": self.label,
+                  "argv": sys.argv[1:],
+                  "host": socket.gethostname(),
+                  "pid": os.getpid(),
+                  "work_dir": os.getcwd(),
+                  "start": self.start_time,
+                  "wall_seconds": time.perf_counter() - self.start_counter,
+                  "user_seconds": usage.ru_utime - self.start_usage.ru_utime,
+                  "system_seconds": usage.ru_stime - self.start_usage.ru_stime,
+                  "child_user_seconds": child_usage.ru_utime - self.start_child_usage.ru_utime,
+                  "child_system_seconds": child_usage.ru_stime - self.start_child_usage.ru_stime,
+                  "peak_rss_bytes": peak_rss_bytes(usage),
+                  "child_peak_rss_bytes": peak_rss_bytes(child_usage)}
+
+        for field in IO_FIELDS:
+            if field in io_counters:
+                record[field] = io_counters[field] - self.start_io.get(field, 0)
+
+        return record
+
+    def stop(self) -> None:
+        # registered with atexit as well as callable directly, so only the first call writes a record
+        if self.stopped:
+            return
+
+        self.stopped = True
+        record = self.get_record()
+
+        # pid and start time keep records unique when a script runs several times in one task or on several hosts
+        record_name = f"{self.script}.{record['host']}.{record['pid']}.{int(self.start_time * 1000)}{TIMING_RECORD_SUFFIX}"
+
+        try:
+            os.makedirs(self.timing_dir, exist_ok=True)
+            # written under a temporary name and then renamed, so perf_report.py never reads a partial record
+            temp_path = path.join(self.timing_dir, f".{record_name}.tmp")
+            with open(temp_path, "w") as record_file:
+                json.dump(record, record_file)
+            os.replace(temp_path, path.join(self.timing_dir, record_name))
+        # a timing record is never worth failing the pipeline over
+        except OSError as error:
+            print(f"Unable to write timing record to {self.timing_dir}: {error}", file=sys.stderr)
+
+
+def start(script_path: str, label: str = "") -> Optional[ScriptTimer]:
+    timing_dir = os.environ.get(TIMING_DIR_VARIABLE, "")
+
+    if not timing_dir:
+        return None
+
+    timer = ScriptTimer(path.basename(script_path), label, timing_dir)
+    # the record is written when the interpreter exits, including after sys.exit() or an uncaught exception
+    atexit.register(timer.stop)
+
+    return timer
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+from typing import *
+
+import perf_timer
+
+# A persistent, content-addressed store for scan output tables. Entries are keyed on a hash of the scanned genome, the
+# profile database, the search tool version and the search parameters, so a rescan of an identical genome against an
+# identical database can be served from the store no matter which run, user or work directory produced it. Each
+# entry's modification time doubles as its last access time, which is what least-recently-used eviction sorts on.
+
+DEFAULT_MAX_SIZE_GB = 50.0
+HASH_CHUNK_SIZE = 1024 * 1024
+ENTRY_DIR = "entries"
+TEMP_SUFFIX = ".tmp"
+# a temporary file this long untouched was left by a put that was killed, rather than one still copying
+STALE_TEMP_SECONDS = 24 * 60 * 60
+
+
+def hash_file(file_path: str, verbose: bool) -> str:
+    if verbose:
+        print(f"Hashing {file_path}...", file=sys.stderr)
+
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as hash_input:
+        for chunk in iter(lambda: hash_input.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def generate_key(file_paths: List[str], params: List[str], verbose: bool) -> str:
+    key_hash = hashlib.sha256()
+
+    # file contents and parameters are hashed in the order given, so the same inputs in the same order always produce
+    # the same key
+    for file_path in file_paths:
+        key_hash.update(hash_file(file_path, verbose).encode("utf-8"))
+
+    for param in params:
+        key_hash.update(b"\0")
+        key_hash.update(param.encode("utf-8"))
+
+    return key_hash.hexdigest()
+
+
+def get_entry_path(cache_dir: str, key: str) -> str:
+    return path.join(cache_dir, ENTRY_DIR, key)
+
+
+def get_from_cache(cache_dir: str, key: str, output_path: str, verbose: bool) -> bool:
+    entry_path = get_entry_path(cache_dir, key)
+
+    if not path.isfile(entry_path):
+        if verbose:
+            print(f"Cache miss for {key}", file=sys.stderr)
+        return False
+
+    try:
+        shutil.copyfile(entry_path, output_path)
+        # mark entry as recently used
+        os.utime(entry_path)
+    except FileNotFoundError:
+        # another task evicted this entry between the check above and the copy
+        if verbose:
+            print(f"Cache entry {key} evicted before it could be read", file=sys.stderr)
+        return False
+
+    if verbose:
+        print(f"Cache hit for {key}, copied to {output_path}", file=sys.stderr)
+
+    return True
+
+
+def put_in_cache(cache_dir: str, key: str, input_path: str, verbose: bool) -> None:
+    entry_path = get_entry_path(cache_dir, key)
+    os.makedirs(path.dirname(entry_path), exist_ok=True)
+
+    # copy to a temporary name first and rename into place, so concurrent tasks never read a partially written entry.
+    # mkstemp picks a name no other task can be using, even on another host sharing the cache directory
+    temp_fd, temp_path = tempfile.mkstemp(suffix=TEMP_SUFFIX, prefix=f".{key}.", dir=path.dirname(entry_path))
+    # mkstemp makes files only their owner can read. Entries get the usual permissions, so other users sharing the
+    # cache can read them
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(temp_fd, 0o666 & ~umask)
+
+    try:
+        with os.fdopen(temp_fd, "wb") as temp_file, open(input_path, "rb") as input_file:
+            shutil.copyfileobj(input_file, temp_file)
+        os.replace(temp_path, entry_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    if verbose:
+        print(f"Stored {input_path} in cache as {key}", file=sys.stderr)
+
+
+def evict_entries(cache_dir: str, max_size_bytes: int, verbose: bool) -> int:
+    entry_dir = path.join(cache_dir, ENTRY_DIR)
+    entries = []
+    total_size = 0
+
+    for entry in os.scandir(entry_dir):
+        if not entry.is_file():
+            continue
+
+        try:
+            entry_stat = entry.stat()
+        except FileNotFoundError:
+            continue
+
+        # temporary files belong to puts that are still in progress, unless they were left by a killed task
+        if entry.name.endswith(TEMP_SUFFIX):
+            if time.time() - entry_stat.st_mtime > STALE_TEMP_SECONDS:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+                if verbose:
+                    print(f"Removed stale temporary file {entry.name} from cache", file=sys.stderr)
+            continue
+
+        entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        total_size += entry_stat.st_size
+
+    # oldest access first
+    entries.sort()
+    evicted = 0
+
+    for access_time, entry_size, entry_path in entries:
+        if total_size <= max_size_bytes:
+            break
+
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            # already evicted by a concurrent task
+            pass
+
+        total_size -= entry_size
+        evicted += 1
+
+        if verbose:
+            print(f"Evicted {path.basename(entry_path)} from cache", file=sys.stderr)
+
+    return evicted
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Persistent content-addressed cache for scan output tables, "
+                                                           "shared across runs")
+    subparsers = parser.add_subparsers(dest="cache_mode",
+                                       help="key prints a cache key for a set of input files and parameters, get "
+                                            "copies a cached table to an output path (exiting with status 1 on a "
+                                            "miss), and put stores a table and evicts least recently used entries "
+                                            "until the cache fits its size cap")
+
+    key_parser = subparsers.add_parser("key", help="Print cache key built from file contents and parameter strings")
+    key_parser.add_argument("--file", type=str, action="append", default=[], dest="file_paths",
+                            help="Input file whose contents are part of the key, such as a genome or HMM database. "
+                                 "May be given multiple times")
+    key_parser.add_argument("--param", type=str, action="append", default=[], dest="params",
+                            help="Parameter string that is part of the key, such as a tool version or search options. "
+                                 "May be given multiple times")
+
+    get_parser = subparsers.add_parser("get", help="Copy cached entry for key to output_path. Exits with status 1 if "
+                                                   "the key is not cached")
+    get_parser.add_argument("cache_dir", type=str, help="Path to cache directory")
+    get_parser.add_argument("key", type=str, help="Cache key produced by key mode")
+    get_parser.add_argument("output_path", type=str, help="Path cached table will be copied to")
+
+    put_parser = subparsers.add_parser("put", help="Store a table in the cache under key")
+    put_parser.add_argument("cache_dir", type=str, help="Path to cache directory. Created if it doesn't exist")
+    put_parser.add_argument("key", type=str, help="Cache key produced by key mode")
+    put_parser.add_argument("input_path", type=str, help="Path to table to store")
+    put_parser.add_argument("--max_size_gb", type=float, default=DEFAULT_MAX_SIZE_GB,
+                            help=f"Size cap for the whole cache in GB. Least recently used entries are evicted until "
+                                 f"the cache fits (default {DEFAULT_MAX_SIZE_GB})")
+
+    # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers
+    for name, subp in subparsers.choices.items():
+        subp.add_argument("--verbose", action="store_true",
+                          help="Print additional information useful for debugging to stderr")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__, args.cache_mode)
+    cache_mode = args.cache_mode
+    verbose = args.verbose
+
+    if cache_mode == "key":
+        print(generate_key(args.file_paths, args.params, verbose))
+
+    elif cache_mode == "get":
+        if not get_from_cache(args.cache_dir, args.key, args.output_path, verbose):
+            sys.exit(1)
+
+    elif cache_mode == "put":
+        if args.max_size_gb < 0:
+            raise ValueError("--max_size_gb must be used with an argument greater than or equal to 0")
+
+        put_in_cache(args.cache_dir, args.key, args.input_path, verbose)
+        evict_entries(args.cache_dir, int(args.max_size_gb * 1024 ** 3), verbose)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from os import path
+from pathlib import Path
+from typing import TextIO
+from typing import *
+
+import fasta_io
+import perf_timer
+
+# Splits a phage database into smaller .fasta files in one streaming pass, so downstream tasks can work on single phages
+# or batches of phages without the database being parsed once per task. With a batch size of 1, each file is named
+# after the sequence ID it holds. A manifest records each sequence's ID, length and the file it was written to, so later
+# steps can look lengths up instead of measuring them again.
+
+DEFAULT_BATCH_SIZE = 1
+
+
+def overwrite_check(file_path: str, force: bool) -> None:
+    if path.isfile(file_path) and not force:
+        raise FileExistsError(
+            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+
+
+def split_phage_database(phage_file: TextIO, output_dir: str, manifest: TextIO, batch_size: int, force: bool,
+                         verbose: bool) -> Tuple[int, int]:
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    manifest.write(fasta_io.MANIFEST_HEADER)
+
+    used_stems = set()
+    seq_count = 0
+    file_count = 0
+    writer = None
+    file_name = None
+
+    try:
+        for header, seq_lines in fasta_io.read_fasta_records(phage_file):
+            seq_id = fasta_io.get_seq_id(header)
+
+            # start a new file for every batch_size sequences
+            if seq_count % batch_size == 0:
+                if writer is not None:
+                    writer.close()
+
+                file_count += 1
+                file_stem = fasta_io.get_file_stem(seq_id, used_stems) if batch_size == 1 else f"batch_{file_count}"
+                file_name = f"{file_stem}.fasta"
+                file_path = path.join(output_dir, file_name)
+                overwrite_check(file_path, force)
+                writer = fasta_io.FastaWriter(file_path)
+
+                if verbose:
+                    print(f"Writing {file_path}...", file=sys.stderr)
+
+            writer.write_lines(header, seq_lines)
+            manifest.write(f"{seq_id}\t{len(fasta_io.get_sequence(seq_lines))}\t{file_name}\n")
+            seq_count += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return seq_count, file_count
+
+
+def split_phage_database_from_path(phage_path: str, output_dir: str, manifest_path: str, batch_size: int, force: bool,
+                                   verbose: bool) -> None:
+    overwrite_check(manifest_path, force)
+
+    with fasta_io.open_fasta(phage_path) as phage_file, open(manifest_path, "w") as manifest:
+        seq_count, file_count = split_phage_database(phage_file, output_dir, manifest, batch_size, force, verbose)
+
+    print(f"Split {seq_count} sequences from {phage_path} into {file_count} files", file=sys.stderr)
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Splits a phage database .fasta into one file per sequence, "
+                                                           "or per batch of sequences, in a single pass, and writes a "
+                                                           "manifest of each sequence's ID, length and output file")
+    parser.add_argument("phage_fasta", type=str, help="Path to .fasta file containing all phage genomes. May be gzip "
+                                                      "compressed")
+    parser.add_argument("output_dir", type=str, help="Path to directory where split .fasta files will be written. "
+                                                     "Created if it doesn't exist")
+    parser.add_argument("output_manifest", type=str,
+                        help="Path to output .tsv listing each sequence's ID, length and the file it was written to")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Number of sequences per output file (default {DEFAULT_BATCH_SIZE}). With 1, files are "
+                             f"named after their sequence ID, otherwise they are named batch_1.fasta, batch_2.fasta, "
+                             f"and so on")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print additional information useful for debugging to stderr")
+    parser.add_argument("--force", action="store_true", help="If output files already exist, overwrite them")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__)
+
+    if args.batch_size < 1:
+        raise ValueError("--batch_size must be used with an argument greater than 0")
+
+    split_phage_database_from_path(args.phage_fasta, args.output_dir, args.output_manifest, args.batch_size, args.force,
+                                   args.verbose)
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,110 +1,96 @@
 #!/usr/bin/env python3
 import argparse
-import json
 import sys
-import typing
 import numpy as np
-from os import path
 from typing import *
 
+import occurrence_io
+import perf_timer
 
-INDENT_VAL = 4
 
+def add_occurrences(summed_dict: Dict[str, np.ndarray], indv_dict: occurrence_io.OccurrenceDict) -> None:
+    # add one file's occurrence runs into the running sum in place. Arrays for the same virus should be the same length,
+    # but if they aren't (e.g. a reference was updated between runs), pad the shorter one with zeros rather than crash
+    for vir_name, (length, runs) in indv_dict.items():
+        occurrence_array = occurrence_io.runs_to_array(runs, length)
+        summed_array = summed_dict.get(vir_name)
 
-def overwrite_check(file_path: str, force: bool) -> None:
-    if path.isfile(file_path) and not force:
-        raise FileExistsError(
-            f"Output file {file_path} already exists- either move or delete this file or enable --force")
+        if summed_array is None:
+            summed_dict[vir_name] = occurrence_array
+            continue
 
+        if len(occurrence_array) > len(summed_array):
+            summed_array = np.pad(summed_array, (0, len(occurrence_array) - len(summed_array)))
+            summed_dict[vir_name] = summed_array
 
-def read_json(json_file: typing.TextIO, verbose: bool) -> Dict[str, np.ndarray]:
-    occurrence_dict = {}
+        summed_array[:len(occurrence_array)] += occurrence_array
 
-    # json.load() will return the .json as a Python dict
-    json_dict = json.load(json_file)
-    for vir_name, occurrence_list in json_dict.items():
-        # casting the occurrence list to a numpy array will allow for fast element-wise addition later
-        occurrence_dict[vir_name] = np.array(occurrence_list)
 
-    return occurrence_dict
-
-
-def read_json_from_path(input_path: str, verbose: bool) -> Dict[str, np.ndarray]:
-    with open(input_path, "r") as json_file:
-        return read_json(json_file, verbose)
-
-
-def sum_occurrences(dict_list: List[Dict[str, np.ndarray]], verbose: bool) -> Dict[str, np.ndarray]:
+def sum_occurrences(input_paths: Iterable[str], verbose: bool) -> occurrence_io.OccurrenceDict:
     summed_dict = {}
     counter = 0
 
-    # iterate through all individual occurrence dicts. For each dict, iterate through its keys and values, saving them
-    # in a summed dictionary where the values for each virus are summed together
-    for indv_dict in dict_list:
-        for vir_name, occurrence_array in indv_dict.items():
-            if vir_name in summed_dict:
-                summed_dict[vir_name] += occurrence_array
-            else:
-                summed_dict[vir_name] = occurrence_array
-
+    # add each file into the running sum as soon as it's loaded, so only one input is held in memory at a time. Since
+    # addition is associative, inputs can be per-genome counts or partial sums written by earlier runs of this script
+    for input_path in input_paths:
+        add_occurrences(summed_dict, occurrence_io.read_occurrences(input_path, verbose))
         counter += 1
 
     if verbose:
-        print(f"{counter} input individual occurrence count .jsons summed")
-
-    return summed_dict
-
-
-def write_occurrence_json(json_file: typing.TextIO, occurrence_dict: Dict[str, np.ndarray]) -> None:
-    # convert numpy arrays back to lists so they'll work with the json package
-    for key, array in occurrence_dict.items():
-        occurrence_dict[key] = array.tolist()
-
-    json_file.write(json.dumps(occurrence_dict, indent=INDENT_VAL))
+        print(f"{counter} input occurrence count files summed")
 
-
-def write_occurrence_json_from_path(json_path: str, occurrence_dict: Dict[str, np.ndarray], force: bool) -> None:
-    overwrite_check(json_path, force)
-
-    with open(json_path, "w") as occ_json:
-        write_occurrence_json(occ_json, occurrence_dict)
-        occ_json.close()
+    return {vir_name: (len(array), occurrence_io.array_to_runs(array)) for vir_name, array in summed_dict.items()}
 
 
 def parse_args(sys_args: list) -> argparse.Namespace:
-    default_eval = 1e-5
-    parser = argparse.ArgumentParser(sys_args, description="Accepts file with paths to VIBES integration .json files, then sums up occurrence counts for each reference with hits")
-    parser.add_argument("output_path", type=str, help="Path to output .json file containing a summed nucleotide occurrence count for each reference virus that appears at least once in the input .jsons")
-        # nargs="*" tells parsearg that the input type will be a list with at least 0 items
-    parser.add_argument("json_path_list", type=str, nargs="*", help="Path to text file where each line is a path to a VIBES integration .json")
+    parser = argparse.ArgumentParser(sys_args, description="Accepts paths to VIBES occurrence count files, then sums up "
+                                                           "occurrence counts for each reference with hits. Inputs may "
+                                                           "be per-genome counts or partial sums from earlier runs, so "
+                                                           "large cohorts can be summed in parallel batches and the "
+                                                           "batch sums merged")
+    parser.add_argument("output_path", type=str, help="Path to output file containing a summed nucleotide occurrence "
+                                                      "count for each reference virus that appears at least once in "
+                                                      "the inputs. Written as binary if the path ends in .npz, "
+                                                      "compact .json otherwise")
+    # nargs="*" tells parsearg that the input type will be a list with at least 0 items
+    parser.add_argument("input_path_list", type=str, nargs="*", help="Paths to occurrence count .json or .npz files")
+    parser.add_argument("--input_list", type=str, default="",
+                        help="Path to text file where each line is a path to an occurrence count file. Useful when "
+                             "there are too many inputs to pass on the command line")
+    parser.add_argument("--dense", action="store_true",
+                        help="Write .json output with one count per position of each virus, as older versions of "
+                             "VIBES did")
     parser.add_argument("--verbose", action="store_true", help="Print additional information useful for debugging")
     parser.add_argument("--force", action="store_true", help="If output file already exists, overwrite it")
 
     return parser.parse_args()
 
+
+def read_input_list(list_path: str) -> Iterator[str]:
+    with open(list_path, "r") as list_file:
+        for line in list_file:
+            if line.strip():
+                yield line.strip()
+
+
 def _main():
     args = parse_args(sys.argv[1:])
-    json_paths_list = args.json_path_list
+    perf_timer.start(__file__)
     output_path = args.output_path
     verbose = args.verbose
     force = args.force
 
-    dict_list = []
-
-    for json_path in json_paths_list:
-        json_path = json_path.strip("[],")
-        individual_occurrences_dict = read_json_from_path(json_path, verbose)
-        dict_list.append(individual_occurrences_dict)
-
-    summed_occurrences_dict = sum_occurrences(dict_list, verbose)
-
-    write_occurrence_json_from_path(output_path, summed_occurrences_dict, force)
+    # Nextflow passes lists of paths formatted like [path1, path2], so strip brackets and commas
+    input_paths = [input_path.strip("[],") for input_path in args.input_path_list]
+    input_paths = [input_path for input_path in input_paths if input_path]
 
+    if args.input_list:
+        input_paths += read_input_list(args.input_list)
 
+    summed_occurrences_dict = sum_occurrences(input_paths, verbose)
 
-    # The gist: read in every integration .json from the input file. Parse each file, building a dictionary of viruses
-    # and occurrence counts. For each key in the dictionary, write a ,json containing the summed count.
+    occurrence_io.write_occurrences(output_path, summed_occurrences_dict, force, args.dense)
 
 
 if __name__ == "__main__":
-    _main()
\ No newline at end of file
+    _main()
@@ -7,6 +7,12 @@ from typing import *
 from os import path
 from pathlib import Path
 import json
+import math
+import os
+
+import fasta_io
+import occurrence_io
+import perf_timer
 
 # Dependency: esl-seqstat in some circumstances
 
@@ -14,6 +20,13 @@ INDENT_VAL = 4
 TABLE_MODE = Literal["dfam", "tbl"]
 TSV_MODE = Literal["integration", "annotation"]
 STRAND = Literal["+", "-"]
+# matches the default used by dfamscan.pl and bathscan.pl
+DEFAULT_MIN_COV_FRAC = 0.75
+SNAPSHOT_FORMAT = "vibes_hit_snapshot"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_SUFFIX = ".snapshot.npz"
+# stored in snapshots for sequences esl-seqstat couldn't find a length for. Version 1 snapshots stored 0
+UNKNOWN_SEQ_LENGTH = -1
 
 
 # TODO: Document this class and its quirks
@@ -180,37 +193,52 @@ def sort_hit_list(hit_list: List[QueryHit]) -> None:
         key=lambda x: (x.target_name, x.query_name, find_position_for_strand_type(x.target_st, x.target_end, x.strand)))
 
 
+def merge_integrations(query_hits: List[QueryHit], max_gap_percent: float, overlap_tolerance: int,
+                       full_threshold: float) -> Dict[int, List[QueryHit]]:
+    # sort list to ensure that any hits from the same integration are next to each other
+    sort_hit_list(query_hits)
+
+    # examine sorted hits to determine if any of them are part of one integration broken up over multiple hits
+    integration_id_dict = assign_integration_ids(query_hits, max_gap_percent, overlap_tolerance)
+
+    # check whether any integrations broken up over multiple hits cover enough of their reference viral genome to be
+    # considered full length. If so, set each constituent hit to full_length = True
+    set_integration_full_length(integration_id_dict, full_threshold)
+
+    return integration_id_dict
+
+
 def overwrite_check(file_path: str, force: bool) -> None:
     if path.isfile(file_path) and not force:
         raise FileExistsError(
             f"Output file {file_path} already exists- either move or delete this file or enable --force")
 
 
-def write_occurrence_json(json_file: TextIO, query_hits: List[QueryHit]) -> None:
-    occ_dict = {}
+def build_occurrence_dict(query_hits: List[QueryHit]) -> occurrence_io.OccurrenceDict:
+    # for each reference target sequence (e.g. a viral genome), count how many times each of its positions has been
+    # detected in a query sequence (e.g. a bacterial genome). Counts are built from hit start and end positions as
+    # runs of equal count, so the work done doesn't depend on how long the hits are
+    intervals_dict = {}
+    length_dict = {}
 
     for hit in query_hits:
-        # each position in the list corresponds to a position in a reference target sequence (e.g. a viral
-        # genome). the number at each position is how many times a nucleotide corresponding to that position has been
-        # detected in a query sequence (e.g. a bacterial genome)
-        if hit.query_name not in occ_dict.keys():
-            occ_dict[hit.query_name] = [0] * hit.query_len
+        # offset start by 1 because genomes are 1-indexed, runs are 0-indexed. Don't offset end, because runs exclude it
+        intervals_dict.setdefault(hit.query_name, []).append(
+            (min(hit.query_st, hit.query_end) - 1, max(hit.query_st, hit.query_end)))
+        length_dict[hit.query_name] = hit.query_len
 
-        query_start_index = hit.query_st - 1  # offset by 1 because genomes are 1-indexed, lists are 0-indexed
-        query_end_index = hit.query_end  # don't offset by 1 because range() excludes end
+    return {query_name: (length_dict[query_name], occurrence_io.intervals_to_runs(intervals))
+            for query_name, intervals in intervals_dict.items()}
 
-        for index in range(query_start_index, query_end_index):
-            occ_dict[hit.query_name][index] += 1
 
-    json_file.write(json.dumps(occ_dict, indent=INDENT_VAL))
+def write_occurrence_json(json_file: TextIO, query_hits: List[QueryHit], dense: bool = False) -> None:
+    occurrence_io.write_occurrence_json(json_file, build_occurrence_dict(query_hits), dense)
 
 
-def write_occurrence_json_from_path(json_path: str, query_hits: List[QueryHit], force: bool) -> None:
-    overwrite_check(json_path, force)
-
-    with open(json_path, "w") as json_file:
-        write_occurrence_json(json_file, query_hits)
-        json_file.close()
+def write_occurrence_json_from_path(json_path: str, query_hits: List[QueryHit], force: bool,
+                                    dense: bool = False) -> None:
+    # written as binary if json_path ends in .npz
+    occurrence_io.write_occurrences(json_path, build_occurrence_dict(query_hits), force, dense)
 
 
 def get_genome_len(genome_path: str, verbose: bool) -> int:
@@ -299,6 +327,72 @@ def write_tsv_from_path(tsv_path: str, seq_list: List[QueryHit], annotation_mode
         elif annotation_mode == "protein_annotation":
             write_protein_tsv(tsv, seq_list)
 
+def read_seq_lengths(lengths_path: str, genome_path: str, verbose: bool) -> Dict[str, int]:
+    if verbose:
+        print(f"Opening {lengths_path}...")
+
+    seq_lengths = {}
+    genome_file_name = path.basename(genome_path)
+    is_manifest = False
+
+    # sequence name and length are the first two columns of a .fai index, a phage manifest, or the lengths file written
+    # by change_contig_ids.py. A manifest from split_phage_database.py covers a whole phage database, with a third
+    # column naming the file each sequence was written to, so only sequences in genome_path are kept
+    with open(lengths_path, "r") as lengths_file:
+        for line in lengths_file:
+            if line.startswith(fasta_io.MANIFEST_HEADER):
+                is_manifest = True
+                continue
+
+            if line[0] == "#" or not line.strip():
+                continue
+
+            fields = line.rstrip("\n").split("\t")
+            if is_manifest and fields[2] != genome_file_name:
+                continue
+
+            seq_lengths[fields[0]] = int(fields[1])
+
+    return seq_lengths
+
+
+def measure_seq_lengths(genome_path: str, verbose: bool) -> Dict[str, int]:
+    if verbose:
+        print(f"Measuring sequence lengths in {genome_path}...")
+
+    # streamed one sequence at a time with the shared .fasta reader, rather than running esl-seqstat
+    return {fasta_io.get_seq_id(header): len(fasta_io.get_sequence(seq_lines))
+            for header, seq_lines in fasta_io.read_fasta_records_from_path(genome_path)}
+
+
+def write_split_protein_tsvs(output_dir: str, seq_list: List[QueryHit], seq_lengths: Dict[str, int], genome_path: str,
+                             force: bool, verbose: bool) -> int:
+    # one table can hold hits on many sequences, such as a batch of phages scanned together. Write one .tsv per
+    # sequence as if each had been scanned and parsed on its own, named as the workflow names a single sequence's .tsv:
+    # its ID up to the first '.', with characters that don't belong in file names replaced. Sequences without hits
+    # still get a .tsv with only a header line
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    seq_hits = {seq_name: [] for seq_name in seq_lengths}
+    genome_extension = path.splitext(genome_path)[1]
+
+    for hit in seq_list:
+        # report the per-sequence .fasta name each sequence would have had if it was scanned on its own
+        hit.target_genome_file = f"{hit.target_name}{genome_extension}"
+        seq_hits.setdefault(hit.target_name, []).append(hit)
+
+    used_stems = set()
+
+    for seq_name, hits in seq_hits.items():
+        tsv_path = path.join(output_dir, f"{fasta_io.get_file_stem(seq_name, used_stems, simple_name=True)}.tsv")
+
+        if verbose:
+            print(f"Writing {len(hits)} hits on {seq_name} to {tsv_path}...")
+
+        write_tsv_from_path(tsv_path, hits, "protein_annotation", force)
+
+    return len(seq_hits)
+
+
 def set_hit_full_length(hit: QueryHit, threshold: float) -> None:
     percent_coverage_of_reference = hit.get_percent_complete()
     hit.full_length = hit.get_percent_complete() >= threshold
@@ -348,9 +442,11 @@ def parse_dfam_file(dfam_file: TextIO, genome_path: str, full_threshold: float,
 
 # TODO: Block comment
 def parse_tbl_file(tbl_file: TextIO, genome_path: str, full_threshold: float, max_eval: float, verbose: bool,
-                   annotations: Dict[str, str] = None) -> List[QueryHit]:
+                   annotations: Dict[str, str] = None, seq_lengths: Dict[str, int] = None) -> List[QueryHit]:
     hit_list = []
-    genome_len = None
+    # maps each sequence in the genome file to its length. Lengths that weren't supplied are looked up with esl-seqstat
+    # the first time a sequence is seen and re-used for every later hit on it
+    seq_lengths = dict(seq_lengths) if seq_lengths else {}
     for line_num, line in enumerate(tbl_file, 0):
         # skip comment lines starting with #
         if line[0] == "#":
@@ -380,9 +476,9 @@ def parse_tbl_file(tbl_file: TextIO, genome_path: str, full_threshold: float, ma
 
             if evalue <= max_eval:
                 hit = QueryHit(hit_name, acc_id, query_name, evalue, ali_st, ali_en, genome_path, hmm_st, hmm_en,
-                               hmm_len, strand, verbose, target_genome_len=genome_len, description=description)
-                # all hits come from the same genome, so genome length is the same
-                genome_len = hit.target_genome_len
+                               hmm_len, strand, verbose, target_genome_len=seq_lengths.get(query_name),
+                               description=description)
+                seq_lengths[query_name] = hit.target_genome_len
                 set_hit_full_length(hit, full_threshold)
                 hit_list.append(hit)
             else:
@@ -393,19 +489,409 @@ def parse_tbl_file(tbl_file: TextIO, genome_path: str, full_threshold: float, ma
     return hit_list
 
 
+# A row from a raw, unfiltered .dfam or .tbl table, holding only the fields needed to resolve overlapping hits. Start is
+# always the smaller coordinate, as in dfamscan.pl and bathscan.pl
+class TableRow:
+    def __init__(self, line: str, table_mode: TABLE_MODE):
+        line_list = line.split()
+        self.line = line
+
+        if table_mode == "dfam":
+            self.model = line_list[0]
+            self.seq = line_list[2]
+            self.score = float(line_list[3])
+            self.strand = line_list[8]
+            self.start = int(line_list[9])
+            self.end = int(line_list[10])
+
+            if self.strand == "-":
+                self.start, self.end = self.end, self.start
+
+        else:
+            self.seq = line_list[0]
+            self.model = line_list[2]
+            self.start = int(line_list[8])
+            self.end = int(line_list[9])
+            self.score = float(line_list[13])
+            self.strand = "+"
+
+            if self.start > self.end:
+                self.start, self.end = self.end, self.start
+                self.strand = "-"
+
+
+def remove_covered_rows(cluster: List[Tuple[float, int, int]], sorted_rows: List[TableRow], deleted: Set[int],
+                        min_cov_frac: float) -> None:
+    # singletons can't be dominated by anything
+    if len(cluster) < 2:
+        return
+
+    # highest scoring rows first, breaking ties with the longer row. sort() is stable, like Perl's, so remaining ties
+    # keep their position order
+    cluster.sort(key=lambda x: (-x[0], -x[2]))
+
+    for j in range(len(cluster)):
+        a_index = cluster[j][1]
+        if a_index in deleted:
+            continue
+
+        row_a = sorted_rows[a_index]
+        for k in range(j + 1, len(cluster)):
+            b_index = cluster[k][1]
+            if b_index in deleted:
+                continue
+
+            row_b = sorted_rows[b_index]
+            if row_b.end < row_a.start or row_b.start > row_a.end:
+                continue
+
+            # a lower scoring row is redundant when enough of it is covered by a higher scoring one
+            covered_len = min(row_a.end, row_b.end) - max(row_a.start, row_b.start) + 1
+            b_len = row_b.end - row_b.start + 1
+            if covered_len / b_len >= min_cov_frac:
+                deleted.add(b_index)
+
+
+# Python port of the redundant profile hit removal in dfamscan.pl and bathscan.pl, producing the same rows in the same
+# order as those scripts do with their default options. Rows are swept in order of sequence and start position; a row
+# joins the current cluster while it starts before the furthest end seen so far (with 5 positions of slack), and
+# within each cluster rows mostly covered by a higher scoring row are removed. As in the Perl scripts, the furthest end
+# is not reset when the sweep moves on to a new sequence
+def resolve_overlapping_hits(table_file: Iterable[str], table_mode: TABLE_MODE, min_cov_frac: float,
+                             verbose: bool) -> List[str]:
+    rows = [TableRow(line, table_mode) for line in table_file if line[0] != "#" and line.strip()]
+    sorted_rows = sorted(rows, key=lambda x: (x.seq, x.start, x.end, x.score))
+
+    deleted = set()
+    cluster = []
+    highest_prev_end = 0
+    prev_seq = ""
+
+    for index, row in enumerate(sorted_rows):
+        if row.seq == prev_seq and row.start < highest_prev_end - 5:
+            cluster.append((row.score, index, row.end - row.start))
+        else:
+            remove_covered_rows(cluster, sorted_rows, deleted, min_cov_frac)
+            cluster = [(row.score, index, row.end - row.start)]
+
+        prev_seq = row.seq
+        highest_prev_end = max(highest_prev_end, row.end)
+
+    remove_covered_rows(cluster, sorted_rows, deleted, min_cov_frac)
+
+    kept_rows = [row for index, row in enumerate(sorted_rows) if index not in deleted]
+    kept_rows.sort(key=lambda x: (x.seq, x.strand, x.start, x.end, x.score, x.model))
+
+    if verbose:
+        print(f"Hits before overlap removal: {len(rows)}")
+        print(f"Hits after overlap removal: {len(kept_rows)}")
+
+    return [row.line for row in kept_rows]
+
+
+def parse_table(table_file: TextIO, genome_path: str, full_threshold: float, max_eval: float, table_mode: TABLE_MODE,
+                verbose: bool, minimum_len: int = 0, annotations: Dict[str, str] = None, resolve_overlaps: bool = False,
+                min_cov_frac: float = DEFAULT_MIN_COV_FRAC, seq_lengths: Dict[str, int] = None) -> List[QueryHit]:
+    if resolve_overlaps:
+        table_file = resolve_overlapping_hits(table_file, table_mode, min_cov_frac, verbose)
+
+    if table_mode == "dfam":
+        return parse_dfam_file(table_file, genome_path, full_threshold, max_eval, minimum_len, verbose)
+    elif table_mode == "tbl":
+        return parse_tbl_file(table_file, genome_path, full_threshold, max_eval, verbose, annotations=annotations,
+                              seq_lengths=seq_lengths)
+    else:
+        raise ValueError("table_type must be either dfam or tbl")
+
+
 def parse_table_from_path(table_path: str, genome_path: str, full_threshold: float, max_eval: float,
                           table_mode: TABLE_MODE, verbose: bool, minimum_len: int = 0,
-                          annotations: Dict[str, str] = None) -> List[QueryHit]:
+                          annotations: Dict[str, str] = None, resolve_overlaps: bool = False,
+                          min_cov_frac: float = DEFAULT_MIN_COV_FRAC,
+                          seq_lengths: Dict[str, int] = None) -> List[QueryHit]:
+    # a table path of - reads the table from stdin, so table_parser.py can sit at the end of a pipe from dfamscan.pl or
+    # bathscan.pl without the filtered table ever being written to disk
+    if table_path == "-":
+        if verbose:
+            print("Reading table from stdin...")
+
+        return parse_table(sys.stdin, genome_path, full_threshold, max_eval, table_mode, verbose,
+                           minimum_len=minimum_len, annotations=annotations, resolve_overlaps=resolve_overlaps,
+                           min_cov_frac=min_cov_frac, seq_lengths=seq_lengths)
+
     with open(table_path) as table_file:
         if verbose:
             print(f"Opening {table_path}...")
 
-        if table_mode == "dfam":
-            return parse_dfam_file(table_file, genome_path, full_threshold, max_eval, minimum_len, verbose)
-        elif table_mode == "tbl":
-            return parse_tbl_file(table_file, genome_path, full_threshold, max_eval, verbose, annotations=annotations)
+        return parse_table(table_file, genome_path, full_threshold, max_eval, table_mode, verbose,
+                           minimum_len=minimum_len, annotations=annotations, resolve_overlaps=resolve_overlaps,
+                           min_cov_frac=min_cov_frac, seq_lengths=seq_lengths)
+
+
+def filter_hits(query_hits: List[QueryHit], max_eval: float, minimum_len: int) -> List[QueryHit]:
+    # the same e-value and length filters parse_dfam_file() applies while reading a table
+    return [hit for hit in query_hits
+            if hit.evalue <= max_eval and is_minimum_length(hit.target_st, hit.target_end, minimum_len)]
+
+
+# A snapshot holds every hit parsed from one genome's table, before e-value and length filters, along with the length
+# of each sequence hit. Hits are stored in the order they were parsed, as flat arrays in a .npz file (numpy is only
+# imported when a snapshot is read or written). Rebuilding hits from a snapshot gives the same integration .tsv as
+# parsing the table again would, for any thresholds, without reading the table or the genome
+def write_hit_snapshot(snapshot_path: str, query_hits: List[QueryHit], genome_path: str, table_mode: TABLE_MODE,
+                       resolve_overlaps: bool, min_cov_frac: float) -> None:
+    import numpy as np
+
+    contig_lengths = {}
+    for hit in query_hits:
+        contig_lengths.setdefault(hit.target_name, hit.target_genome_len)
+
+    contig_names = list(contig_lengths.keys())
+    contig_index = {contig_name: index for index, contig_name in enumerate(contig_names)}
+
+    # np.savez_compressed() would append .npz to a path that doesn't end with it, so write through a file object
+    with open(snapshot_path, "wb") as snapshot_file:
+        np.savez_compressed(snapshot_file,
+                            format=np.array(SNAPSHOT_FORMAT),
+                            version=np.array(SNAPSHOT_VERSION),
+                            genome_file=np.array(path.basename(genome_path)),
+                            table_type=np.array(table_mode),
+                            resolve_overlaps=np.array(resolve_overlaps),
+                            min_cov_frac=np.array(min_cov_frac),
+                            contig_names=np.array(contig_names, dtype=str),
+                            contig_lengths=np.array([UNKNOWN_SEQ_LENGTH if contig_lengths[name] is None
+                                                     else contig_lengths[name] for name in contig_names],
+                                                    dtype=np.int64),
+                            hit_names=np.array([hit.query_name for hit in query_hits], dtype=str),
+                            accessions=np.array([hit.acc_id for hit in query_hits], dtype=str),
+                            contigs=np.array([contig_index[hit.target_name] for hit in query_hits], dtype=np.int64),
+                            evalues=np.array([hit.evalue for hit in query_hits], dtype=np.float64),
+                            hmm_starts=np.array([hit.query_st for hit in query_hits], dtype=np.int64),
+                            hmm_ends=np.array([hit.query_end for hit in query_hits], dtype=np.int64),
+                            hmm_lengths=np.array([hit.query_len for hit in query_hits], dtype=np.int64),
+                            ali_starts=np.array([hit.target_st for hit in query_hits], dtype=np.int64),
+                            ali_ends=np.array([hit.target_end for hit in query_hits], dtype=np.int64),
+                            strands=np.array([hit.strand for hit in query_hits], dtype=str))
+
+
+def write_hit_snapshot_from_path(snapshot_path: str, query_hits: List[QueryHit], genome_path: str,
+                                 table_mode: TABLE_MODE, resolve_overlaps: bool, min_cov_frac: float,
+                                 force: bool) -> None:
+    overwrite_check(snapshot_path, force)
+    write_hit_snapshot(snapshot_path, query_hits, genome_path, table_mode, resolve_overlaps, min_cov_frac)
+
+
+def read_hit_snapshot(snapshot_path: str, full_threshold: Optional[float], verbose: bool) -> List[QueryHit]:
+    import numpy as np
+
+    if verbose:
+        print(f"Opening {snapshot_path}...")
+
+    with np.load(snapshot_path) as snapshot:
+        if "format" not in snapshot.files or str(snapshot["format"]) != SNAPSHOT_FORMAT:
+            raise ValueError(f"{snapshot_path} is not a hit snapshot written by table_parser.py --snapshot_path")
+
+        if int(snapshot["version"]) > SNAPSHOT_VERSION:
+            raise ValueError(f"{snapshot_path} was written by a newer version of table_parser.py")
+
+        genome_file = str(snapshot["genome_file"])
+        contig_names = snapshot["contig_names"].tolist()
+        contig_lengths = snapshot["contig_lengths"].tolist()
+        columns = [snapshot[column].tolist() for column in ["hit_names", "accessions", "contigs", "evalues",
+                                                            "hmm_starts", "hmm_ends", "hmm_lengths", "ali_starts",
+                                                            "ali_ends", "strands"]]
+
+    query_hits = []
+
+    for hit_name, acc_id, contig, evalue, hmm_st, hmm_en, hmm_len, ali_st, ali_en, strand in zip(*columns):
+        # QueryHit looks up any length it isn't given with esl-seqstat, so an unknown length is passed as the sentinel
+        # and then set back to None, as it was when the snapshot was written
+        seq_length = contig_lengths[contig] if contig_lengths[contig] > 0 else UNKNOWN_SEQ_LENGTH
+        hit = QueryHit(hit_name, acc_id, contig_names[contig], evalue, ali_st, ali_en, genome_file, hmm_st, hmm_en,
+                       hmm_len, strand, verbose, target_genome_len=seq_length)
+        if seq_length == UNKNOWN_SEQ_LENGTH:
+            hit.target_genome_len = None
+        # without a threshold, hits are left unlabeled, for callers that decide full length themselves
+        if full_threshold is not None:
+            set_hit_full_length(hit, full_threshold)
+        query_hits.append(hit)
+
+    return query_hits
+
+
+def get_snapshot_paths(input_paths: List[str]) -> List[str]:
+    snapshot_paths = []
+
+    for input_path in input_paths:
+        if path.isdir(input_path):
+            snapshot_paths.extend(sorted(path.join(input_path, file_name) for file_name in os.listdir(input_path)
+                                         if file_name.endswith(SNAPSHOT_SUFFIX)))
         else:
-            raise ValueError("table_type must be either dfam or tbl")
+            snapshot_paths.append(input_path)
+
+    return snapshot_paths
+
+
+def get_snapshot_stem(snapshot_path: str) -> str:
+    file_name = path.basename(snapshot_path)
+
+    for suffix in [SNAPSHOT_SUFFIX, ".npz"]:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+
+    return file_name
+
+
+def rethreshold_snapshots(snapshot_paths: List[str], output_dir: str, occurrence_dir: str, full_threshold: float,
+                          max_eval: float, minimum_len: int, max_gap_percent: float, overlap_tolerance: int,
+                          dense_occurrences: bool, force: bool, verbose: bool) -> int:
+    # writes {stem}.tsv (and {stem}.occurrences.npz) for each {stem}.snapshot.npz, as table_parser.py would have written
+    # from each genome's table with these thresholds
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    if occurrence_dir:
+        Path(occurrence_dir).mkdir(parents=True, exist_ok=True)
+
+    hit_count = 0
+
+    for snapshot_path in snapshot_paths:
+        stem = get_snapshot_stem(snapshot_path)
+        query_hits = filter_hits(read_hit_snapshot(snapshot_path, full_threshold, verbose), max_eval, minimum_len)
+        merge_integrations(query_hits, max_gap_percent, overlap_tolerance, full_threshold)
+
+        write_tsv_from_path(path.join(output_dir, f"{stem}.tsv"), query_hits, "integration_annotation", force)
+
+        if occurrence_dir:
+            write_occurrence_json_from_path(path.join(occurrence_dir, f"{stem}.occurrences.npz"), query_hits, force,
+                                            dense_occurrences)
+
+        hit_count += len(query_hits)
+
+    return hit_count
+
+
+def build_sweep_arrays(snapshot_paths: List[str], max_eval: float, verbose: bool) -> Dict[str, "numpy.ndarray"]:
+    import numpy as np
+
+    sorted_hits = []
+    genome_indices = []
+
+    # every snapshot is read and sorted once, however many parameter combinations are tried. Filtering a sorted list
+    # leaves it sorted, so the minimum length filter can be applied to the arrays later
+    for genome_index, snapshot_path in enumerate(snapshot_paths):
+        query_hits = filter_hits(read_hit_snapshot(snapshot_path, None, verbose), max_eval, 0)
+        sort_hit_list(query_hits)
+        sorted_hits.extend(query_hits)
+        genome_indices.extend([genome_index] * len(query_hits))
+
+    # names are compared as integer codes. Hits on different genomes never belong to the same integration
+    _, model_codes = np.unique(np.array([hit.query_name for hit in sorted_hits], dtype=str), return_inverse=True)
+    _, seq_codes = np.unique(np.array([hit.target_name for hit in sorted_hits], dtype=str), return_inverse=True)
+
+    return {"genome": np.array(genome_indices, dtype=np.int64),
+            "model": model_codes.astype(np.int64),
+            "seq": seq_codes.astype(np.int64),
+            "plus_strand": np.array([hit.strand == "+" for hit in sorted_hits], dtype=bool),
+            "hmm_st": np.array([hit.query_st for hit in sorted_hits], dtype=np.int64),
+            "hmm_end": np.array([hit.query_end for hit in sorted_hits], dtype=np.int64),
+            "hmm_len": np.array([hit.query_len for hit in sorted_hits], dtype=np.int64),
+            "ali_st": np.array([hit.target_st for hit in sorted_hits], dtype=np.int64),
+            "ali_end": np.array([hit.target_end for hit in sorted_hits], dtype=np.int64),
+            "percent_complete": np.array([hit.get_percent_complete() for hit in sorted_hits], dtype=np.float64)}
+
+
+def get_pair_measures(hits: Dict[str, "numpy.ndarray"]) -> Dict[str, "numpy.ndarray"]:
+    import numpy as np
+
+    # the tests same_integration() makes between each hit and the one before it, for every hit after the first. The
+    # previous hit is always the one just before in the sorted list, whichever integration either belongs to
+    prev = {name: values[:-1] for name, values in hits.items()}
+    current = {name: values[1:] for name, values in hits.items()}
+    plus_strand = current["plus_strand"]
+
+    same_target = (prev["genome"] == current["genome"]) & (prev["model"] == current["model"]) & \
+                  (prev["seq"] == current["seq"]) & (prev["plus_strand"] == plus_strand)
+
+    # gap between the hits on the bacterial genome, and their overlap on the reference viral genome
+    prev_bac_end = np.where(plus_strand, prev["ali_end"], prev["ali_st"])
+    current_bac_st = np.where(plus_strand, current["ali_st"], current["ali_end"])
+    ref_overlap = np.where(prev["plus_strand"], prev["hmm_end"] - current["hmm_st"],
+                           current["hmm_end"] - prev["hmm_st"])
+
+    return {"same_target": same_target,
+            "bac_gap": current_bac_st - prev_bac_end,
+            "hmm_len": current["hmm_len"].astype(np.float64),
+            "ref_overlap": ref_overlap}
+
+
+def summarize_sweep_combination(hits: Dict[str, "numpy.ndarray"], joins_prev: "numpy.ndarray",
+                                full_thresholds: List[float]) -> Iterator[Tuple[float, List[str]]]:
+    import numpy as np
+
+    # each hit that doesn't join the previous hit starts a new integration
+    starts = np.flatnonzero(np.concatenate(([True], ~joins_prev))) if len(hits["genome"]) else np.zeros(0, dtype=int)
+    integration_sizes = np.diff(np.append(starts, len(hits["genome"])))
+
+    if len(starts):
+        # an integration's hits together cover this fraction of their reference viral genome. A hit that covers
+        # enough on its own always puts its integration over the threshold too
+        percent_sums = np.add.reduceat(hits["percent_complete"], starts)
+        bac_starts = np.minimum.reduceat(np.minimum(hits["ali_st"], hits["ali_end"]), starts)
+        bac_ends = np.maximum.reduceat(np.maximum(hits["ali_st"], hits["ali_end"]), starts)
+        lengths = bac_ends - bac_starts + 1
+        length_stats = [f"{value:g}" for value in [lengths.min(), *np.percentile(lengths, [25, 50, 75]),
+                                                   lengths.max(), lengths.mean()]]
+    else:
+        percent_sums = np.zeros(0)
+        length_stats = ["-"] * 6
+
+    for full_threshold in full_thresholds:
+        full_integrations = percent_sums >= full_threshold
+        yield full_threshold, [str(len(hits["genome"])), str(len(starts)), str(int(full_integrations.sum())),
+                               str(int(integration_sizes[full_integrations].sum()))] + length_stats
+
+
+def sweep_thresholds(hits: Dict[str, "numpy.ndarray"], full_thresholds: List[float], overlap_tolerances: List[int],
+                     distance_thresholds: List[float], minimum_lengths: List[int]) -> List[List[str]]:
+    import numpy as np
+
+    rows = []
+
+    for minimum_length in minimum_lengths:
+        kept = np.abs(hits["ali_end"] - hits["ali_st"]) >= minimum_length
+        kept_hits = {name: values[kept] for name, values in hits.items()}
+        pairs = get_pair_measures(kept_hits)
+
+        for overlap_tolerance in overlap_tolerances:
+            order_preserved = pairs["same_target"] & (pairs["ref_overlap"] <= overlap_tolerance) & \
+                              (pairs["bac_gap"] >= 0)
+
+            for distance_threshold in distance_thresholds:
+                joins_prev = order_preserved & (pairs["bac_gap"] <= pairs["hmm_len"] * distance_threshold)
+
+                for full_threshold, summary in summarize_sweep_combination(kept_hits, joins_prev, full_thresholds):
+                    rows.append([f"{full_threshold:g}", str(overlap_tolerance), f"{distance_threshold:g}",
+                                 str(minimum_length)] + summary)
+
+    return rows
+
+
+def write_sweep_summary(summary_file: TextIO, rows: List[List[str]]) -> None:
+    headers = ["Full threshold", "Overlap tolerance", "Distance threshold", "Minimum length", "Hits", "Integrations",
+               "Full length integrations", "Full length hits", "Min integration length", "Integration length Q1",
+               "Median integration length", "Integration length Q3", "Max integration length",
+               "Mean integration length"]
+    summary_file.write("# " + "\t".join(headers) + "\n")
+
+    for row in rows:
+        summary_file.write("\t".join(row) + "\n")
+
+
+def write_sweep_summary_from_path(summary_path: str, rows: List[List[str]], force: bool) -> None:
+    overwrite_check(summary_path, force)
+
+    with open(summary_path, "w") as summary_file:
+        write_sweep_summary(summary_file, rows)
 
 
 def parse_protein_annotation_from_path(anno_tsv_path: str, verbose: bool) -> Dict[str, str]:
@@ -426,8 +912,9 @@ def load_json(json_path: str, verbose: bool) -> Dict[str, List[int]]:
     if verbose:
         print(f"Opening {json_path}...")
 
-    with open(json_path, "r") as json_file:
-        return json.load(json_file)
+    # reads compact, binary or dense occurrence files, returning dense counts
+    return {vir_name: occurrence_io.runs_to_dense(runs, length)
+            for vir_name, (length, runs) in occurrence_io.read_occurrences(json_path, verbose).items()}
 
 # TODO: a method for filtering out hits that do not contain a match to an optionally specified region on the viral
 # TODO: genome. this method should only run after integrations have been assigned IDs, to avoid filtering out flanking
@@ -459,7 +946,8 @@ def parse_args(sys_args: str) -> argparse.Namespace:
     # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers
     for name, subp in subparsers.choices.items():
         subp.add_argument("table_path", type=str,
-                          help="Path to input .dfam or .tbl file made up of query hits.")
+                          help="Path to input .dfam or .tbl file made up of query hits. Use - to read the table "
+                               "from stdin.")
         subp.add_argument("genome_path", type=str,
                           help="Path to target genome in .fasta format.")
         subp.add_argument("output_tsv_path", type=str,
@@ -473,6 +961,13 @@ def parse_args(sys_args: str) -> argparse.Namespace:
                                "With an input of 0.7, a hit's length must be at least 70%% of the length of "
                                "the full_threshold = args.full_thresholdhit's reference viral genome to be "
                                "considered full length.")
+        subp.add_argument("--resolve_overlaps", action="store_true",
+                          help="Remove redundant overlapping hits before parsing, as dfamscan.pl (.dfam) or "
+                               "bathscan.pl (.tbl) would. Set when table_path is a raw nhmmscan --dfamtblout or "
+                               "bathsearch --tblout table that hasn't been filtered by either script.")
+        subp.add_argument("--min_cov_frac", type=float, default=DEFAULT_MIN_COV_FRAC,
+                          help=f"Used with --resolve_overlaps. A hit is removed when at least this fraction of it is "
+                               f"covered by a single higher scoring hit. Default is {DEFAULT_MIN_COV_FRAC}.")
         subp.add_argument("--verbose", action="store_true",
                           help="Print additional information useful for debugging.")
         subp.add_argument("--force", action="store_true",
@@ -484,6 +979,16 @@ def parse_args(sys_args: str) -> argparse.Namespace:
     protein_parser.add_argument("--annotation_tsv", type=str, default="",
                                 help="Path to .tsv file containing information about the function of viral proteins "
                                      "used to annotate user-supplied viruses.")
+    protein_parser.add_argument("--split_by_target", action="store_true",
+                                help="Write one .tsv per sequence in genome_path, named after that sequence, to the "
+                                     "directory output_tsv_path. Set when genome_path holds a batch of viral genomes "
+                                     "that were scanned together.")
+    protein_parser.add_argument("--seq_lengths", type=str, default="",
+                                help="Path to tab-delimited file whose first two columns are the name and length of "
+                                     "each sequence in genome_path, such as a .fai index or a manifest from "
+                                     "split_phage_database.py. Used instead of running esl-seqstat. With "
+                                     "--split_by_target, every sequence listed gets a .tsv, and if this isn't set, "
+                                     "lengths are measured by reading genome_path once.")
     integration_parser.add_argument("--overlap_tolerance", type=int,
                                     help="As a result of significant mismatches/indels between user-provided viral seq "
                                          "and detected integrations, two consecutive hits mapping to one viral "
@@ -497,6 +1002,18 @@ def parse_args(sys_args: str) -> argparse.Namespace:
     integration_parser.add_argument("--minimum_length", type=int, default=0,
                                     help="Minimum length for a hit to be reported in .tsv output. For example, if set "
                                          "to 200, then hits less than 200bp long are filtered out.")
+    integration_parser.add_argument("--occurrence_path", type=str, default="",
+                                    help="Optional output file counting how many times each position of each reference "
+                                         "virus was detected. Written as binary if the path ends in .npz, compact "
+                                         ".json otherwise")
+    integration_parser.add_argument("--dense_occurrences", action="store_true",
+                                    help="Write --occurrence_path .json with one count per position of each virus, as "
+                                         "older versions of VIBES did")
+    integration_parser.add_argument("--snapshot_path", type=str, default="",
+                                    help="Optional output .npz file holding every hit in the table, before e-value and "
+                                         "length filters, and the length of each sequence hit. The rethreshold mode "
+                                         "rebuilds the output .tsv from snapshots with new thresholds, without the "
+                                         "table or genome")
     integration_parser.add_argument("--mandatory_regions_tsv", type=str, default="",
                                     help="Path to tab-delimited .tsv file where each line has a virus name, start "
                                          "coordinate (integer) on that viral genome, and end coordinate (integer). Any "
@@ -506,6 +1023,67 @@ def parse_args(sys_args: str) -> argparse.Namespace:
                                          "an especially important sequence, like a gene of interest or core viral "
                                          "genome.")
 
+    # rethreshold mode works from snapshots rather than a table and genome, so it's set up apart from the other modes
+    rethreshold_parser = subparsers.add_parser("rethreshold",
+                                               help="Rebuild integration .tsv files from snapshots written with "
+                                                    "integration_annotation --snapshot_path, applying new thresholds "
+                                                    "without reading any table or genome again.")
+    rethreshold_parser.add_argument("snapshot_paths", type=str, nargs="+",
+                                    help=f"Snapshot files, or directories containing *{SNAPSHOT_SUFFIX} snapshots")
+    rethreshold_parser.add_argument("output_dir", type=str,
+                                    help=f"Path to directory where a .tsv file is written for each snapshot, named "
+                                         f"after the snapshot without {SNAPSHOT_SUFFIX}. Created if it doesn't exist")
+    rethreshold_parser.add_argument("--max_evalue", type=float, default=default_eval,
+                                    help=f"Maximum allowed sequence e-value (must be >= 0). Default is {default_eval}.")
+    rethreshold_parser.add_argument("--full_threshold", type=float, required=True,
+                                    help="Minimum fraction of a hit's reference viral genome it, or its integration, "
+                                         "must cover to be labeled as full length.")
+    rethreshold_parser.add_argument("--overlap_tolerance", type=int, required=True,
+                                    help="Maximum overlap on the reference viral genome allowed between consecutive "
+                                         "hits assigned the same integration ID.")
+    rethreshold_parser.add_argument("--distance_threshold", type=float, required=True,
+                                    help="Maximum distance between consecutive hits assigned the same integration ID, "
+                                         "as a fraction of the length of their reference viral genome.")
+    rethreshold_parser.add_argument("--minimum_length", type=int, default=0,
+                                    help="Minimum length for a hit to be reported in .tsv output.")
+    rethreshold_parser.add_argument("--occurrence_dir", type=str, default="",
+                                    help="Optional directory where an .occurrences.npz file is written for each "
+                                         "snapshot, as integration_annotation --occurrence_path would")
+    rethreshold_parser.add_argument("--dense_occurrences", action="store_true",
+                                    help="Used with --occurrence_dir. Write occurrence counts with one count per "
+                                         "position of each virus")
+    rethreshold_parser.add_argument("--verbose", action="store_true",
+                                    help="Print additional information useful for debugging.")
+    rethreshold_parser.add_argument("--force", action="store_true",
+                                    help="If output files already exist, overwrite them.")
+
+    # sweep mode also works from snapshots, trying every combination of the thresholds given
+    sweep_parser = subparsers.add_parser("sweep",
+                                         help="Summarize the integrations called from snapshots written with "
+                                              "integration_annotation --snapshot_path under every combination of "
+                                              "the thresholds given. Snapshots are read and sorted once, however "
+                                              "many combinations are tried.")
+    sweep_parser.add_argument("snapshot_paths", type=str, nargs="+",
+                              help=f"Snapshot files, or directories containing *{SNAPSHOT_SUFFIX} snapshots")
+    sweep_parser.add_argument("output_tsv_path", type=str,
+                              help="Path to output .tsv with one line per combination of thresholds, counting hits, "
+                                   "integrations and full length calls across all snapshots and describing the "
+                                   "distribution of integration lengths on the bacterial genome")
+    sweep_parser.add_argument("--max_evalue", type=float, default=default_eval,
+                              help=f"Maximum allowed sequence e-value (must be >= 0). Default is {default_eval}.")
+    sweep_parser.add_argument("--full_thresholds", type=float, nargs="+", required=True,
+                              help="Full length thresholds to try, as fractions of the reference viral genome.")
+    sweep_parser.add_argument("--overlap_tolerances", type=int, nargs="+", required=True,
+                              help="Overlap tolerances to try, in positions on the reference viral genome.")
+    sweep_parser.add_argument("--distance_thresholds", type=float, nargs="+", required=True,
+                              help="Distance thresholds to try, as fractions of the reference viral genome length.")
+    sweep_parser.add_argument("--minimum_lengths", type=int, nargs="+", default=[0],
+                              help="Minimum hit lengths to try. Default is 0.")
+    sweep_parser.add_argument("--verbose", action="store_true",
+                              help="Print additional information useful for debugging.")
+    sweep_parser.add_argument("--force", action="store_true",
+                              help="If output files already exist, overwrite them.")
+
     return parser.parse_args()
 
 
@@ -519,6 +1097,35 @@ def do_cmd(cmd: str, verbose: bool) -> str:
 def _main():
     # TODO: Explanations
     args = parse_args(sys.argv[1:])
+    perf_timer.start(__file__, args.annotation_mode)
+
+    # rethreshold mode reads snapshots instead of a table and genome
+    if args.annotation_mode == "rethreshold":
+        if args.max_evalue < 0:
+            raise ValueError("--max_evalue must be used with an argument greater than or equal to 0")
+
+        snapshot_paths = get_snapshot_paths(args.snapshot_paths)
+        hit_count = rethreshold_snapshots(snapshot_paths, args.output_dir, args.occurrence_dir, args.full_threshold,
+                                          args.max_evalue, args.minimum_length, args.distance_threshold,
+                                          args.overlap_tolerance, args.dense_occurrences, args.force, args.verbose)
+
+        print(f"Wrote {hit_count} hits from {len(snapshot_paths)} snapshots to {args.output_dir}")
+        return
+
+    if args.annotation_mode == "sweep":
+        if args.max_evalue < 0:
+            raise ValueError("--max_evalue must be used with an argument greater than or equal to 0")
+
+        snapshot_paths = get_snapshot_paths(args.snapshot_paths)
+        hits = build_sweep_arrays(snapshot_paths, args.max_evalue, args.verbose)
+        rows = sweep_thresholds(hits, args.full_thresholds, args.overlap_tolerances, args.distance_thresholds,
+                                args.minimum_lengths)
+        write_sweep_summary_from_path(args.output_tsv_path, rows, args.force)
+
+        print(f"Summarized {len(rows)} threshold combinations from {len(snapshot_paths)} snapshots to "
+              f"{args.output_tsv_path}")
+        return
+
     table_path = args.table_path
     genome_path = args.genome_path
     tsv_path = args.output_tsv_path
@@ -528,6 +1135,8 @@ def _main():
     max_eval = args.max_evalue
     verbose = args.verbose
     force = args.force
+    resolve_overlaps = args.resolve_overlaps
+    min_cov_frac = args.min_cov_frac
 
     # check that inputs are legal
     if max_eval < 0:
@@ -540,23 +1149,30 @@ def _main():
         max_gap_percent = args.distance_threshold
         minimum_length = args.minimum_length
 
-        # parse table for information on hits detected on query
-        query_hits = parse_table_from_path(table_path, genome_path, full_threshold, max_eval,
-                                           table_mode, verbose, minimum_len=minimum_length)
-
-        # sort list to ensure that any hits from the same integration are next to each other
-        sort_hit_list(query_hits)
+        if args.snapshot_path:
+            # every hit is parsed so it can go in the snapshot, and the filters are applied afterwards, which keeps the
+            # same hits as filtering while parsing
+            query_hits = parse_table_from_path(table_path, genome_path, full_threshold, math.inf, table_mode, verbose,
+                                               resolve_overlaps=resolve_overlaps, min_cov_frac=min_cov_frac)
+            write_hit_snapshot_from_path(args.snapshot_path, query_hits, genome_path, table_mode, resolve_overlaps,
+                                         min_cov_frac, force)
+            query_hits = filter_hits(query_hits, max_eval, minimum_length)
 
-        # examine sorted hits to determine if any of them are part of one integration broken up over multiple hits
-        integration_id_dict = assign_integration_ids(query_hits, max_gap_percent, overlap_tolerance)
+        else:
+            # parse table for information on hits detected on query
+            query_hits = parse_table_from_path(table_path, genome_path, full_threshold, max_eval,
+                                               table_mode, verbose, minimum_len=minimum_length,
+                                               resolve_overlaps=resolve_overlaps, min_cov_frac=min_cov_frac)
 
-        # check whether any integrations broken up over multiple hits cover enough of their reference viral genome to be
-        # considered full length. If so, set each constituent hit to full_length = True
-        set_integration_full_length(integration_id_dict, full_threshold)
+        # group hits from the same integration and label full length integrations
+        merge_integrations(query_hits, max_gap_percent, overlap_tolerance, full_threshold)
 
         # write output
         write_tsv_from_path(tsv_path, query_hits, annotation_mode, force)
 
+        if args.occurrence_path:
+            write_occurrence_json_from_path(args.occurrence_path, query_hits, force, args.dense_occurrences)
+
     # annotation mode
     elif annotation_mode == "protein_annotation":
         # parse mode-specific arguments
@@ -567,10 +1183,22 @@ def _main():
         if protein_annotation_path:
             protein_annotations = parse_protein_annotation_from_path(protein_annotation_path, verbose)
 
+        seq_lengths = None
+
+        if args.seq_lengths:
+            seq_lengths = read_seq_lengths(args.seq_lengths, genome_path, verbose)
+        elif args.split_by_target:
+            seq_lengths = measure_seq_lengths(genome_path, verbose)
+
         query_hits = parse_table_from_path(table_path, genome_path, full_threshold, max_eval, table_mode, verbose,
-                                           annotations=protein_annotations)
+                                           annotations=protein_annotations, resolve_overlaps=resolve_overlaps,
+                                           min_cov_frac=min_cov_frac, seq_lengths=seq_lengths)
 
-        write_tsv_from_path(tsv_path, query_hits, annotation_mode, force)
+        if args.split_by_target:
+            # output_tsv_path is a directory holding one .tsv per sequence
+            write_split_protein_tsvs(tsv_path, query_hits, seq_lengths, genome_path, force, verbose)
+        else:
+            write_tsv_from_path(tsv_path, query_hits, annotation_mode, force)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import atexit
+import fcntl
+import hashlib
+import importlib
+import json
+import locale
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from os import path
+from typing import *
+
+# Runs short Python steps of the workflow without paying for interpreter startup, NumPy import and module loading in
+# every task. 'serve' starts a worker that imports the scripts below once and listens on a Unix socket. 'run' sends a
+# script's arguments, working directory, environment and standard input/output/error to the worker, which forks a copy
+# of itself to run the script's entry point exactly as the standalone script would, so output files are the same. Each
+# task gets its own fork, so tasks run in parallel and can't see each other's state.
+#
+# If no worker is listening, 'run' replaces itself with the standalone script, and with --start also launches a worker
+# in the background for later tasks. Workers are node-local and exit after --idle_timeout seconds without tasks. A task
+# whose worker runs in a container, or in a scheduler job that ends with the task, won't outlive that task.
+
+BIN_DIR = path.dirname(path.abspath(__file__))
+
+# scripts the worker can run, and the function each one's command line entry point calls
+WORKER_SCRIPTS = {"table_parser.py": "_main", "change_contig_ids.py": "_main", "sum_occurrences.py": "_main",
+                  "parse.py": "main"}
+
+SOCKET_VARIABLE = "VIBES_WORKER_SOCKET"
+DEFAULT_IDLE_TIMEOUT = 300
+# how often the worker wakes up to reap finished tasks and check whether it has been idle too long, in seconds
+POLL_INTERVAL = 1
+
+# messages are a 4-byte length followed by that many bytes of JSON. The client's stdin, stdout and stderr file
+# descriptors travel with the request
+MESSAGE_HEADER = struct.Struct("!I")
+STANDARD_FDS = [0, 1, 2]
+
+
+def get_default_socket_path() -> str:
+    # keyed on the interpreter and on the location and modification times of the scripts, so a task never reaches a
+    # worker that loaded an older copy of them
+    key = hashlib.sha1(f"{sys.executable}\t{BIN_DIR}".encode())
+
+    for script_name in sorted(os.listdir(BIN_DIR)):
+        if script_name.endswith(".py"):
+            script_stat = os.stat(path.join(BIN_DIR, script_name))
+            key.update(f"\t{script_name}:{script_stat.st_mtime_ns}:{script_stat.st_size}".encode())
+
+    return path.join(tempfile.gettempdir(), f"vibes_worker_{os.getuid()}_{key.hexdigest()[:16]}.sock")
+
+
+def receive_exactly(conn: socket.socket, size: int) -> bytes:
+    data = b""
+
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed partway through a message")
+        data += chunk
+
+    return data
+
+
+def send_message(conn: socket.socket, message: Dict[str, Any], fds: List[int] = ()) -> None:
+    data = json.dumps(message).encode()
+    payload = MESSAGE_HEADER.pack(len(data)) + data
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if fds else []
+
+    sent = conn.sendmsg([payload], ancillary)
+    conn.sendall(payload[sent:])
+
+
+def receive_message(conn: socket.socket) -> Tuple[Optional[Dict[str, Any]], List[int]]:
+    # returns None as the message if the connection was closed before a new message started
+    fds = array.array("i")
+    # any file descriptors arrive with the first bytes of the message
+    header, ancillary, _, _ = conn.recvmsg(MESSAGE_HEADER.size, socket.CMSG_LEN(len(STANDARD_FDS) * fds.itemsize))
+
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+
+    if not header:
+        return None, list(fds)
+
+    header += receive_exactly(conn, MESSAGE_HEADER.size - len(header))
+    message_size = MESSAGE_HEADER.unpack(header)[0]
+
+    return json.loads(receive_exactly(conn, message_size)), list(fds)
+
+
+def load_entry_points(verbose: bool) -> Dict[str, Callable[[], Any]]:
+    entry_points = {}
+
+    for script_name, function_name in WORKER_SCRIPTS.items():
+        # a script whose dependencies aren't installed here (NumPy in some containers, for instance) is left to run
+        # standalone, where it fails the same way it always would
+        try:
+            module = importlib.import_module(script_name[:-len(".py")])
+        except ImportError as error:
+            if verbose:
+                print(f"Unable to load {script_name}: {error}", file=sys.stderr)
+            continue
+
+        entry_points[script_name] = getattr(module, function_name)
+
+    if verbose:
+        print(f"Loaded {', '.join(entry_points)}", file=sys.stderr)
+
+    return entry_points
+
+
+def get_exit_status(code: Any) -> int:
+    # mirrors how the interpreter turns the argument of sys.exit() into an exit status
+    if code is None:
+        return 0
+
+    if isinstance(code, int):
+        return code
+
+    print(code, file=sys.stderr)
+
+    return 1
+
+
+def watch_client(conn: socket.socket) -> None:
+    # the client never sends anything after its request, so a read only returns once it has gone away, for instance
+    # because Nextflow killed the task. There's no one left to report to, so stop the task too
+    try:
+        conn.recv(1)
+    except OSError:
+        pass
+
+    os._exit(1)
+
+
+def run_task(conn: socket.socket, entry_points: Dict[str, Callable[[], Any]]) -> None:
+    request, fds = receive_message(conn)
+
+    if request is None or request.get("script") not in entry_points or len(fds) != len(STANDARD_FDS):
+        return
+
+    # take on the client's stdin, stdout and stderr, so the script reads and writes the task's own streams
+    for target_fd, fd in zip(STANDARD_FDS, fds):
+        os.dup2(fd, target_fd)
+        if fd != target_fd:
+            os.close(fd)
+
+    send_message(conn, {"started": True})
+    threading.Thread(target=watch_client, args=(conn,), daemon=True).start()
+
+    os.environ.clear()
+    os.environ.update(request["environment"])
+    # the interpreter also ignores a locale it can't set at startup
+    try:
+        locale.setlocale(locale.LC_CTYPE, "")
+    except locale.Error:
+        pass
+
+    os.chdir(request["work_dir"])
+    os.umask(request["umask"])
+
+    script_name = request["script"]
+    sys.argv = [path.join(BIN_DIR, script_name)] + request["arguments"]
+    exit_status = 0
+
+    try:
+        entry_points[script_name]()
+    except SystemExit as error:
+        exit_status = get_exit_status(error.code)
+    except BaseException:
+        traceback.print_exc()
+        exit_status = 1
+
+    # os._exit() skips exit handlers, such as the one perf_timer.py registers, so run them here
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    send_message(conn, {"exit_status": exit_status})
+
+
+def reap_tasks(task_pids: Set[int]) -> None:
+    for pid in list(task_pids):
+        finished_pid, _ = os.waitpid(pid, os.WNOHANG)
+        if finished_pid:
+            task_pids.remove(pid)
+
+
+def serve(socket_path: str, idle_timeout: float, verbose: bool) -> None:
+    # only one worker serves each socket. If several tasks start one at once, the rest exit here
+    lock_file = open(f"{socket_path}.lock", "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        if verbose:
+            print(f"A worker is already serving {socket_path}", file=sys.stderr)
+        lock_file.close()
+        return
+
+    entry_points = load_entry_points(verbose)
+
+    # a worker that was killed leaves its socket file behind
+    if path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the worker may connect to it
+    old_umask = os.umask(0o177)
+    server.bind(socket_path)
+    os.umask(old_umask)
+    server.listen()
+    server.settimeout(POLL_INTERVAL)
+
+    if verbose:
+        print(f"Listening on {socket_path}", file=sys.stderr)
+
+    task_pids = set()
+    last_active = time.monotonic()
+
+    try:
+        while True:
+            reap_tasks(task_pids)
+
+            if task_pids:
+                last_active = time.monotonic()
+            elif time.monotonic() - last_active > idle_timeout:
+                break
+
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+
+            conn.settimeout(None)
+            pid = os.fork()
+
+            if pid == 0:
+                # the forked task only needs its own connection
+                server.close()
+                lock_file.close()
+
+                try:
+                    run_task(conn, entry_points)
+                finally:
+                    os._exit(0)
+
+            conn.close()
+            task_pids.add(pid)
+            last_active = time.monotonic()
+    finally:
+        # clients waiting to be accepted see the connection close before their task starts, and run it themselves
+        server.close()
+        os.remove(socket_path)
+        lock_file.close()
+
+    if verbose:
+        print(f"Worker on {socket_path} exiting after {idle_timeout} seconds without tasks", file=sys.stderr)
+
+
+def start_worker(socket_path: str, idle_timeout: float) -> None:
+    # started in its own session, with none of the task's streams open, so it outlives the task that started it and
+    # doesn't hold the task's output open
+    subprocess.Popen([sys.executable, path.abspath(__file__), "serve", "--socket", socket_path, "--idle_timeout",
+                      str(idle_timeout)], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return umask
+
+
+def run_on_worker(socket_path: str, script_name: str, arguments: List[str]) -> Optional[int]:
+    # returns the script's exit status, or None if the worker closed the connection before starting the script
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+
+        request = {"script": script_name, "arguments": arguments, "work_dir": os.getcwd(),
+                   "environment": dict(os.environ), "umask": get_umask()}
+        send_message(client, request, STANDARD_FDS)
+
+        if receive_message(client)[0] is None:
+            return None
+
+        try:
+            reply = receive_message(client)[0]
+        except ConnectionError:
+            reply = None
+
+        if reply is None:
+            print(f"Worker on {socket_path} exited while running {script_name}", file=sys.stderr)
+            return 1
+
+        return reply["exit_status"]
+
+
+def run_script(script_name: str, arguments: List[str], socket_path: str, start: bool, idle_timeout: float,
+               verbose: bool) -> int:
+    if script_name not in WORKER_SCRIPTS:
+        raise ValueError(f"{script_name} can't be run by the worker. Choose from: {', '.join(WORKER_SCRIPTS)}")
+
+    exit_status = None
+
+    try:
+        exit_status = run_on_worker(socket_path, script_name, arguments)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if verbose:
+            print(f"No worker listening on {socket_path}", file=sys.stderr)
+
+        if start:
+            start_worker(socket_path, idle_timeout)
+
+    if exit_status is None:
+        if verbose:
+            print(f"Running {script_name} as a standalone script", file=sys.stderr)
+
+        script_path = path.join(BIN_DIR, script_name)
+        os.execv(sys.executable, [sys.executable, script_path] + arguments)
+
+    return exit_status
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Runs short VIBES Python scripts in a persistent worker "
+                                                           "process that keeps their modules loaded")
+    subparsers = parser.add_subparsers(dest="worker_mode", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Start a worker that runs scripts sent to it by 'run'")
+
+    run_parser = subparsers.add_parser("run", help="Run a script on the worker, or as a standalone script if no worker "
+                                                   "is listening")
+    run_parser.add_argument("--start", action="store_true",
+                            help="If no worker is listening, start one in the background for later tasks")
+    run_parser.add_argument("script", type=str, choices=list(WORKER_SCRIPTS), help="Script to run")
+    run_parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments passed on to the script")
+
+    # subparsers have independent lists of arguments. To set common arguments, loop over the subparsers
+    for subparser in [serve_parser, run_parser]:
+        subparser.add_argument("--socket", type=str, default=os.environ.get(SOCKET_VARIABLE, ""),
+                               help=f"Path to the worker's Unix socket. Defaults to ${SOCKET_VARIABLE} if set, "
+                                    f"otherwise to a path in the temporary directory that is unique to this user, "
+                                    f"interpreter and version of the scripts")
+        subparser.add_argument("--idle_timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                               help=f"Seconds a worker waits without tasks before exiting (default "
+                                    f"{DEFAULT_IDLE_TIMEOUT})")
+        subparser.add_argument("--verbose", action="store_true",
+                               help="Print additional information useful for debugging to stderr")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    socket_path = args.socket or get_default_socket_path()
+
+    if args.idle_timeout < 0:
+        raise ValueError("--idle_timeout must be used with an argument greater than or equal to 0")
+
+    if args.worker_mode == "serve":
+        serve(socket_path, args.idle_timeout, args.verbose)
+
+    elif args.worker_mode == "run":
+        sys.exit(run_script(args.script, args.script_args, socket_path, args.start, args.idle_timeout, args.verbose))
+
+
+if __name__ == "__main__":
+    _main()
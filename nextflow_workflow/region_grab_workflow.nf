@@ -4,6 +4,9 @@ tsv_files = Channel.fromPath(params.tsv_files)
 element = params.element
 genome_dir = params.genome_dir
 run_bakta = params.run_bakta
+// in batch mode, every tsv is handled by one task and overlapping regions are merged before being annotated
+batch_mode = params.batch_mode
+elements = params.elements ?: [element]
 nextflow.enable.dsl = 2
 
 
@@ -18,6 +21,7 @@ process get_regions {
 
     // note: ${tsv_file.baseName below will have to become tsv_file.simpleName}.fasta once the .fasta.tsv bug has been addressed
     """
+    PYTHONPATH="${projectDir}/bin\${PYTHONPATH:+:\$PYTHONPATH}" \
     python3 ${params.program_dir}/region_grabber.py \
         "${tsv_file}" \
         "${genome_dir}/${tsv_file.baseName}" \
@@ -28,6 +32,32 @@ process get_regions {
     """
 }
 
+process get_regions_batch {
+    publishDir('output/regions/', mode: "copy")
+
+    input:
+    path manifest
+
+    output:
+    path "merged_regions.fasta", emit: region_channel
+    path "region_mapping.tsv", emit: mapping_channel
+
+    script:
+    def element_args = elements.collect { "\"${it}\"" }.join(" ")
+
+    """
+    PYTHONPATH="${projectDir}/bin\${PYTHONPATH:+:\$PYTHONPATH}" \
+    python3 ${params.program_dir}/region_grabber.py \
+        batch \
+        "${manifest}" \
+        merged_regions.fasta \
+        region_mapping.tsv \
+        --elements ${element_args} \
+        --verbose \
+        --force
+    """
+}
+
 process bakta_annotation {
     publishDir('output/annotated_regions/', mode: "copy")
 
@@ -52,7 +82,22 @@ process bakta_annotation {
 }
 
 workflow {
-    regions_channel = get_regions(tsv_files) | filter {it.size() > 0} // remove any empty files with no element hits
+    if (batch_mode) {
+        // each manifest line holds a tsv and the genome it's based on (see get_regions for the .fasta.tsv naming)
+        manifest = tsv_files
+            .map { "${it}\t${genome_dir}/${it.baseName}" }
+            .collectFile(name: "region_manifest.tsv", newLine: true)
+
+        get_regions_batch(manifest)
+
+        // one Bakta task per unique merged region
+        regions_channel = get_regions_batch.out.region_channel
+            | filter {it.size() > 0}
+            | splitFasta(by: 1, file: true)
+    }
+    else {
+        regions_channel = get_regions(tsv_files) | filter {it.size() > 0} // remove any empty files with no element hits
+    }
 
     if (run_bakta) // if true, run bakta to annotate
         bakta_annotation(regions_channel)
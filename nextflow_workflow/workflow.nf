@@ -39,6 +39,36 @@ overlap_tolerance = params.overlap_tolerance
 integration_distance_threshold = params.integration_distance_threshold
 integration_minimum_length = params.integration_minimum_length
 
+incremental_store = params.incremental_store
+fuse_table_parsing = params.fuse_table_parsing
+python_overlap_filter = params.python_overlap_filter
+debug_mode = params.debug_mode
+
+scan_cache_dir = params.scan_cache_dir
+scan_cache_max_gb = params.scan_cache_max_gb
+
+// with python_overlap_filter, scan processes hand raw tables to table_parser.py, which removes redundant hits itself
+// instead of dfamscan.pl or bathscan.pl doing so in the scan task
+scanned_dfam_suffix = python_overlap_filter ? "dfam" : "scanned.dfam"
+scanned_tbl_suffix = python_overlap_filter ? "tbl" : "scanned.tbl"
+resolve_overlaps_flag = python_overlap_filter ? "--resolve_overlaps" : ""
+
+occurrence_counts = params.occurrence_counts
+occurrence_store = params.occurrence_store
+occurrence_batch_size = params.occurrence_batch_size
+
+hit_snapshots = params.hit_snapshots
+
+bath_batch_size = params.bath_batch_size
+
+// with python_worker, short Python steps are sent to a worker process on the node that keeps their modules loaded,
+// instead of starting a new interpreter in every task
+python_runner = params.python_worker ? "vibes_worker.py run --start " : ""
+
+prefilter_kmer_size = params.prefilter_kmer_size
+prefilter_sketch_scale = params.prefilter_sketch_scale
+prefilter_min_shared_kmers = params.prefilter_min_shared_kmers
+
 
 process hmm_build {
     cpus { hmmbuild_cpus * task.attempt }
@@ -69,7 +99,81 @@ process hmm_build {
     """
 }
 
+process build_kmer_index {
+    cpus 1
+    time '1h'
+
+    input:
+    path phage_file
+
+    output:
+    path "${phage_file.simpleName}.kmer_index"
+
+    """
+    kmer_prefilter.py \
+        build \
+        --kmer_size ${prefilter_kmer_size} \
+        --sketch_scale ${prefilter_sketch_scale} \
+        "${phage_file}" \
+        "${phage_file.simpleName}.kmer_index"
+    """
+}
+
+// writes the filtered genome to a subdirectory so it keeps the original file name, which later processes use to name
+// their output
+process kmer_prefilter {
+    tag "${genome_file.simpleName}"
+    cpus 1
+    time '1h'
+
+    publishDir "${output_path}/prefilter/", mode: "copy", pattern: "*.prefilter.tsv"
+
+    input:
+    path genome_file
+    path kmer_index
+
+    output:
+    path "filtered/${genome_file.name}", emit: genomes
+    path "${genome_file.simpleName}.prefilter.tsv", emit: reports
+
+    """
+    mkdir filtered
+
+    kmer_prefilter.py \
+        filter \
+        --min_shared_kmers ${prefilter_min_shared_kmers} \
+        "${kmer_index}" \
+        "${genome_file}" \
+        "filtered/${genome_file.name}" \
+        "${genome_file.simpleName}.prefilter.tsv"
+    """
+}
+
+process validate_prefilter {
+    tag "${genome_name}"
+    cpus 1
+    time '1h'
+
+    publishDir "${output_path}/prefilter/validation/", mode: "copy", pattern: "*.tsv"
+
+    input:
+    tuple val(genome_name), path(prefilter_report), path(scanned_table_file)
+
+    output:
+    path "${genome_name}.validation.tsv"
+
+    """
+    kmer_prefilter.py \
+        validate \
+        "${prefilter_report}" \
+        "${scanned_table_file}" \
+        "${scanned_table_file.extension}" \
+        "${genome_name}.validation.tsv"
+    """
+}
+
 process nhmmscan {
+    tag "${genome_file.simpleName}"
     cpus nhmmscan_cpus
     time { nhmmscan_time.hour * task.attempt }
     memory { nhmmscan_memory.GB * task.attempt }
@@ -87,19 +191,239 @@ process nhmmscan {
 
     output:
     path genome_file, emit: genomes
-    path "*.scanned.dfam", emit: tables
+    path "${genome_file.simpleName}.${scanned_dfam_suffix}", emit: tables
 
+    script:
+    def filter_commands = python_overlap_filter ? "" : """
+    dfamscan.pl \
+    --dfam_infile ${genome_file.simpleName}.dfam \
+    --dfam_outfile ${genome_file.simpleName}.scanned.dfam
     """
+
+    def scan_commands = """
     nhmmscan \
     --cpu ${task.cpus} \
     --dfamtblout ${genome_file.simpleName}.dfam \
     ${hmm_file} \
     ${genome_file}
+    ${filter_commands}
+    """
+
+    if (scan_cache_dir)
+        // the cache key covers the genome, the profile database, the HMMER version, dfamscan.pl (when it's run) and
+        // the search options above, so a change to any of them is a cache miss
+        """
+        cache_key=\$(scan_cache.py key \
+            --file ${genome_file} \
+            --file ${hmm_file} \
+            ${python_overlap_filter ? '' : '--file \$(which dfamscan.pl)'} \
+            --param "\$(nhmmscan -h | grep -m 1 '^# HMMER')" \
+            --param "nhmmscan --dfamtblout ${python_overlap_filter ? '' : '| dfamscan.pl'}")
+
+        if ! scan_cache.py get ${scan_cache_dir} \$cache_key ${genome_file.simpleName}.${scanned_dfam_suffix}; then
+        ${scan_commands}
+        scan_cache.py put \
+        --max_size_gb ${scan_cache_max_gb} \
+        ${scan_cache_dir} \
+        \$cache_key \
+        ${genome_file.simpleName}.${scanned_dfam_suffix}
+        fi
+        """
+    else
+        scan_commands
+}
+
+process diff_phage_database {
+    cpus 1
+    time '1h'
+
+    input:
+    path phage_file
+    val store_dir
+
+    output:
+    path "new_phages.fasta", emit: new_phages
+    path "phage_manifest.tsv", emit: manifest
+    path "removed_phages.txt", emit: removed
+
+    """
+    incremental_scan.py \
+        diff \
+        "${phage_file}" \
+        "${store_dir}/phage_manifest.tsv" \
+        new_phages.fasta \
+        phage_manifest.tsv \
+        removed_phages.txt
+    """
+}
+
+// builds one HMM database per input tuple. kind is "new" for phages added since the last incremental run and "full"
+// for the whole phage database, which is only needed for genomes that have never been scanned. If there are no new
+// phages, empty placeholder files are emitted and no scan is run against them
+process incremental_hmm_build {
+    cpus { hmmbuild_cpus * task.attempt }
+    time { hmmbuild_time.hour * task.attempt }
+    memory { hmmbuild_memory.GB * task.attempt}
+
+    errorStrategy 'retry'
+    maxRetries 2
+
+    input:
+    tuple val(kind), path(seq_file)
+
+    output:
+    tuple val(kind), path("${kind}.hmm"), path("${kind}.hmm.h3f"), path("${kind}.hmm.h3i"), path("${kind}.hmm.h3m"),
+        path("${kind}.hmm.h3p")
+
+    """
+    if [ -s "${seq_file}" ]; then
+        hmmbuild_mult_seq.py \
+            --cpu ${task.cpus} \
+            --seq_type ${seq_type} \
+            --temp_folder ./ \
+            "${seq_file}" \
+            "${kind}.hmm"
+    else
+        touch ${kind}.hmm ${kind}.hmm.h3f ${kind}.hmm.h3i ${kind}.hmm.h3m ${kind}.hmm.h3p
+    fi
+    """
+}
+
+// scans a genome against either the new phages or (for genomes missing from the store) the full database, merges the
+// hits into the genome's stored unfiltered table and reruns overlap resolution on the merged table. changed is "true"
+// when the merged table differs from the stored one
+process incremental_nhmmscan {
+    tag "${genome_file.simpleName}"
+    cpus nhmmscan_cpus
+    time { nhmmscan_time.hour * task.attempt }
+    memory { nhmmscan_memory.GB * task.attempt }
+
+    errorStrategy 'retry'
+    maxRetries 2
+
+    publishDir "${incremental_store}/raw_tables/", mode: "copy", pattern: "${genome_file.simpleName}.dfam"
+
+    input:
+    tuple path(genome_file), val(kind), path(hmm_file), path(h3f_file), path(h3i_file), path(h3m_file), path(h3p_file)
+    path removed_phages
+
+    output:
+    tuple path(genome_file), path("${genome_file.simpleName}.${scanned_dfam_suffix}"), env(changed), emit: tables
+    path "${genome_file.simpleName}.dfam", emit: raw_tables
 
+    script:
+    def filter_commands = python_overlap_filter ? "" : """
     dfamscan.pl \
     --dfam_infile ${genome_file.simpleName}.dfam \
     --dfam_outfile ${genome_file.simpleName}.scanned.dfam
     """
+
+    """
+    if [ -s ${hmm_file} ]; then
+        nhmmscan \
+        --cpu ${task.cpus} \
+        --dfamtblout new_hits.dfam \
+        ${hmm_file} \
+        ${genome_file}
+    else
+        touch new_hits.dfam
+    fi
+
+    changed=\$(incremental_scan.py \
+        merge \
+        --stored_table "${incremental_store}/raw_tables/${genome_file.simpleName}.dfam" \
+        --removed ${removed_phages} \
+        new_hits.dfam \
+        ${genome_file.simpleName}.dfam)
+    ${filter_commands}
+    """
+}
+
+// the manifest is only written to the store once every genome's table has been updated, so an interrupted run is
+// redone in full on the next attempt rather than leaving tables out of step with the manifest
+process update_phage_manifest {
+    cpus 1
+    time '1h'
+
+    publishDir "${incremental_store}/", mode: "copy"
+
+    input:
+    path manifest
+    // unused, but forces this process to wait until all stored tables are updated
+    val raw_tables
+
+    output:
+    path manifest
+
+    """
+    echo "Updating phage manifest in ${incremental_store}"
+    """
+}
+
+// runs nhmmscan, dfamscan.pl and table_parser.py as one pipe, so the only file staged out is the final integration
+// .tsv. In debug mode, the unfiltered and filtered tables are also kept
+process nhmmscan_fused {
+    tag "${genome_file.simpleName}"
+    cpus nhmmscan_cpus
+    time { nhmmscan_time.hour * task.attempt }
+    memory { nhmmscan_memory.GB * task.attempt }
+
+    errorStrategy 'retry'
+    maxRetries 2
+
+    publishDir "${output_path}/tsv/bacterial_integrations/", mode: "copy", pattern: "*.tsv"
+    publishDir "${output_path}/snapshots/", mode: "copy", pattern: "*.snapshot.npz"
+    publishDir "${output_path}/debug/scan_tables/", mode: "copy", pattern: "*.dfam", enabled: debug_mode
+
+    input:
+    path genome_file
+    path hmm_file
+    path h3f_file
+    path h3i_file
+    path h3m_file
+    path h3p_file
+
+    output:
+    path "${genome_file.simpleName}.tsv", emit: tsv_files
+    path "${genome_file.simpleName}.${scanned_dfam_suffix}", optional: true, emit: tables
+    path "${genome_file.simpleName}.occurrences.npz", optional: true, emit: occurrences
+    path "${genome_file.simpleName}.snapshot.npz", optional: true, emit: snapshots
+
+    script:
+    def occurrence_option = occurrence_counts ? "--occurrence_path ${genome_file.simpleName}.occurrences.npz" : ""
+    def snapshot_option = hit_snapshots ? "--snapshot_path ${genome_file.simpleName}.snapshot.npz" : ""
+    def keep_raw_table = debug_mode ? "| tee ${genome_file.simpleName}.dfam" : ""
+    def keep_scanned_table = debug_mode ? "| tee ${genome_file.simpleName}.scanned.dfam" : ""
+    def filter_commands = python_overlap_filter ? "" : """| dfamscan.pl \
+    --dfam_infile /dev/stdin \
+    --dfam_outfile /dev/stdout \
+    ${keep_scanned_table} \
+    """
+
+    """
+    set -o pipefail
+
+    nhmmscan \
+    --cpu ${task.cpus} \
+    -o /dev/null \
+    --dfamtblout /dev/stdout \
+    ${hmm_file} \
+    ${genome_file} \
+    ${keep_raw_table} \
+    ${filter_commands}| ${python_runner}table_parser.py \
+        integration_annotation \
+        ${resolve_overlaps_flag} \
+        --full_threshold ${integration_full_threshold} \
+        --overlap_tolerance ${overlap_tolerance} \
+        --distance_threshold ${integration_distance_threshold} \
+        --minimum_length ${integration_minimum_length} \
+        ${occurrence_option} \
+        ${snapshot_option} \
+        - \
+        "${genome_file}" \
+        "${genome_file.simpleName}.tsv" \
+        dfam
+    """
 }
 
 process bathconvert {
@@ -126,6 +450,7 @@ process bathconvert {
 
 
 process bathsearch {
+    tag "${genome_file.simpleName}"
     cpus bathsearch_cpus
     time { bathsearch_time.hour * task.attempt }
     memory { bathsearch_memory.GB * task.attempt}
@@ -139,43 +464,79 @@ process bathsearch {
 
     output:
     path genome_file, emit: genomes
-    path "*.scanned.tbl", emit: tables
+    path "${genome_file.simpleName}.${scanned_tbl_suffix}", emit: tables
 
+    script:
+    def filter_commands = python_overlap_filter ? "" : """
+    bathscan.pl \
+    --infile ${genome_file.simpleName}.tbl \
+    --outfile ${genome_file.simpleName}.scanned.tbl
     """
+
+    def scan_commands = """
     bathsearch \
     -o /dev/null \
     --cpu ${task.cpus} \
     --tblout ${genome_file.simpleName}.tbl \
     ${hmm_file} \
     ${genome_file}
-
-    bathscan.pl \
-    --infile ${genome_file.simpleName}.tbl \
-    --outfile ${genome_file.simpleName}.scanned.tbl
+    ${filter_commands}
     """
+
+    if (scan_cache_dir)
+        """
+        cache_key=\$(scan_cache.py key \
+            --file ${genome_file} \
+            --file ${hmm_file} \
+            ${python_overlap_filter ? '' : '--file \$(which bathscan.pl)'} \
+            --param "\$(bathsearch -h | head -n 2)" \
+            --param "bathsearch --tblout ${python_overlap_filter ? '' : '| bathscan.pl'}")
+
+        if ! scan_cache.py get ${scan_cache_dir} \$cache_key ${genome_file.simpleName}.${scanned_tbl_suffix}; then
+        ${scan_commands}
+        scan_cache.py put \
+        --max_size_gb ${scan_cache_max_gb} \
+        ${scan_cache_dir} \
+        \$cache_key \
+        ${genome_file.simpleName}.${scanned_tbl_suffix}
+        fi
+        """
+    else
+        scan_commands
 }
 
 process reformat_integrations {
+    tag "${genome_file.simpleName}"
     cpus ri_cpus
     time ri_time.hour
     memory ri_memory.GB
 
     publishDir "${output_path}/tsv/bacterial_integrations/", mode: "copy", pattern: "*.tsv"
+    publishDir "${output_path}/snapshots/", mode: "copy", pattern: "*.snapshot.npz"
 
     input:
     path genome_file
     path scanned_table_file
 
     output:
-    path "${genome_file.simpleName}.tsv"
+    path "${genome_file.simpleName}.tsv", emit: tsv_files
+    path "${genome_file.simpleName}.occurrences.npz", optional: true, emit: occurrences
+    path "${genome_file.simpleName}.snapshot.npz", optional: true, emit: snapshots
+
+    script:
+    def occurrence_option = occurrence_counts ? "--occurrence_path ${genome_file.simpleName}.occurrences.npz" : ""
+    def snapshot_option = hit_snapshots ? "--snapshot_path ${genome_file.simpleName}.snapshot.npz" : ""
 
     """
-    table_parser.py \
+    ${python_runner}table_parser.py \
         integration_annotation \
+        ${resolve_overlaps_flag} \
         --full_threshold ${integration_full_threshold} \
         --overlap_tolerance ${overlap_tolerance} \
         --distance_threshold ${integration_distance_threshold} \
         --minimum_length ${integration_minimum_length} \
+        ${occurrence_option} \
+        ${snapshot_option} \
         "${scanned_table_file}" \
         "${genome_file}" \
         "${genome_file.simpleName}.tsv" \
@@ -185,6 +546,7 @@ process reformat_integrations {
 
 
 process reformat_proteins {
+    tag "${genome_file.simpleName}"
     cpus rp_cpus
     time rp_time.hour
     memory rp_memory.GB
@@ -200,8 +562,9 @@ process reformat_proteins {
     path "${genome_file.simpleName}.tsv"
 
     """
-    table_parser.py \
+    ${python_runner}table_parser.py \
         protein_annotation \
+        ${resolve_overlaps_flag} \
         --annotation_tsv ${protein_annotations} \
         --full_threshold ${integration_full_threshold} \
         ${scanned_table_file} \
@@ -211,20 +574,114 @@ process reformat_proteins {
     """
 }
 
+// splits phage_file into batches of bath_batch_size genomes in one pass, with a manifest of each genome's ID, length and
+// batch file
+process split_phages {
+    cpus 1
+    time '1h'
+
+    input:
+    path phage_file
+
+    output:
+    path "phage_batches/*.fasta", emit: batches
+    path "phage_manifest.tsv", emit: manifest
+
+    """
+    split_phage_database.py \
+        --batch_size ${bath_batch_size} \
+        ${phage_file} \
+        phage_batches \
+        phage_manifest.tsv
+    """
+}
+
+// splits one table of protein hits on a batch of viral genomes into one .tsv per viral genome, matching what
+// reformat_proteins writes for a single genome. Genome lengths are looked up in the manifest written by split_phages,
+// rather than with esl-seqstat
+process reformat_protein_batch {
+    tag "${genome_batch.simpleName}"
+    cpus rp_cpus
+    time rp_time.hour
+    memory rp_memory.GB
+
+    publishDir "${output_path}/tsv/viral_gene_annotations", mode: "copy", pattern: "*.tsv"
+
+    input:
+    path genome_batch
+    path scanned_table_file
+    path protein_annotations
+    path phage_manifest
+
+    output:
+    path "*.tsv", emit: tsv_files
+
+    """
+    ${python_runner}table_parser.py \
+        protein_annotation \
+        ${resolve_overlaps_flag} \
+        --split_by_target \
+        --seq_lengths ${phage_manifest} \
+        --annotation_tsv ${protein_annotations} \
+        --full_threshold ${integration_full_threshold} \
+        ${scanned_table_file} \
+        ${genome_batch} \
+        . \
+        ${scanned_table_file.extension}
+    """
+}
+
+// summing occurrence counts is associative, so counts are summed in parallel batches and then the batch sums summed,
+// rather than one task reading every genome's counts
+process sum_occurrence_batch {
+    cpus 1
+    time '1h'
+
+    input:
+    path occurrence_files
+
+    output:
+    path "partial_occurrences_${task.index}.npz"
+
+    """
+    ${python_runner}sum_occurrences.py \
+    partial_occurrences_${task.index}.npz \
+    ${occurrence_files}
+    """
+}
+
 process sum_occurrences {
     cpus 1
     time '1h'
 
+    publishDir "${output_path}/occurrences/", mode: "copy"
+
     input:
-    val jsonList
+    path partial_sums
 
     output:
     path "summed_occurrences.json"
 
     """
-    sum_occurrences.py \
+    ${python_runner}sum_occurrences.py \
     "summed_occurrences.json" \
-    ${jsonList}
+    ${partial_sums}
+    """
+}
+
+// genomes already in the store have their old contribution replaced, so rerunning a genome doesn't count it twice
+process update_occurrence_store {
+    cpus 1
+    time '1h'
+
+    input:
+    path tsv_files
+
+    """
+    occurrence_store.py \
+    add \
+    ${occurrence_store} \
+    ${tsv_files}
     """
 }
 
@@ -257,6 +714,7 @@ process download_bakta_db {
 }
 
 process bakta_annotation {
+    tag "${genome.simpleName}"
     container = 'oschwengers/bakta'
     publishDir("${output_path}/bakta_annotations/", mode: "copy")
 
@@ -284,10 +742,13 @@ process bakta_annotation {
 
 }
 
+// Prokka runs in its own container, which isn't expected to have Python or the VIBES scripts, so contig IDs are renamed
+// beforehand by rename_contig_ids
 process prokka_annotation {
+    tag "${genome_name}"
     container = 'staphb/prokka'
 
-    publishDir("${output_path}/prokka_annotations/", mode: "copy", pattern: "${genome.simpleName}/*")
+    publishDir("${output_path}/prokka_annotations/", mode: "copy", pattern: "${genome_name}/*")
 
     cpus { prokka_cpus * task.attempt }
     time { prokka_time.hour * task.attempt }
@@ -297,25 +758,26 @@ process prokka_annotation {
     maxRetries 2
 
     input:
-    path genome
+    tuple val(genome_name), path(genome), path(id_map)
 
     output:
-    path "${genome.simpleName}/*"
-    tuple val("${genome.simpleName}"), path("${genome.simpleName}.gff"), emit: tuples
+    path "${genome_name}/*"
+    tuple val(genome_name), path(id_map), path("${genome_name}.gff"), emit: tuples
 
     """
     prokka \
-    --outdir ${genome.simpleName}/ \
-    --prefix ${genome.simpleName} \
+    --outdir ${genome_name}/ \
+    --prefix ${genome_name} \
     --cpus ${task.cpus} \
     --compliant \
     ${genome}
 
-    cp ${genome.simpleName}/*.gff .
+    cp ${genome_name}/*.gff .
     """
 }
 
 process prokka_annotation_zip_output {
+    tag "${genome_name}"
     container = 'staphb/prokka'
 
     publishDir("${output_path}/prokka_annotations/", mode: "copy", pattern: "*.tar.gz")
@@ -328,63 +790,52 @@ process prokka_annotation_zip_output {
     maxRetries 2
 
     input:
-    path genome
+    tuple val(genome_name), path(genome), path(id_map)
 
     output:
-    path "${genome.simpleName}.tar.gz"
-    tuple val("${genome.simpleName}"), path("${genome.simpleName}.gff"), emit: tuples
+    path "${genome_name}.tar.gz"
+    tuple val(genome_name), path(id_map), path("${genome_name}.gff"), emit: tuples
 
     """
     prokka \
-    --outdir ${genome.simpleName}/ \
-    --prefix ${genome.simpleName} \
+    --outdir ${genome_name}/ \
+    --prefix ${genome_name} \
     --cpus ${task.cpus} \
     ${genome}
 
-    cp ${genome.simpleName}/*.gff .
-
-    tar --remove -czf ${genome.simpleName}.tar.gz ${genome.simpleName}
-    """
-}
-
-process rename_fasta {
-    cpus 1
-    time '1h'
-
-    input:
-    path original_fasta
-    val name_record
-
-    output:
-    path "${name_record.id}.${original_fasta.getExtension()}"
+    cp ${genome_name}/*.gff .
 
-    """
-    cat ${original_fasta} > ${name_record.id}.${original_fasta.getExtension()}
+    tar --remove -czf ${genome_name}.tar.gz ${genome_name}
     """
 }
 
+// writes the renamed genome uncompressed to a subdirectory, so it keeps the genome's name without overwriting the staged
+// input, and Prokka can read it whether or not the input was gzipped
 process rename_contig_ids {
+    tag "${genome.simpleName}"
     cpus 1
     time '1h'
 
     input:
-    path genome_fasta
+    path genome
 
     output:
-    tuple path("${task.index}.${genome_fasta.extension}"), val("${genome_fasta.simpleName}"), emit: genome_tuples
-    tuple val("${genome_fasta.simpleName}"), path("${genome_fasta.simpleName}_id_map.json"), emit: tuples
+    tuple val("${genome.simpleName}"), path("renamed/${genome.simpleName}.fasta"), path("${genome.simpleName}_id_map.json"), emit: tuples
 
     """
-    change_contig_ids.py \
+    mkdir renamed
+
+    ${python_runner}change_contig_ids.py \
     rename \
-    ${genome_fasta} \
-    ${genome_fasta.simpleName}_id_map.json \
-    --output_fasta ${task.index}.${genome_fasta.extension} \
+    ${genome} \
+    ${genome.simpleName}_id_map.json \
+    --output_fasta renamed/${genome.simpleName}.fasta \
     --verbose
     """
 }
 
 process revert_contig_ids {
+    tag "${genome_name}"
     publishDir("${output_path}/gff/", mode: "copy", pattern: "*.gff")
     cpus 1
     time '1h'
@@ -396,7 +847,7 @@ process revert_contig_ids {
     path input_file
 
     """
-    change_contig_ids.py \
+    ${python_runner}change_contig_ids.py \
     revert \
     ${input_file} \
     ${mapping_json} \
@@ -404,25 +855,6 @@ process revert_contig_ids {
     """
 }
 
-// So, rename_contig_ids has an issue in that it wants to overwrite contig names in the actual input files (this seems
-// bad). I tried using stageInMode 'copy', which should fix this issue by creating a copy of the genome, but instead
-// this causes a mysterious crash. So in the meantime, I'm creating a new output file and renaming it to be the same as
-// the input genome here
-process fix_modified_fasta_name {
-    cpus 1
-    time '1h'
-
-    input:
-    tuple path(genome_with_wrong_name), val(actual_name)
-
-    output:
-    path "${actual_name}.${genome_with_wrong_name.extension}"
-
-    """
-    mv ${genome_with_wrong_name} ${actual_name}.${genome_with_wrong_name.extension}
-    """
-}
-
 process output_visualization {
     publishDir("${output_path}/", mode: "copy")
     cpus 1
@@ -439,7 +871,7 @@ process output_visualization {
     path 'html_viz/*.html'
 
     """
-    parse.py \
+    ${python_runner}parse.py \
     -b ${projectDir}/resources/html/vibes-soda.js \
     -t ${projectDir}/resources/html/template.html \
     -o html_viz/ \
@@ -465,6 +897,23 @@ workflow build_hmm {
 }
 
 
+// Removes genome sequences that share too few k-mers with the phage database, so they are never scanned by nhmmscan.
+// Genomes with no passing sequences are dropped entirely
+workflow prefilter_genomes {
+    take:
+        phage_file
+        genome_files
+
+    main:
+        kmer_index = build_kmer_index(phage_file)
+        kmer_prefilter(genome_files, kmer_index)
+
+    emit:
+        genomes = kmer_prefilter.out.genomes.filter { it.size() > 0 }
+        reports = kmer_prefilter.out.reports
+}
+
+
 // TODO: Block comment
 workflow amino_annotation {
     take:
@@ -516,21 +965,53 @@ workflow detect_integrations {
         tables = table_channel
 }
 
-// TODO: Block comment
+// Scans genomes already in the incremental store against only the phages added since the last run, and scans new
+// genomes against the whole database. Only genomes whose hits changed are emitted for reformatting, so integration
+// .tsv files from earlier runs are kept as they are for every other genome
+workflow incremental_detect_integrations {
+    take:
+        phage_file
+        genome_files
+
+    main:
+        diff_phage_database(phage_file, incremental_store)
+
+        genome_branches = genome_files.branch {
+            stored: file("${incremental_store}/raw_tables/${it.simpleName}.dfam").exists()
+            unscanned: true
+        }
+
+        // the full database only needs to be built if at least one genome has never been scanned
+        full_phages = genome_branches.unscanned.first().map { ["full", file(phage_file)] }
+        new_phages = diff_phage_database.out.new_phages.map { ["new", it] }
+        hmm_tuples = incremental_hmm_build(new_phages.mix(full_phages))
+
+        stored_inputs = genome_branches.stored.combine(hmm_tuples.filter { it[0] == "new" })
+        unscanned_inputs = genome_branches.unscanned.combine(hmm_tuples.filter { it[0] == "full" })
+
+        incremental_nhmmscan(stored_inputs.mix(unscanned_inputs), diff_phage_database.out.removed)
+        update_phage_manifest(diff_phage_database.out.manifest, incremental_nhmmscan.out.raw_tables.collect().ifEmpty([]))
+
+        changed_tables = incremental_nhmmscan.out.tables.filter { it[2] == "true" }
+
+    emit:
+        genomes = changed_tables.map { it[0] }
+        tables = changed_tables.map { it[1] }
+}
+
+// annotates proteins on the viral genomes in phage_file. One task splits phage_file into batches of bath_batch_size, so
+// each bathsearch task loads the viral protein database once for many genomes, and each batch's table is then split
+// back into one .tsv per genome
 workflow bath_viral_genomes {
     take:
         phage_file
         viral_protein_hmm
+        protein_annotations
 
     main:
-        phage_genomes = Channel.fromPath(phage_file).splitFasta(file: true)
-        phage_ids = Channel.fromPath(phage_file).splitFasta(record: [id: true])
+        split_phages(file(phage_file))
+        phage_batches = split_phages.out.batches.flatten()
         viral_protein_hmm = file(viral_protein_hmm)
-        table_type = Channel.value("tbl")
-
-        // we want the .fasta file names to be more informative than something like phage_db.x.fasta, so rename to virus
-        // id
-        phage_genomes = rename_fasta(phage_genomes, phage_ids)
 
         // we expect viral protein .hmms to be amino acid seqs, so we use BATH
         if (viral_protein_hmm.getExtension() == "hmm") {
@@ -538,11 +1019,12 @@ workflow bath_viral_genomes {
             viral_protein_hmm = bathconvert.out.bathmm
         }
 
-        bathsearch(phage_genomes, viral_protein_hmm)
+        bathsearch(phage_batches, viral_protein_hmm)
+        reformat_protein_batch(bathsearch.out.genomes, bathsearch.out.tables, protein_annotations,
+                               split_phages.out.manifest.first())
 
     emit:
-        genomes = bathsearch.out.genomes
-        tables = bathsearch.out.tables
+        tsv_files = reformat_protein_batch.out.tsv_files
 }
 
 workflow reformat_integration_tables {
@@ -554,7 +1036,21 @@ workflow reformat_integration_tables {
         reformat_integrations(genomes, integration_tables)
 
     emit:
-        tsv_files = reformat_integrations.out
+        tsv_files = reformat_integrations.out.tsv_files
+        occurrences = reformat_integrations.out.occurrences
+}
+
+
+workflow sum_occurrence_counts {
+    take:
+        occurrence_files
+
+    main:
+        sum_occurrence_batch(occurrence_files.collate(occurrence_batch_size))
+        sum_occurrences(sum_occurrence_batch.out.collect())
+
+    emit:
+        summed_occurrences = sum_occurrences.out
 }
 
 
@@ -563,22 +1059,19 @@ workflow bacterial_annotation_prokka {
         genome_files
 
     main:
+        // rename_contig_ids emits (genome_name, renamed genome, JSON) tuples. Prokka tasks pass the JSON through,
+        // emitting (genome_name, JSON, GFF) tuples
         rename_contig_ids(genome_files)
-        renamed_contig_id_genomes_wrong_name = rename_contig_ids.out.genome_tuples
-        renamed_contig_tuples = rename_contig_ids.out.tuples
-
-        renamed_contig_id_genomes = fix_modified_fasta_name(renamed_contig_id_genomes_wrong_name)
-
-        // store annotation output in tuples so we can join to the proper ID mapping JSON
+        renamed_genomes = rename_contig_ids.out.tuples
         output_tuples = Channel.empty()
 
         if (zip_prokka == true) {
-            prokka_annotation_zip_output(renamed_contig_id_genomes)
+            prokka_annotation_zip_output(renamed_genomes)
             output_tuples = prokka_annotation_zip_output.out.tuples
         }
 
         else if (zip_prokka == false) {
-            prokka_annotation(renamed_contig_id_genomes)
+            prokka_annotation(renamed_genomes)
             output_tuples = prokka_annotation.out.tuples
         }
 
@@ -586,9 +1079,7 @@ workflow bacterial_annotation_prokka {
             error "zip_prokka must be either true or false in parameters file"
         }
 
-        // renamed_contig_tuples should contain (genome_name, JSON). output_tuples should contain (genome_name, GFF).
-        // .join() should match matching genome names, giving us (genome_name, JSON, GFF)
-        revert_contig_ids(renamed_contig_tuples.join(output_tuples))
+        revert_contig_ids(output_tuples)
 
     emit:
         reverted_files = revert_contig_ids.out
@@ -622,6 +1113,8 @@ workflow {
     protein_annotations = params.viral_protein_annotation_tsv
     prokka_annotation = params.prokka_annotation
     visualize_output = params.visualize_output
+    kmer_prefilter = params.kmer_prefilter
+    prefilter_validation = params.prefilter_validation
 
     if (!detect_integrations && !prokka_annotation && !annotate_viral_genomes && !visualize_output) {
         error "Warning: All workflow operations (detect_integrations, annotate_phage_genes, prokka_annotation, html_visual_output) in\
@@ -632,16 +1125,67 @@ workflow {
         error "Error: phage_seq_type in params_file must be dna, rna, or amino"
     }
 
+    if (kmer_prefilter && prefilter_validation && fuse_table_parsing && !debug_mode) {
+        error "Error: prefilter_validation needs scan tables, which fuse_table_parsing only keeps when debug_mode is true"
+    }
+
     // if statements allow users to disable specific parts of the VIBES workflow
     // else statements ensures html_visual_output waits on other workflows to 
     // complete, if enabled
 
     if (detect_integrations && (seq_type == "dna" || seq_type == "rna")) {
-        hmm_files = build_hmm(phage_file)
-        detect_integrations(hmm_files, genome_files)
-        integration_genomes = detect_integrations.out.genomes
-        integration_tables = detect_integrations.out.tables
-        di_output = reformat_integration_tables(integration_genomes, integration_tables)
+        scan_genome_files = genome_files
+
+        // in validation mode, every genome is still fully scanned so the prefilter's reports can be checked against
+        // the complete set of hits
+        if (kmer_prefilter) {
+            prefilter_genomes(phage_file, genome_files)
+
+            if (!prefilter_validation) {
+                scan_genome_files = prefilter_genomes.out.genomes
+            }
+        }
+
+        if (incremental_store) {
+            incremental_detect_integrations(phage_file, scan_genome_files)
+            integration_genomes = incremental_detect_integrations.out.genomes
+            integration_tables = incremental_detect_integrations.out.tables
+        }
+        else if (fuse_table_parsing) {
+            hmm_files = build_hmm(phage_file)
+            nhmmscan_fused(scan_genome_files, hmm_files)
+            // tables are only kept in debug mode
+            integration_tables = nhmmscan_fused.out.tables
+        }
+        else {
+            hmm_files = build_hmm(phage_file)
+            detect_integrations(hmm_files, scan_genome_files)
+            integration_genomes = detect_integrations.out.genomes
+            integration_tables = detect_integrations.out.tables
+        }
+
+        if (fuse_table_parsing && !incremental_store) {
+            di_output = nhmmscan_fused.out.tsv_files
+            occurrence_files = nhmmscan_fused.out.occurrences
+        }
+        else {
+            reformat_integration_tables(integration_genomes, integration_tables)
+            di_output = reformat_integration_tables.out.tsv_files
+            occurrence_files = reformat_integration_tables.out.occurrences
+        }
+
+        if (occurrence_counts) {
+            sum_occurrence_counts(occurrence_files)
+        }
+
+        if (occurrence_store) {
+            update_occurrence_store(di_output.collect())
+        }
+
+        if (kmer_prefilter && prefilter_validation) {
+            prefilter_reports = prefilter_genomes.out.reports.map { [it.simpleName, it] }
+            validate_prefilter(prefilter_reports.join(integration_tables.map { [it.simpleName, it] }))
+        }
     }
     else if (detect_integrations && seq_type == "amino") {
         phage_file = file(phage_file)
@@ -662,11 +1206,8 @@ workflow {
     }
 
     if (annotate_viral_genomes) {
-        bath_viral_genomes(phage_file, viral_protein_hmm)
-        annotation_genomes = bath_viral_genomes.out.genomes
-        annotation_tables = bath_viral_genomes.out.tables
-
-        vg_output = reformat_proteins(annotation_genomes, annotation_tables, protein_annotations)
+        bath_viral_genomes(phage_file, viral_protein_hmm, protein_annotations)
+        vg_output = bath_viral_genomes.out.tsv_files
     }
     else {
         vg_output = Channel.of(1)
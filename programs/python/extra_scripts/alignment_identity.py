@@ -0,0 +1,227 @@
+# Computes relatedness between genomes from the alignment tables written by nhmmer_stdout_alignment_parser.py. For each
+# alignment, percent identity, gap counts and the covered query and target ranges are computed by comparing the aligned
+# strings as NumPy byte arrays. Alignments are then combined per query-target pair and written as a genome-by-genome
+# matrix, with rows for queries and columns for targets.
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from nhmmer_stdout_alignment_parser import ALIGNMENT_COLUMNS
+
+# characters HMMER uses for gaps in aligned strings: '.' for insertions relative to the query, '-' for deletions
+GAP_CHARS = np.frombuffer(b".-", dtype=np.uint8)
+
+# per-alignment statistics gathered from each table, in the order they're stored in each table's stats array
+STAT_COLUMNS = ["aligned_columns", "matches", "gap_columns", "gap_opens"]
+
+METRICS = ["identity", "query_coverage", "target_coverage", "relatedness"]
+
+PAIR_COLUMNS = ["query", "target", "alignments", "aligned_columns", "matches", "gap_columns", "gap_opens", "identity",
+                "query_covered", "query_len", "query_coverage", "target_covered", "target_len", "target_coverage",
+                "relatedness"]
+
+
+def concatenate_alignments(alignments: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    # all aligned strings in a table are joined into one byte array, so every comparison below runs over the whole
+    # table at once. Case is ignored: the query line of nhmmer output is the model consensus, often in lowercase
+    joined = np.frombuffer("".join(alignments).upper().encode("ascii"), dtype=np.uint8)
+    lengths = alignments.str.len().to_numpy(dtype=np.int64)
+
+    return joined, lengths
+
+
+def gap_opens(gaps: np.ndarray, row_starts: np.ndarray) -> np.ndarray:
+    # a gap opens at each gap column not preceded by a gap column in the same alignment
+    opens = gaps.copy()
+    opens[1:] &= ~gaps[:-1]
+    opens[row_starts] = gaps[row_starts]
+
+    return opens
+
+
+def alignment_stats(query_alignments: pd.Series, target_alignments: pd.Series) -> np.ndarray:
+    """Returns an (alignments x STAT_COLUMNS) array of counts for each
+    pair of aligned strings. Every pair must be the same length and at
+    least one character long"""
+    query_bytes, lengths = concatenate_alignments(query_alignments)
+    target_bytes, _ = concatenate_alignments(target_alignments)
+    row_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    query_gaps = np.isin(query_bytes, GAP_CHARS)
+    target_gaps = np.isin(target_bytes, GAP_CHARS)
+    aligned = ~(query_gaps | target_gaps)
+
+    columns = np.stack([aligned,
+                        aligned & (query_bytes == target_bytes),
+                        query_gaps ^ target_gaps,
+                        gap_opens(query_gaps, row_starts) | gap_opens(target_gaps, row_starts)])
+
+    # sum each alignment's columns in one pass
+    return np.add.reduceat(columns.astype(np.int64), row_starts, axis=1).T
+
+
+def read_alignment_table(table_path: str) -> pd.DataFrame:
+    # the header line starts with '#', so it's skipped and the column names are supplied directly
+    table = pd.read_csv(table_path, sep="\t", skiprows=1, names=ALIGNMENT_COLUMNS, keep_default_na=False,
+                        dtype={"query": str, "target": str, "query_alignment": str, "target_alignment": str})
+
+    for column in ["query_len", "target_len"]:
+        # parsed query lengths are '-' if nhmmer didn't report one
+        table[column] = pd.to_numeric(table[column], errors="coerce").fillna(0).astype(np.int64)
+
+    return table
+
+
+def process_alignment_table(table_path: str) -> pd.DataFrame:
+    table = read_alignment_table(table_path)
+
+    query_lengths = table["query_alignment"].str.len()
+    target_lengths = table["target_alignment"].str.len()
+    valid = (query_lengths == target_lengths) & (query_lengths > 0)
+
+    if not valid.all():
+        print(f"Skipping {(~valid).sum()} alignments with mismatched aligned string lengths in {table_path}",
+              file=sys.stderr)
+        table = table[valid].reset_index(drop=True)
+
+    if len(table) == 0:
+        stats = pd.DataFrame(np.zeros((0, len(STAT_COLUMNS)), dtype=np.int64), columns=STAT_COLUMNS)
+    else:
+        stats = pd.DataFrame(alignment_stats(table["query_alignment"], table["target_alignment"]),
+                             columns=STAT_COLUMNS)
+
+    # aligned strings aren't needed past this point, so only coordinates and counts are sent back to the parent process
+    alignment_info = table[["query", "query_len", "query_from", "query_to", "target", "target_len", "target_from",
+                            "target_to"]]
+
+    return pd.concat([alignment_info, stats], axis=1)
+
+
+def covered_lengths(pair_index: np.ndarray, froms: np.ndarray, tos: np.ndarray, pair_count: int) -> np.ndarray:
+    """Returns the number of positions covered by at least one
+    alignment for each pair, so overlapping alignments aren't counted
+    twice. Coordinates are 1-based and inclusive, and from may be
+    greater than to for reverse strand alignments"""
+    starts = np.minimum(froms, tos).astype(np.int64)
+    ends = np.maximum(froms, tos).astype(np.int64) + 1
+
+    # offset each pair's coordinates past the previous pair's, so one sort and one running maximum handle every pair
+    offset = pair_index * (ends.max(initial=0) + 1)
+    order = np.lexsort((starts, pair_index))
+    starts = (starts + offset)[order]
+    ends = (ends + offset)[order]
+
+    # everything before the furthest end seen so far is already covered
+    prev_max_end = np.concatenate(([0], np.maximum.accumulate(ends)[:-1]))
+    new_coverage = np.maximum(ends - np.maximum(starts, prev_max_end), 0)
+
+    return np.bincount(pair_index[order], weights=new_coverage, minlength=pair_count).astype(np.int64)
+
+
+def summarize_pairs(alignments: pd.DataFrame) -> pd.DataFrame:
+    pair_keys = alignments["query"] + "\t" + alignments["target"]
+    pair_index, pair_names = pd.factorize(pair_keys)
+    pair_count = len(pair_names)
+
+    grouped = alignments.groupby(pair_index)
+    pairs = pd.DataFrame({"query": grouped["query"].first().to_numpy(),
+                          "target": grouped["target"].first().to_numpy(),
+                          "alignments": grouped.size().to_numpy()})
+
+    for column in STAT_COLUMNS:
+        pairs[column] = grouped[column].sum().to_numpy()
+
+    # identity is measured over columns where neither sequence has a gap
+    pairs["identity"] = 100 * pairs["matches"] / pairs["aligned_columns"].where(pairs["aligned_columns"] > 0)
+
+    for side in ["query", "target"]:
+        pairs[f"{side}_covered"] = covered_lengths(pair_index, alignments[f"{side}_from"].to_numpy(),
+                                                   alignments[f"{side}_to"].to_numpy(), pair_count)
+        pairs[f"{side}_len"] = grouped[f"{side}_len"].max().to_numpy()
+        side_lengths = pairs[f"{side}_len"].where(pairs[f"{side}_len"] > 0)
+        pairs[f"{side}_coverage"] = 100 * pairs[f"{side}_covered"] / side_lengths
+
+    # identity weighted by how much of the query is covered, so short, highly similar alignments between otherwise
+    # unrelated genomes don't look like close relatives
+    pairs["relatedness"] = pairs["identity"] * pairs["query_coverage"] / 100
+
+    return pairs[PAIR_COLUMNS].fillna(0)
+
+
+def build_matrix(pairs: pd.DataFrame, metric: str) -> pd.DataFrame:
+    genomes = sorted(set(pairs["query"]) | set(pairs["target"]))
+    values = pairs.pivot(index="query", columns="target", values=metric).reindex(index=genomes, columns=genomes)
+    values = values.fillna(0).to_numpy(copy=True)
+
+    # self alignments are dropped by the parser, but every genome is identical to and fully covers itself
+    np.fill_diagonal(values, 100)
+
+    return pd.DataFrame(values, index=genomes, columns=genomes)
+
+
+def get_table_paths(input_paths: List[str]) -> List[str]:
+    table_paths = []
+
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            table_paths.extend(sorted(f"{input_path}/{table}" for table in os.listdir(input_path)
+                                      if table.endswith("_alignments.tsv")))
+        else:
+            table_paths.append(input_path)
+
+    return table_paths
+
+
+def compute_relatedness(table_paths: List[str], workers: int) -> pd.DataFrame:
+    with Pool(processes=workers) as pool:
+        alignments = pd.concat(pool.imap(process_alignment_table, table_paths), ignore_index=True)
+
+    return summarize_pairs(alignments)
+
+
+def parse_args(sys_args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(sys_args, description="Computes percent identity, coverage and gap statistics for "
+                                                           "each pair of genomes from alignment tables written by "
+                                                           "nhmmer_stdout_alignment_parser.py, and writes a "
+                                                           "genome-by-genome relatedness matrix")
+    parser.add_argument("input_paths", type=str, nargs="+",
+                        help="Alignment tables, or directories containing *_alignments.tsv tables")
+    parser.add_argument("output_matrix", type=str,
+                        help="Path to output .tsv matrix, with a row for each query genome and a column for each "
+                             "target genome")
+    parser.add_argument("--metric", type=str, choices=METRICS, default="identity",
+                        help="Value stored in the matrix: percent identity over aligned columns, percent of the query "
+                             "or target covered by alignments, or relatedness (identity scaled by query coverage). "
+                             "Defaults to identity")
+    parser.add_argument("--output_pairs", type=str, default="",
+                        help="Path to optional output .tsv with every statistic for each query-target pair")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of alignment tables processed in parallel (default: number of CPUs)")
+
+    return parser.parse_args()
+
+
+def _main():
+    args = parse_args(sys.argv[1:])
+    table_paths = get_table_paths(args.input_paths)
+
+    pairs = compute_relatedness(table_paths, max(1, args.workers))
+
+    if args.output_pairs:
+        with open(args.output_pairs, "w") as pairs_file:
+            pairs_file.write("# " + "\t".join(PAIR_COLUMNS) + "\n")
+            pairs.to_csv(pairs_file, sep="\t", header=False, index=False, float_format="%.4f")
+
+    matrix = build_matrix(pairs, args.metric)
+    matrix.to_csv(args.output_matrix, sep="\t", index_label="# genome", float_format="%.4f")
+
+    print(f"{len(pairs)} genome pairs from {len(table_paths)} alignment tables")
+
+
+if __name__ == "__main__":
+    _main()
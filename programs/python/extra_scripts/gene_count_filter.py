@@ -11,11 +11,12 @@
 # Created on: 2024-01-24
 
 import argparse
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import os
 from pathlib import Path
 import sys
-from typing import List, Dict, Tuple
+from typing import List, Dict, TextIO, Tuple
 
 # Minimum number of genes a match must contain to pass through the filter
 DEFAULT_GENE_COUNT_THRESHOLD = 2
@@ -23,6 +24,9 @@ DEFAULT_GENE_COUNT_THRESHOLD = 2
 # Minimum percentage of a gene covered by a match for it to be counted towards passing the filter
 DEFAULT_GENE_COVERAGE_THRESHOLD = .2
 
+# Sorted gene start coordinates, matching end coordinates, and the length of the longest gene
+GeneIntervals = Tuple[np.ndarray, np.ndarray, int]
+
 
 def plot_histogram(histogram_dict: Dict[int, int], fig_path: str) -> None:
     """
@@ -31,105 +35,79 @@ def plot_histogram(histogram_dict: Dict[int, int], fig_path: str) -> None:
     Args:
          -histogram_dict (Dict[int, int]): Dictionary containing keys that represent a number of genes in a match
             and values that represent how many matches contained that many genes.
+         -fig_path (str): Path to save the histogram PNG to
 
     Returns:
         None
     """
+    # matplotlib is slow to import, so only load it when a histogram is actually requested
+    import matplotlib.pyplot as plt
+
     plt.bar(histogram_dict.keys(), histogram_dict.values())
     plt.xlabel("Genes per Match")
     plt.ylabel("Matches (log)")
     plt.title("Distribution of Genes per Match")
     plt.yscale("log")
-
-    if fig_path:
-        plt.savefig(fig_path)
+    plt.savefig(fig_path)
 
 
-def write_lines_to_output(output_path: str, output_content: str, force: bool) -> None:
+def open_output_file(output_path: str, force: bool) -> TextIO:
     """
-    Opens output_path as a file and writes output_content to it. If the file exists, --force must be enabled
+    Opens output_path as a file for writing. If the file exists, --force must be enabled
     """
     # If this file exists, unless force is enabled, don't write to the file
-    if not Path(output_path).exists() or force:
-        with open(output_path, "w") as output_file:
-            output_file.write(output_content)
-    else:
+    if Path(output_path).exists() and not force:
         raise FileExistsError(
             f"Output file {output_path} already exists- either move or delete this file or enable --force")
 
-
-def sufficient_overlap(match_st: int, match_en: int, gene_st: int, gene_en: int, minimum_coverage: float) -> bool:
-    """
-    Returns True if the gene overlaps enough with the match to pass a threshold determined by
-        DEFAULT_GENE_COVERAGE_THRESHOLD; otherwise, returns False.
-
-    Args:
-        - match_st (int): Start position of the match.
-        - match_en (int): End position of the match.
-        - gene_st (int): Start position of the gene.
-        - gene_en (int): End position of the gene.
-        -minimum_coverage (float): float representation of the minumum percentage by which the match and gene must
-            overlap to be reported
-
-    Returns:
-        - sufficiently_overlaps (bool): True when overlap passes threshold, False otherwise.
-    """
-    # we've ordered the Tuple such that the smaller value is always gene_st, and the larger is always gene_en
-    coverage_factor = ((min(match_en, gene_en) - max(match_st, gene_st)) / (gene_en - gene_st))
-
-    return coverage_factor >= minimum_coverage
-
-
-def gene_in_match(match_st: int, match_en: int, gene_st: int, gene_en: int) -> bool:
-    """
-    Returns True if the gene occurs at all within the bounds of the match; otherwise, returns False.
-
-    Args:
-        - match_st (int): Start position of the match.
-        - match_en (int): End position of the match.
-        - gene_st (int): Start position of the gene.
-        - gene_en (int): End position of the gene.
-
-    Returns:
-        overlaps (bool): True when the match and gene overlap at all, False otherwise.
-    """
-    # If the end of the gene occurs after the start of the match, and the start of the gene occurs before the end of the
-    # match, there must be at least some overlap.
-    return (gene_en > match_st) and (gene_st < match_en)
+    return open(output_path, "w")
 
 
-def report_genes_in_match(match_tuple: Tuple[str, int, int], gene_dict: Dict[str, List[Tuple[int,int]]],
+def report_genes_in_match(match_tuple: Tuple[str, int, int], gene_dict: Dict[str, GeneIntervals],
                           minimum_coverage: float) -> int:
     """
     Accepts a tuple containing match information (from one match on one bacteria genome) and viral gene annotation
     information (all query viruses). Detects genes overlapping with a match and returns how many genes do so.
 
+    A gene counts toward a match when the two overlap at all (the end of the gene occurs after the start of the match,
+    and the start of the gene occurs before the end of the match), and when the overlap covers at least
+    minimum_coverage of the gene. Genes are sorted by start coordinate, so the genes that could overlap the match are
+    found by binary search: a gene can only overlap if it starts before the match ends, and after the match start minus
+    the longest gene's length. Overlap is then checked for all of these candidates at once.
+
     Args:
         - match_tuple (Tuple[str, int, int]): Contains information on one match: (match_name, query_st, query_en)
-        - gene_list (Dict[str, List[Tuple[str, str]]]): Contains gene position information for each query virus:
-            Dict[query_name, List[Tuple[gene_st, gene_en]]
+        - gene_dict (Dict[str, GeneIntervals]): Contains sorted gene position arrays for each query virus, as built by
+            build_gene_intervals()
         -minimum_coverage (float): float representation of the minumum percentage by which the match and gene must
             overlap to be reported
 
     Returns:
         - gene_in_match (int): Number of genes that overlap with match
     """
-    genes_in_match = 0
-    # use query virus name to identify correct gene position list
-    gene_list = gene_dict[match_tuple[0]]
+    # use query virus name to identify correct gene position arrays
+    gene_starts, gene_ends, max_gene_len = gene_dict[match_tuple[0]]
 
     match_st = match_tuple[1]
     match_en = match_tuple[2]
 
-    for gene_tuple in gene_list:
-        gene_st = gene_tuple[0]
-        gene_en = gene_tuple[1]
+    first_candidate = np.searchsorted(gene_starts, match_st - max_gene_len, side="right")
+    last_candidate = np.searchsorted(gene_starts, match_en, side="left")
+
+    candidate_starts = gene_starts[first_candidate:last_candidate]
+    candidate_ends = gene_ends[first_candidate:last_candidate]
 
-        if gene_in_match(match_st, match_en, gene_st, gene_en) and sufficient_overlap(match_st, match_en, gene_st,
-                                                                                      gene_en, minimum_coverage):
-            genes_in_match += 1
+    overlaps = candidate_ends > match_st
+    overlap_lens = np.minimum(match_en, candidate_ends) - np.maximum(match_st, candidate_starts)
+    gene_lens = candidate_ends - candidate_starts
 
-    return genes_in_match
+    # a gene with the same start and end coordinate has no length to divide by- if it overlaps the match at all, it's
+    # entirely covered
+    coverage_factors = np.ones(len(gene_lens))
+    has_length = gene_lens > 0
+    coverage_factors[has_length] = overlap_lens[has_length] / gene_lens[has_length]
+
+    return int(np.count_nonzero(overlaps & (coverage_factors >= minimum_coverage)))
 
 
 def generate_match_tuple(line: str) -> Tuple[str, int, int]:
@@ -164,18 +142,36 @@ def generate_match_tuple(line: str) -> Tuple[str, int, int]:
     return match_tuple
 
 
-def build_query_virus_gene_dict(gene_annotation_paths: List[str]) -> Dict[str, List[Tuple[int, int]]]:
+def build_gene_intervals(gene_list: List[Tuple[int, int]]) -> GeneIntervals:
     """
-    Builds a Dictionary where each key is the name of a query virus and values are a List of Tuples, each Tuple
-    containing the start and end coordinate of an annotated gene on the associated query viral genome.
+    Converts a list of gene coordinates into sorted arrays that report_genes_in_match() can binary search.
+
+    Args:
+    - gene_list (List[Tuple[int,int]]): List of tuples containing start and end coordinates for genes
+
+    Returns:
+    - gene_intervals (GeneIntervals): Tuple containing an array of gene start coordinates sorted in ascending order, an
+    array of the matching end coordinates, and the length of the longest gene
+    """
+    gene_array = np.array(sorted(gene_list), dtype=np.int64).reshape(-1, 2)
+    gene_starts = gene_array[:, 0]
+    gene_ends = gene_array[:, 1]
+    max_gene_len = int((gene_ends - gene_starts).max()) if len(gene_array) > 0 else 0
+
+    return gene_starts, gene_ends, max_gene_len
+
+
+def build_query_virus_gene_dict(gene_annotation_paths: List[str]) -> Dict[str, GeneIntervals]:
+    """
+    Builds a Dictionary where each key is the name of a query virus and values are sorted arrays of the start and end
+    coordinates of annotated genes on the associated query viral genome.
 
     Args:
     - gene_annotation_paths (List[str]): List of paths to viral gene annotation TSV files generated by VIBES
 
     Returns:
-    - gene_dict (Dict[str, List[Tuple[int,int]]]): Dictionary where each key is the name of a query virus and
-    values are a List of Tuples, each Tuple containing the start and end coordinate of an annotated gene on the
-    associated query viral genome
+    - gene_dict (Dict[str, GeneIntervals]): Dictionary where each key is the name of a query virus and values are
+    gene intervals, as built by build_gene_intervals()
     """
     gene_dict = {}
 
@@ -183,7 +179,7 @@ def build_query_virus_gene_dict(gene_annotation_paths: List[str]) -> Dict[str, L
         gene_list = generate_gene_list(annotation_path)
         # annotation TSVs are named after their viruses. With Path().stem, we get the file name without preceding
         # path or extensions
-        gene_dict[Path(annotation_path).stem] = gene_list
+        gene_dict[Path(annotation_path).stem] = build_gene_intervals(gene_list)
 
     return gene_dict
 
@@ -245,6 +241,119 @@ def generate_gene_list(annotation_tsv_path: str) -> List[Tuple[int, int]]:
     return gene_list
 
 
+def filter_integration_file(integration_path: str, output_dir: str, gene_dict: Dict[str, GeneIntervals],
+                            minimum_gene_threshold: int, minimum_coverage: float, force: bool) -> Dict[int, int]:
+    """
+    Filters one VIBES integration TSV, writing each integration that contains enough genes to a filtered TSV in
+    output_dir as soon as it's found.
+
+    Args:
+    - integration_path (str): Path to VIBES output bacterial_integration TSV
+    - output_dir (str): Path to directory the filtered TSV will be written to
+    - gene_dict (Dict[str, GeneIntervals]): Gene intervals for each query virus, from build_query_virus_gene_dict()
+    - minimum_gene_threshold (int): Minimum number of genes required for an integration to pass the filter
+    - minimum_coverage (float): How much of a gene must be contained in a match for it to be counted
+    - force (bool): If True, overwrite the output file if it exists
+
+    Returns:
+    - histogram_dict (Dict[int, int]): Dictionary where keys are the number of genes found in a match, and values are
+    the number of matches in this file with that many genes
+    """
+    # dict where keys are the number of genes found in a match, and the number of matches with that many genes
+    # are values
+    histogram_dict = {}
+
+    print(f"Opening {integration_path}...")
+
+    # set output file path based on provided output directory and current integration file name
+    output_file_path = f"{output_dir}/{Path(integration_path).stem}_filtered.tsv"
+
+    with open(integration_path) as integration_file, open_output_file(output_file_path, force) as output_file:
+        # some matches on different lines are part of the same integration, and share an ID. we want to count up
+        # genes across all of these matches and include them as a group if they pass the threshold.
+        prev_match_id = None
+        prev_match_lines = []
+        prev_match_genes = 0
+
+        for line in integration_file:
+            # header lines start with #, so we grab it for the output file
+            if line[0] == '#':
+                output_file.write(line)
+            else:
+                # split the line on the seperator character (\t), and grab last entry (ID). Then remove newline
+                match_id = line.split("\t")[-1].rstrip()
+                match_tuple = generate_match_tuple(line)
+                genes_in_match = report_genes_in_match(match_tuple, gene_dict, minimum_coverage)
+
+                # check to see if the match id is the same as on the previous line. if so, continue to accumulate genes
+                # for this integration
+                if match_id == prev_match_id:
+                    prev_match_genes += genes_in_match
+                    prev_match_lines.append(line)
+
+                # if the ids don't match, then we can see if the previous line(s) qualified, and write them straight
+                # to the output file if so:
+                else:
+                    if prev_match_genes >= minimum_gene_threshold:
+                        output_file.writelines(prev_match_lines)
+
+                    # we only want to overwrite these if the match has a new ID
+                    prev_match_id = match_id
+                    prev_match_genes = genes_in_match
+                    prev_match_lines = [line]
+
+                # capture info in histogram even if it doesn't pass the threshold
+                # .setdefault() looks for the key in the dict, returning its value if the key exists.
+                # If not, it inserts the key with the second argument as a default value. So, here we
+                # add 1 to the value representing how many matches contained this many genes, adding
+                # 1 to 0 if it's the first case
+                histogram_dict[prev_match_genes] = histogram_dict.setdefault(prev_match_genes, 0) + 1
+
+        # then, after exiting the loop, we know the previous line was the last list (and maybe more if it shared an
+        # id with lines before it). We have to check if this last line passed the threshold:
+        if prev_match_genes >= minimum_gene_threshold:
+            output_file.writelines(prev_match_lines)
+            # .setdefault() looks for the key in the dict, returning its value if the key exists.
+            # If not, it inserts the key with the second argument as a default value. So, here we
+            # add 1 to the value representing how many matches contained this many genes, adding
+            # 1 to 0 if it's the first case
+            histogram_dict[prev_match_genes] = histogram_dict.setdefault(prev_match_genes, 0) + 1
+
+    return histogram_dict
+
+
+# gene intervals for each worker process, set once per worker by init_worker() rather than sent with every file
+worker_gene_dict = {}
+
+
+def init_worker(gene_dict: Dict[str, GeneIntervals]) -> None:
+    """
+    Stores gene intervals in a worker process, so they're only sent to each worker once.
+
+    Args:
+    - gene_dict (Dict[str, GeneIntervals]): Gene intervals for each query virus
+    """
+    global worker_gene_dict
+    worker_gene_dict = gene_dict
+
+
+def filter_integration_file_in_worker(integration_path: str, output_dir: str, minimum_gene_threshold: int,
+                                      minimum_coverage: float, force: bool) -> Dict[int, int]:
+    """
+    Runs filter_integration_file() in a worker process, using the gene intervals stored by init_worker().
+    """
+    return filter_integration_file(integration_path, output_dir, worker_gene_dict, minimum_gene_threshold,
+                                   minimum_coverage, force)
+
+
+def merge_histograms(histogram_dict: Dict[int, int], file_histogram_dict: Dict[int, int]) -> None:
+    """
+    Adds the counts in file_histogram_dict into histogram_dict.
+    """
+    for gene_count, match_count in file_histogram_dict.items():
+        histogram_dict[gene_count] = histogram_dict.setdefault(gene_count, 0) + match_count
+
+
 def parse_args(sys_args: List[str]) -> argparse.Namespace:
     """
     Parses command line arguments.
@@ -266,6 +375,7 @@ def parse_args(sys_args: List[str]) -> argparse.Namespace:
     parser.add_argument("--gene_count_threshold", type=int, help=f"Minimum genes per match required by filter. Default value: {DEFAULT_GENE_COUNT_THRESHOLD}", default=DEFAULT_GENE_COUNT_THRESHOLD)
     parser.add_argument("--gene_coverage_threshold", type=float, help=f"Minimum overlap between match and gene required for gene to be counted. Default: {DEFAULT_GENE_COVERAGE_THRESHOLD}", default=DEFAULT_GENE_COVERAGE_THRESHOLD)
     parser.add_argument("--output_histogram", type=str, help="Where to save output histogram PNG", default="")
+    parser.add_argument("--workers", type=int, help="Number of integration TSVs filtered in parallel. Default: number of CPUs", default=os.cpu_count())
     parser.add_argument("--force", help="If output files already exist, overwrite them", action="store_true")
 
     return parser.parse_args()
@@ -296,6 +406,9 @@ def _main():
     # boolean that, when True, overwrites any output files should they exist
     force = args.force
 
+    # number of integration TSVs filtered at once
+    workers = max(1, args.workers)
+
     # dict where keys are the number of genes found in a match, and the number of matches with that many genes
     # are values
     histogram_dict = {}
@@ -309,67 +422,18 @@ def _main():
     # get dict with gene position information for each query virus
     gene_dict = build_query_virus_gene_dict(gene_annotation_paths)
 
-    for integration_path in integration_paths:
-        print(f"Opening {integration_path}...")
-        with open(integration_path) as integration_file:
-            # set output file path based on provided output directory and current integration file name
-            output_file_path = f"{output_dir}/{Path(integration_path).stem}_filtered.tsv"
-            output_file_contents = ""
-
-            # some matches on different lines are part of the same integration, and share an ID. we want to count up
-            # genes across all of these matches and include them as a group if they pass the threshold.
-            prev_match_id = None
-            prev_match_lines = ""
-            prev_match_genes = 0
-
-            for line in integration_file:
-                # header lines start with #, so we grab it for the output file
-                if line[0] == '#':
-                    output_file_contents += line
-                else:
-                    # split the line on the seperator character (\t), and grab last entry (ID). Then remove newline
-                    match_id = line.split("\t")[-1].rstrip()
-                    match_tuple = generate_match_tuple(line)
-                    genes_in_match = report_genes_in_match(match_tuple, gene_dict, minimum_coverage)
-
-                    # check to see if the match id is the same as on the previous line. if so, continue to accumulate genes
-                    # for this integration
-                    if match_id == prev_match_id:
-                        prev_match_genes += genes_in_match
-                        prev_match_lines += line
-
-                    # if the ids don't match, then we can see if the previous line(s) qualified:
-                    else:
-                        if prev_match_genes >= minimum_gene_threshold:
-                            output_file_contents += prev_match_lines
-
-
-                        # we only want to overwrite these if the match has a new ID
-                        prev_match_id = match_id
-                        prev_match_genes = genes_in_match
-                        prev_match_lines = line
-
-                    # capture info in histogram even if it doesn't pass the threshold
-                    # .setdefault() looks for the key in the dict, returning its value if the key exists.
-                    # If not, it inserts the key with the second argument as a default value. So, here we
-                    # add 1 to the value representing how many matches contained this many genes, adding
-                    # 1 to 0 if it's the first case
-                    histogram_dict[prev_match_genes] = histogram_dict.setdefault(prev_match_genes, 0) + 1
-
-            # then, after exiting the loop, we know the previous line was the last list (and maybe more if it shared an
-            # id with lines before it). We have to check if this last line passed the threshold:
-            if prev_match_genes >= minimum_gene_threshold:
-                output_file_contents += prev_match_lines
-                # .setdefault() looks for the key in the dict, returning its value if the key exists.
-                # If not, it inserts the key with the second argument as a default value. So, here we
-                # add 1 to the value representing how many matches contained this many genes, adding
-                # 1 to 0 if it's the first case
-                histogram_dict[prev_match_genes] = histogram_dict.setdefault(prev_match_genes, 0) + 1
+    # each integration TSV is filtered independently, so spread them over a pool of worker processes. Each worker
+    # returns a histogram for its file, which are merged here
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(gene_dict,)) as executor:
+        futures = [executor.submit(filter_integration_file_in_worker, integration_path, output_dir,
+                                   minimum_gene_threshold, minimum_coverage, force)
+                   for integration_path in integration_paths]
 
-            # once we've iterated through all lines, we can write to the output file:
-            write_lines_to_output(output_file_path, output_file_contents, force)
+        for future in futures:
+            merge_histograms(histogram_dict, future.result())
 
-    plot_histogram(histogram_dict, hist_file_path)
+    if hist_file_path:
+        plot_histogram(histogram_dict, hist_file_path)
 
 
 if __name__ == "__main__":
@@ -4,92 +4,143 @@
 import argparse
 import os
 import sys
+from multiprocessing import Pool
+from typing import Dict, List, Optional, TextIO, Tuple
+
+# columns of the alignment table written for each nhmmer stdout file
+ALIGNMENT_COLUMNS = ["query", "query_len", "query_from", "query_to", "target", "target_len", "target_from",
+                     "target_to", "score", "query_alignment", "target_alignment"]
+
+
+class AlignmentRecord:
+    def __init__(self, query: str, query_len: str, target: str):
+        self.query = query
+        self.query_len = query_len
+        self.target = target
+        # filled in from the hit's score line: score, query (hmm) from/to, target (ali) from/to and target length
+        self.stats = None
+        self.query_segments = []
+        self.target_segments = []
+
+    def to_tsv_line(self) -> str:
+        score, query_from, query_to, target_from, target_to, target_len = self.stats
+        return "\t".join([self.query, self.query_len, query_from, query_to, self.target, target_len, target_from,
+                          target_to, score, "".join(self.query_segments), "".join(self.target_segments)]) + "\n"
+
+
+def parse_stats_line(line_split: List[str]) -> Tuple[str, str, str, str, str, str]:
+    # the score line under each >> target line looks like:
+    #  !   95.2   0.1   1.2e-28    1    100 []    1000    1099 ..     999    1100 ..    50000    0.97
+    # holding score, bias, E-value, hmm from, hmm to, hmm bounds, ali from, ali to, ali bounds, env from, env to, env
+    # bounds, target sequence length and accuracy
+    return line_split[1], line_split[4], line_split[5], line_split[7], line_split[8], line_split[13]
+
+
+def parse_nhmmer_stdout(stdout_file: TextIO, output_file: TextIO) -> int:
+    """Reads nhmmer stdout line by line, writing one row per alignment
+    to output_file. Returns the number of alignments written"""
+    alignment_count = 0
+    query = None
+    query_len = "-"
+    record = None
+    in_alignment = False
+
+    def flush(current: Optional[AlignmentRecord]) -> int:
+        # self hits don't tell us anything about relatedness, so they're skipped
+        if current is None or current.stats is None or current.query == current.target:
+            return 0
+
+        output_file.write(current.to_tsv_line())
+        return 1
+
+    for line in stdout_file:
+        if line.startswith("Query:"):
+            alignment_count += flush(record)
+            record = None
+            in_alignment = False
+
+            # Query:       seqA  [M=5000]
+            line_split = line.split()
+            query = line_split[1]
+            query_len = line_split[2][3:-1] if len(line_split) > 2 and line_split[2].startswith("[M=") else "-"
+
+        elif line.startswith(">>"):
+            alignment_count += flush(record)
+            record = AlignmentRecord(query, query_len, line.split()[1])
+            in_alignment = False
+
+        elif line.startswith("//"):
+            alignment_count += flush(record)
+            record = None
+            in_alignment = False
+
+        elif record is not None:
+            line_split = line.split()
+
+            if not line_split:
+                continue
+
+            if not in_alignment:
+                if line_split[0] in ("!", "?") and record.stats is None:
+                    record.stats = parse_stats_line(line_split)
+                elif line_split[0] == "Alignment:":
+                    in_alignment = True
+                continue
+
+            # alignment lines look like "seqA  1 ACGT...ACGT  60". The match and posterior probability lines between
+            # them don't start with either sequence name
+            if len(line_split) >= 4 and line_split[0] in (record.query, record.target):
+                segment = "".join(line_split[2:-1])
+                if line_split[0] == record.query:
+                    record.query_segments.append(segment)
+                else:
+                    record.target_segments.append(segment)
+
+    alignment_count += flush(record)
+
+    return alignment_count
+
+
+def parse_nhmmer_stdout_from_path(stdout_path: str, output_path: str) -> int:
+    with open(stdout_path, "r") as stdout_file, open(output_path, "w") as output_file:
+        output_file.write("# " + "\t".join(ALIGNMENT_COLUMNS) + "\n")
+        return parse_nhmmer_stdout(stdout_file, output_file)
+
 
+def parse_file_task(task: Tuple[str, str]) -> Tuple[str, int]:
+    stdout_path, output_path = task
+    return stdout_path, parse_nhmmer_stdout_from_path(stdout_path, output_path)
 
-def parse_nhmmer_stdout_alis(directory, save_dir, save_scores_separate=True):
+
+def parse_nhmmer_stdout_alis(directory: str, save_dir: str, workers: int) -> Dict[str, int]:
     """Given a directory containing text files with nhmmer output,
     this will find the alignments in the files
     and save them to the savedir
 
-    The files will be saved as follows
-
-    for each file in directory F, there will be a directory in savedir
-    F_alignments
-
-    Within each directory, there will be one file per target-query pair
-    this """
+    For each file F in directory, there will be one table in savedir
+    named F_alignments.tsv, with one row per target-query alignment.
+    Files are parsed in parallel, one file per worker process"""
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
-    for inputfile in os.listdir(directory):
-        file = open(f'{directory}/{inputfile}', "r")
-        alltext = file.read()
-
-        query_split = alltext.split("Query:")[1:]
-
-        data_dir = f"{save_dir}/{inputfile[:-4]}_alignments"
-        if not os.path.exists(data_dir):
-            os.mkdir(data_dir)
-        for query_text in query_split:
-            query = query_text.split()[0]
-            target_split = query_text.split(">>")[1:]
-            ali_info_list = ''.join(target_split).split("\n")[3].split()
-            for target_text in target_split:
-                target = target_text.split()[0]
-                if target == query:
-                    continue
-                alignment_text = target_text.split("Alignment:")[1:]
-                assert len(alignment_text) == 1
-                lines = [l for l in alignment_text[0].split("\n") if len(l) > 0]
-                score = ali_info_list[1]
-                query_from = ali_info_list[4]
-                query_to = ali_info_list[5]
-                target_from = ali_info_list[7]
-                target_to = ali_info_list[8]
-                ali_info = f">{query}[{query_from}:{query_to}]--{target}[{target_from}:{target_to}]\n"
-                if save_scores_separate:
-                    filename = f"{target}-{query}_{score}.txt"
-                    alignmentfile = open(f"{data_dir}/{filename}", "w")
-                    alignmentfile.write(ali_info)
-                    for line in lines[1:]:
-                        if query in line:
-                            line_split = line.split()
-                            querysub = ''.join([t for t in line_split[2:-1]])
-                            alignmentfile.write(querysub + "\n")
-                        elif target in line:
-                            line_split = line.split()
-                            targetsub = ''.join([t for t in line_split[2:-1]])
-                            alignmentfile.write(targetsub + "\n" + "\n")
-                else:
-                    filename = f"{target}-{query}.txt"
-                    if os.path.exists(f"{data_dir}/{filename}"):
-                        alignmentfile = open(f"{data_dir}/{filename}", "a")
-                    else:
-                        alignmentfile = open(f"{data_dir}/{filename}", "w")
-
-                    alignmentfile.write(ali_info)
-
-                    for line in lines[1:]:
-                        if query in line:
-                            line_split = line.split()
-                            querysub = ''.join([t for t in line_split[2:-1]])
-                            alignmentfile.write(querysub + "\n")
-                        elif target in line:
-                            line_split = line.split()
-                            targetsub = ''.join([t for t in line_split[2:-1]])
-                            alignmentfile.write(targetsub + "\n" + "\n")
-                alignmentfile.close()
+
+    tasks = [(f"{directory}/{inputfile}", f"{save_dir}/{inputfile[:-4]}_alignments.tsv")
+             for inputfile in sorted(os.listdir(directory))]
+
+    with Pool(processes=workers) as pool:
+        return dict(pool.imap_unordered(parse_file_task, tasks))
 
 
 def parse_args(sys_args: list) -> argparse.Namespace:
     parser = argparse.ArgumentParser(sys_args, description="Parse nhmmer stdout to capture alignments between target "
-                                                           "and query sequences. For each stdout file, produces a "
-                                                           "directory named after the input text file containing "
-                                                           "files with each alignment and the alignment score")
+                                                           "and query sequences. For each stdout file, produces one "
+                                                           ".tsv table named after the input text file, with a row "
+                                                           "for each alignment holding its coordinates, score and "
+                                                           "aligned sequences")
     parser.add_argument("stdout_dir", type=str, help="Path to directory populated with nhmmer stdout in text files")
-    parser.add_argument("alignment_dir", type=str, help="Path to parent output directory, where alignments will be "
-                                                        "stored in subdirectories")
-    parser.add_argument("--suppress_scores", help="Do not include scores in alignent ", action="store_true",
-                        default=False)
+    parser.add_argument("alignment_dir", type=str, help="Path to output directory, where alignment tables will be "
+                                                        "stored")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of stdout files parsed in parallel (default: number of CPUs)")
 
     return parser.parse_args()
 
@@ -99,11 +150,11 @@ def _main():
     args = parse_args(sys.argv[1:])
     stdout_dir = args.stdout_dir
     alignment_dir = args.alignment_dir
-    suppress_score = args.suppress_scores
+    workers = max(1, args.workers)
 
-    # flip suppress_score: if it's True, we want to input False and vice versa
-    parse_nhmmer_stdout_alis(stdout_dir, alignment_dir, not suppress_score)
+    alignment_counts = parse_nhmmer_stdout_alis(stdout_dir, alignment_dir, workers)
+    print(f"{sum(alignment_counts.values())} alignments parsed from {len(alignment_counts)} files")
 
 
 if __name__ == "__main__":
-    _main()
\ No newline at end of file
+    _main()
@@ -1,16 +1,47 @@
 import argparse
+import fasta_io
 from os import path
 import pandas as pd
-import subprocess
 from typing import *
 import sys
 
+# fasta_io.py, the shared .fasta reader and indexer, is one of the workflow scripts in nextflow_workflow/bin. It needs to
+# be importable, e.g. by adding that directory to PYTHONPATH, as region_grab_workflow.nf does
+
 DEFAULT_FLANK_LENGTH = 15000
 
 
+def add_common_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--flank_length", type=int, default=DEFAULT_FLANK_LENGTH,
+                        help=f"Length of each flank to be grabbed from each end of the element (default {DEFAULT_FLANK_LENGTH}). The total length of the grabbed region will be ~twice the flank_length. If a flank would extend past either end of the genome, it will be cut short to match the end of the genome")
+    parser.add_argument("--verbose",
+                        help="Prints each region grabbed by region_grabber.py",
+                        action="store_true")
+    parser.add_argument("--force", help="If output file already exists, overwrite it", action="store_true")
+
+
 def parse_args(sys_args: list) -> argparse.Namespace:
+    # with batch as its first argument, region_grabber.py grabs regions around several elements in several genomes.
+    # Otherwise it takes the same arguments it always has, grabbing regions around one element in one genome
+    if sys_args and sys_args[0] == "batch":
+        batch_parser = argparse.ArgumentParser(prog="region_grabber.py batch",
+                                               description="Grab regions around hits to several elements in several genomes. Regions that overlap on the same sequence are merged, so each stretch of genome is only written once")
+        batch_parser.add_argument("manifest", type=str,
+                                  help="Tab-separated file where each line holds the path to a VIBES .tsv file, the path to the bacterial genome it's based on and, optionally, a genome name used to label its regions (by default, the genome file name up to the first '.')")
+        batch_parser.add_argument("output_fasta", type=str,
+                                  help="Path to output .fasta file, which will contain one sequence for each merged region")
+        batch_parser.add_argument("output_mapping", type=str,
+                                  help="Path to output .tsv file mapping each hit to the merged region that contains it")
+        batch_parser.add_argument("--elements", type=str, nargs="+", required=True,
+                                  help="Names of elements the grabbed regions will be centered on. Each must exactly match the .tsv Name field")
+        add_common_args(batch_parser)
+
+        args = batch_parser.parse_args(sys_args[1:])
+        args.grab_mode = "batch"
+        return args
+
     parser = argparse.ArgumentParser(sys_args,
-                                     description="Scans VIBES .tsv files for hits that match element_name and uses seqkit subseq to grab a region centered on the hit from the original bacterial genome")
+                                     description="Scans VIBES .tsv files for hits that match element_name and grabs a region centered on each hit from the original bacterial genome. Genomes are indexed (genome.fai, kept for later runs) so regions are read directly from their byte offsets. Run 'region_grabber.py batch -h' to grab regions around several elements in several genomes at once")
     parser.add_argument("input_tsv", type=str,
                         help="Input VIBES .tsv file containing information on hits in bacterial genome")
     parser.add_argument("bacterial_genome", type=str,
@@ -19,14 +50,11 @@ def parse_args(sys_args: list) -> argparse.Namespace:
                         help="Name of element the grabbed region will be centered on. Element_name must exactly match the .tsv Name field")
     parser.add_argument("output_fasta", type=str,
                         help="Path to output .fasta file, which will contain sequence of regions around hits matching with name matching element_name")
-    parser.add_argument("--flank_length", type=int, default=DEFAULT_FLANK_LENGTH,
-                        help=f"Length of each flank to be grabbed from each end of the element (default {DEFAULT_FLANK_LENGTH}). The total length of the grabbed region will be ~twice the flank_length. If a flank would extend past either end of the genome, it will be cut short to match the end of the genome")
-    parser.add_argument("--verbose",
-                        help="Prints seqkit subseq commands run by region_grabber.py",
-                        action="store_true")
-    parser.add_argument("--force", help="If output file already exists, overwrite it", action="store_true")
+    add_common_args(parser)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    args.grab_mode = "grab"
+    return args
 
 
 def read_tsv(tsv_path: str) -> pd.DataFrame:
@@ -44,36 +72,54 @@ def get_element_info(tsv_data: pd.DataFrame, element_name: str) -> pd.DataFrame:
     return matching_rows
 
 
+def get_flanked_interval(match_start: int, match_end: int, strand: str, genome_total_length: int,
+                         flank_size: int) -> Tuple[int, int]:
+    start_pos = None
+    end_pos = None
+    # check strand: if -, then match start and end should be flipped as the hit is inverted and starts at match_end
+    if strand == "+":
+        start_pos = match_start - flank_size
+        end_pos = match_end + flank_size
+    elif strand == "-":
+        start_pos = match_end - flank_size
+        end_pos = match_start + flank_size
+    else:
+        raise ValueError(f"Unexpected strand type indicator {strand}: expected + or -")
+
+    if start_pos < 1:
+        start_pos = 1
+
+    if end_pos > genome_total_length: # if greater than genome length
+        end_pos = genome_total_length
+
+    return start_pos, end_pos
+
+
 def get_subseq_list(element_data: pd.DataFrame, flank_size: int, genome_path: str, verbose: bool) -> List[str]:
     subseq_list = []
-    for row in element_data.itertuples():
-        origin_seq_name = row[2]
-        match_start = row[3]
-        match_end = row[4]
-        genome_total_length = row[5]
-        strand = row[6]
-
-        start_pos = None
-        end_pos = None
-        # check strand: if -, then match start and end should be flipped as the hit is inverted and starts at match_end
-        if strand == "+":
-            start_pos = match_start - flank_size
-            end_pos = match_end + flank_size
-        elif row[6] == "-":
-            start_pos = match_end - flank_size
-            end_pos = match_start + flank_size
-        else:
-            raise ValueError(f"Unexpected strand type indicator {row[6]: expected + or -}")
 
-        if start_pos < 1:
-            start_pos = 1
+    if element_data.empty:
+        return subseq_list
+
+    # every region is read from the same memory map, so the genome is only opened once no matter how many hits there are
+    with fasta_io.FastaIndex(genome_path, verbose) as fasta_index:
+        for row in element_data.itertuples():
+            origin_seq_name = row[2]
+            match_start = row[3]
+            match_end = row[4]
+            genome_total_length = row[5]
+            strand = row[6]
+
+            start_pos, end_pos = get_flanked_interval(match_start, match_end, strand, genome_total_length, flank_size)
+
+            end_pos = min(end_pos, fasta_index.get_length(origin_seq_name))
 
-        if end_pos > genome_total_length: # if greater than genome length
-            end_pos = genome_total_length
+            if verbose:
+                print(f"Grabbing {origin_seq_name}:{start_pos}-{end_pos}")
 
-        # seqkit subseq retrieves subsequence from genome with seq name origin_seq_name, coordinates start_pos-end_pos
-        cmd = ["seqkit", "subseq", genome_path, "--chr", origin_seq_name, "-r", f"{start_pos}:{end_pos}"]
-        subseq_list.append(do_cmd(cmd, verbose).stdout)
+            # headers follow seqkit subseq's naming, seq_start-end
+            region = fasta_index.fetch(origin_seq_name, start_pos, end_pos)
+            subseq_list.append(fasta_io.format_fasta_entry(f"{origin_seq_name}_{start_pos}-{end_pos}", region))
 
     return subseq_list
 
@@ -84,46 +130,125 @@ def write_to_output(output_path: str, subseq_list: List[str], force: bool) -> No
             f"Output file {output_path} already exists- either move or delete this file or enable --force")
     else:
         with open(output_path, "w") as output_file:
-            for entry in subseq_list:
-                entry = entry + "\n"
-                output_file.write(entry)
+            output_file.writelines(subseq_list)
 
 
-def index_cleanup(genome_path: str, verbose: bool) -> None:
-    # this function deletes the index file created by seqkit
-    index_path = genome_path + ".seqkit.fai"
-    cmd = ["rm", index_path]
-    do_cmd(cmd, verbose)
+def read_manifest(manifest_path: str) -> List[Tuple[str, str, str]]:
+    manifest_list = []
 
+    with open(manifest_path, "r") as manifest_file:
+        for line in manifest_file:
+            if not line.strip() or line[0] == "#":
+                continue
 
-def do_cmd(cmd: List[str], verbose: bool) -> subprocess.CompletedProcess:
-    # double check that all elements are strings
-    cmd = [str(e) for e in cmd]
-    if verbose:
-        verbose_cmd = " ".join(cmd)
-        print(f"Running command: {verbose_cmd}")
+            fields = line.rstrip("\n").split("\t")
+            tsv_path = fields[0]
+            genome_path = fields[1]
+            genome_name = fields[2] if len(fields) > 2 and fields[2] else path.basename(genome_path).split(".")[0]
+            manifest_list.append((tsv_path, genome_path, genome_name))
+
+    return manifest_list
+
+
+def merge_flanked_intervals(hit_list: List[Tuple[str, int, int, Any]]) -> List[Tuple[str, int, int, List[Any]]]:
+    # hit_list holds (sequence name, flanked start, flanked end, hit info). Sort by sequence and start, then merge any
+    # intervals on the same sequence that overlap or touch, keeping track of which hits ended up in each merged region
+    merged_list = []
+
+    for seq_name, start_pos, end_pos, hit in sorted(hit_list, key=lambda entry: (entry[0], entry[1], entry[2])):
+        if merged_list and merged_list[-1][0] == seq_name and start_pos <= merged_list[-1][2] + 1:
+            prev_name, prev_start, prev_end, prev_hits = merged_list[-1]
+            prev_hits.append(hit)
+            merged_list[-1] = (prev_name, prev_start, max(prev_end, end_pos), prev_hits)
+        else:
+            merged_list.append((seq_name, start_pos, end_pos, [hit]))
+
+    return merged_list
+
+
+def grab_batch_regions(manifest_list: List[Tuple[str, str, str]], element_names: List[str], flank_size: int,
+                       output_fasta: TextIO, output_mapping: TextIO, verbose: bool) -> int:
+    region_count = 0
+    output_mapping.write("# Genome\tHit name\tElement\tSequence name\tMatch start\tMatch end\tStrand\t"
+                         "Flanked start\tFlanked end\tRegion\n")
+
+    for tsv_path, genome_path, genome_name in manifest_list:
+        tsv_data = read_tsv(tsv_path)
+        element_data = tsv_data.loc[tsv_data["Name"].isin(element_names)]
+
+        if element_data.empty:
+            continue
+
+        hit_list = []
+        for row in element_data[["Name", "Hit Name", "Query Sequence Name", "Match Start on Query Seq",
+                                 "Match End on Query Seq", "Query Genome Length", "Strand"]].itertuples(index=False):
+            element_name, hit_name, seq_name, match_start, match_end, genome_total_length, strand = row
+            start_pos, end_pos = get_flanked_interval(match_start, match_end, strand, genome_total_length, flank_size)
+            hit_list.append((seq_name, start_pos, end_pos,
+                             (hit_name, element_name, seq_name, match_start, match_end, strand, start_pos, end_pos)))
 
-    return subprocess.run(cmd, capture_output=True, text=True)
+        # each genome is memory mapped once, and each merged region is read from it once
+        with fasta_io.FastaIndex(genome_path, verbose) as fasta_index:
+            for seq_name, start_pos, end_pos, hits in merge_flanked_intervals(hit_list):
+                end_pos = min(end_pos, fasta_index.get_length(seq_name))
+
+                # sequence names are only unique within a genome, so region names start with the genome name
+                region_name = f"{genome_name}_{seq_name}_{start_pos}-{end_pos}"
+
+                if verbose:
+                    print(f"Grabbing {region_name}, containing {len(hits)} hits")
+
+                output_fasta.write(fasta_io.format_fasta_entry(region_name,
+                                                               fasta_index.fetch(seq_name, start_pos, end_pos)))
+                for hit in hits:
+                    output_mapping.write("\t".join(str(field) for field in (genome_name,) + hit + (region_name,)))
+                    output_mapping.write("\n")
+
+                region_count += 1
+
+    return region_count
+
+
+def grab_batch_regions_from_path(manifest_path: str, element_names: List[str], flank_size: int, output_fasta_path: str,
+                                 output_mapping_path: str, force: bool, verbose: bool) -> None:
+    for output_path in (output_fasta_path, output_mapping_path):
+        if path.isfile(output_path) and not force:
+            raise FileExistsError(
+                f"Output file {output_path} already exists- either move or delete this file or enable --force")
+
+    manifest_list = read_manifest(manifest_path)
+
+    with open(output_fasta_path, "w") as output_fasta, open(output_mapping_path, "w") as output_mapping:
+        region_count = grab_batch_regions(manifest_list, element_names, flank_size, output_fasta, output_mapping,
+                                          verbose)
+
+    if verbose:
+        print(f"{region_count} merged regions grabbed from {len(manifest_list)} genomes")
 
 
 def _main():
     args = parse_args(sys.argv[1:])
-    tsv_path = args.input_tsv
-    genome_path = args.bacterial_genome
-    element_name = args.element_name
-    output_path = args.output_fasta
+    grab_mode = args.grab_mode
     flank_len = args.flank_length
     verbose = args.verbose
     force = args.force
 
-    tsv_data = read_tsv(tsv_path)
-    element_data = get_element_info(tsv_data, element_name)
-    subseqs = get_subseq_list(element_data, flank_len, genome_path, verbose)
+    if grab_mode == "grab":
+        tsv_path = args.input_tsv
+        genome_path = args.bacterial_genome
+        element_name = args.element_name
+        output_path = args.output_fasta
+
+        tsv_data = read_tsv(tsv_path)
+        element_data = get_element_info(tsv_data, element_name)
+        subseqs = get_subseq_list(element_data, flank_len, genome_path, verbose)
 
-    if len(subseqs) > 0:
-        write_to_output(output_path, subseqs, force)
+        if len(subseqs) > 0:
+            write_to_output(output_path, subseqs, force)
 
-    index_cleanup(genome_path, verbose)
+    elif grab_mode == "batch":
+        grab_batch_regions_from_path(args.manifest, args.elements, flank_len, args.output_fasta, args.output_mapping,
+                                     force, verbose)
 
 
 if __name__ == "__main__":
@@ -1,29 +1,27 @@
 import argparse
+import fasta_io
 import sys
 from typing import Dict, TextIO
 import re
 
+# fasta_io.py, the shared .fasta reader, is one of the workflow scripts in nextflow_workflow/bin. It needs to be
+# importable, e.g. by adding that directory to PYTHONPATH
 
-def generate_individual_fastas(fasta_file: TextIO, output_dir: str):
+
+def generate_individual_fastas(fasta_file: TextIO, output_dir: str) -> Dict[str, str]:
     temp_fasta_dict = {}
-    fasta_list = re.split('\n>', fasta_file.read())
-    # TODO: explain why not >
-
-    for entry in fasta_list:
-        # remove leading and trailing > character, if present
-        entry = entry.strip(">")
-        header, sequence = entry.split("\n", 1)
-        # TODO: explain magic number
-        fasta_name = header.split()[0]
-        # grab the 'name,' or fasta header line up to the first whitespace character
-        seq_name = re.escape(header.split()[0])
+
+    for header, seq_lines in fasta_io.read_fasta_records(fasta_file):
+        # each file is named after the 'name,' or fasta header line up to the first whitespace character
+        fasta_name = fasta_io.get_seq_id(header)
+        seq_name = re.escape(fasta_name)
 
         temp_file_path = f"{output_dir}/{fasta_name}.fasta"
         temp_fasta_dict[temp_file_path] = seq_name
-        with open(temp_file_path, "w") as temp_file:
-            temp_file.write(f">{header.strip()}\n{sequence.strip()}")
-            temp_file.close()
+        with fasta_io.FastaWriter(temp_file_path) as temp_writer:
+            temp_writer.write_lines(header, seq_lines)
 
+    return temp_fasta_dict
 
 
 def parse_args(sys_args: list) -> argparse.Namespace:
@@ -46,7 +44,7 @@ def _main():
     input_fasta = args.input_fasta
     output_dir = args.fasta_dir
 
-    with open(input_fasta) as fasta_file:
+    with fasta_io.open_fasta(input_fasta) as fasta_file:
         generate_individual_fastas(fasta_file, output_dir)
 
 